@@ -10,527 +10,1004 @@
 # - Edit `evm.py` (this file!), see TODO below
 # - Run `python3 evm.py` to run the tests
 
-import json
-import os
-from eth_hash.auto import keccak
+import time
+# when this module started importing, for evm_runner's startup report
+IMPORT_START = time.perf_counter()
+
+import sys
 import evm_codes
+import evm_analysis
+from evm_cache import CreateResult, code_cache, create_cache
+import evm_gas
+from evm_gas import OutOfGas
+from evm_keccak import keccak256, keccak_memo
+from evm_logs import Log, LogsBloom
+import evm_compile
+from evm_memory import Memory, MeteredMemory
+import evm_precompiles
+from evm_precompiles import PRECOMPILES
+from evm_stack import UncheckedStack
+from evm_state import WorldState
+import evm_word
+from evm_word import MASK
 
-state = None
+# world state and compile threshold for the module-level evm() and run(),
+# see EVM for running independent contexts side by side
+state = WorldState()
+compile_after = None
 # helper functions
-def mload(memory, offset, size):
-    val = 0
-    if len(memory) < offset + size:
-        memory += ([0] * (offset + size - len(memory)))
-    for i in range(size):
-        val <<= 8
-        val += memory[offset + i]
-    return val
-
-def mstore(memory, data, offset, size):
-    if len(memory) < offset + size:
-        memory += ([0] * (offset + size - len(memory)))
-    for i in range(size):
-        memory[offset + size - i - 1] = (data >> (i * 8)) & 0xFF
-    return memory
-def unsigned_to_signed(x):
-    return x if x < (2 ** 255 - 1) else x - (2 ** 256)
-
-def signed_to_unsigned(x):
-    return x if x >= 0 else x + (2 ** 256)
-
-def invalid_position(code, pc):
-    for i in range(1, 33):
-        if pc < i:
-            break
-        if code[pc - i] == evm_codes.PUSH0 + i:
-            return True
-    return False
-
-def evm(code, tx, block, storage):
-    global state
-    pc = 0
-    success = True
-    stack = []
-    memory = []
-    log = []
-    ret = None
-    lastRet = None
-    
-    while pc < len(code):
-        op = code[pc]
-        pc += 1
-
-        match op:
-            case evm_codes.STOP:
-                break
-            case evm_codes.ADD:
-                stack = [stack[0] + stack[1]] + stack[2:]
-                if stack[0] > (2 ** 256) - 1:
-                    stack[0] -= (2 ** 256)
-            case evm_codes.MUL:
-                stack = [stack[0] * stack[1]] + stack[2:]
-                if stack[0] > (2 ** 256) - 1:
-                    stack[0] %= (2 ** 256)
-            case evm_codes.SUB:
-                stack = [stack[0] - stack[1]] + stack[2:]
-                if stack[0] < 0:
-                    stack[0] += (2 ** 256)
-            case evm_codes.DIV:
-                if stack[1] == 0:
-                    stack = [0] + stack[2:]
-                else:
-                    stack = [stack[0] // stack[1]] + stack[2:]
-            case evm_codes.SDIV:
-                if stack[1] == 0:
-                    stack = [0] + stack[2:]
-                else:
-                    stack[0] = unsigned_to_signed(stack[0])
-                    stack[1] = unsigned_to_signed(stack[1])
-                    num = signed_to_unsigned(stack[0] // stack[1])
-                    stack = [num] + stack[2:]
-            case evm_codes.MOD:
-                if stack[1] == 0:
-                    stack = [0] + stack[2:]
-                else:
-                    stack = [stack[0] % stack[1]] + stack[2:]
-            case evm_codes.SMOD:
-                if stack[1] == 0:
-                    stack = [0] + stack[2:]
-                else:
-                    stack[0] = unsigned_to_signed(stack[0])
-                    stack[1] = unsigned_to_signed(stack[1])
-                    num = signed_to_unsigned(stack[0] % stack[1])
-                    stack = [num] + stack[2:]
-            case evm_codes.ADDMOD:
-                if stack[2] == 0:
-                    stack = [0] + stack[3:]
-                else:
-                    stack = [(stack[0] + stack[1]) % stack[2]] + stack[3:]
-            case evm_codes.MULMOD:
-                if stack[2] == 0:
-                    stack = [0] + stack[3:]
-                else:
-                    stack = [(stack[0] * stack[1]) % stack[2]] + stack[3:]
-            case evm_codes.EXP:
-                stack = [stack[0] ** stack[1]] + stack[2:]
-                if stack[0] > (2 ** 256) - 1:
-                    stack[0] %= (2 ** 256)
-            case evm_codes.SIGNEXTEND:
-                sz = stack[0]
-                num = bin(stack[1] % (256 ** (sz + 1)))
-                if len(num) - 2 == (sz + 1) * 8:
-                    num = '0b' + '1' * (32 * 8 + 2 - len(num)) + num[2:]
-                stack = [int(num, 2)] + stack[2:]
-            case evm_codes.LT:
-                stack = [int(stack[0] < stack[1])] + stack[2:]
-            case evm_codes.GT:
-                stack = [int(stack[0] > stack[1])] + stack[2:]
-            case evm_codes.SLT:
-                stack = [int(unsigned_to_signed(stack[0]) < unsigned_to_signed(stack[1]))] + stack[2:]
-            case evm_codes.SGT:
-                stack = [int(unsigned_to_signed(stack[1]) < unsigned_to_signed(stack[0]))] + stack[2:]
-            case evm_codes.EQ:
-                stack = [int(stack[0] == stack[1])] + stack[2:]
-            case evm_codes.ISZERO:
-                stack = [int(stack[0] == 0)] + stack[1:]
-            case evm_codes.AND:
-                stack = [stack[0] & stack[1]] + stack[2:]
-            case evm_codes.OR:
-                stack = [stack[0] | stack[1]] + stack[2:]
-            case evm_codes.XOR:
-                stack = [stack[0] ^ stack[1]] + stack[2:]
-            case evm_codes.NOT:
-                stack = [stack[0] ^ ((2 ** 256) - 1)] + stack[1:]
-            case evm_codes.BYTE:
-                if stack[0] not in range(0, 32):
-                    stack = [0] + stack[2:]
-                else:
-                    stack = [(stack[1] >> (8*(31 - stack[0]))) & 0xFF] + stack[2:]
-            case evm_codes.SHL:
-                stack = [(stack[1] << stack[0]) & ((2 ** 256) - 1)] + stack[2:]
-            case evm_codes.SHR:
-                stack = [stack[1] >> stack[0]] + stack[2:]
-            case evm_codes.SAR:
-                num = bin(stack[1])
-                if stack[0] >= 256:
-                    num = int('0b' + '1' * 256, 2) if len(num) - 2 == 32 * 8 else 0
-                elif len(num) - 2 == 32 * 8:
-                    num = bin(stack[1] >> stack[0])
-                    if int(num, 2) == 0:
-                        num = '0b'
-                    num = int('0b' + '1' * (32 * 8 + 2 - len(num)) + num[2:], 2)
-                else:
-                    num = stack[1] >> stack[0]
-                stack = [num] + stack[2:]
-            case evm_codes.SHA3:
-                offset, size = stack[0], stack[1]
-                val = mload(memory, offset, size)
-                
-                stack = [int.from_bytes(keccak(val.to_bytes(size, byteorder='big')), byteorder='big')] + stack[2:]
-            case evm_codes.ADDRESS:
-                stack = [int(tx['to'], 16)] + stack
-            case evm_codes.BALANCE:
-                addr = hex(stack[0])
-                if len(addr) < 42:
-                    addr = '0x' + '0'*(42 - len(addr)) + addr[2:]
-                if state is None or addr not in state or 'balance' not in state[addr]:
-                    stack[0] = 0
-                else:
-                    stack[0] = int(state[addr]['balance'], 16)
-            case evm_codes.ORIGIN:
-                stack = [int(tx['origin'], 16)] + stack
-            case evm_codes.CALLER:
-                stack = [int(tx['from'], 16)] + stack
-            case evm_codes.CALLVALUE:
-                stack = [int(tx['value'], 16)] + stack
-            case evm_codes.CALLDATALOAD:
-                pos = stack[0]
-                data = tx['data']
-                end = min(pos * 2 + 64, len(data))
-                data = data[pos * 2:end]
-                if len(data) < 64:
-                    data += ("0"*(64 - len(data)))
-                stack[0] = int(data, 16)
-            case evm_codes.CALLDATASIZE:
-                if tx is None:
-                    a = 0
-                else:
-                    a = len(tx.get('data', '')) / 2
-                stack = [a] + stack
-            case evm_codes.CALLDATACOPY:
-                destoffset, offset, size = stack[0], stack[1], stack[2]
-                if len(memory) < destoffset + size:
-                    memory += ([0] * (destoffset + size - len (memory)))
-                data = tx["data"]
-                for i in range(size):
-                    if (offset + i + 1) * 2 <= len(data):
-                        memory[destoffset + i] = int(data[(offset + i) * 2: (offset + i + 1) * 2], 16)
-                    else:
-                        memory[destoffset + i] = 0
-                stack = stack[3:]
-            case evm_codes.CODESIZE:
-                stack = [len(code)] + stack
-            case evm_codes.CODECOPY:
-                destoffset, offset, size = stack[0], stack[1], stack[2]
-                if len(memory) < destoffset + size:
-                    memory += ([0] * (destoffset + size - len (memory)))
-                data = code
-                for i in range(size):
-                    if (offset + i) <= len(data):
-                        memory[destoffset + i] = int.from_bytes(data[(offset + i): (offset + i + 1)], byteorder="big")
-                    else:
-                        memory[destoffset + i] = 0
-                stack = stack[3:]
-            case evm_codes.GASPRICE:
-                stack = [int(tx['gasprice'], 16)] + stack
-            case evm_codes.EXTCODESIZE:
-                addr = hex(stack[0])
-                if len(addr) < 42:
-                    addr = '0x' + '0'*(42 - len(addr)) + addr[2:]
-                if state is None or addr not in state or 'code' not in state[addr]:
-                    stack[0] = 0
-                else:
-                    stack[0] = len(state[addr]['code']['bin']) / 2
-            case evm_codes.EXTCODECOPY:
-                addr, destoffset, offset, size = hex(stack[0]), stack[1], stack[2], stack[3]
-                if len(addr) < 42:
-                    addr = '0x' + '0'*(42 - len(addr)) + addr[2:]
-                if state is None or addr not in state or 'code' not in state[addr]:
-                    extcode = b''
-                else:
-                    extcode = bytes.fromhex(state[addr]['code']['bin'])
-                if len(memory) < destoffset + size:
-                    memory += ([0] * (destoffset + size - len (memory)))
-                data = extcode
-                for i in range(size):
-                    if (offset + i) <= len(data):
-                        memory[destoffset + i] = int.from_bytes(data[(offset + i): (offset + i + 1)], byteorder="big")
-                    else:
-                        memory[destoffset + i] = 0
-                stack = stack[4:]
-            case evm_codes.RETURNDATASIZE:
-                a = len(lastRet)/2 if lastRet else 0
-                stack = [a] + stack
-            case evm_codes.RETURNDATACOPY:
-                destOffset, offset, size = stack[0], stack[1], stack[2]
-                stack = stack[3:]
-                data = lastRet[offset * 2: (offset + size) * 2]
-                mstore(memory, int(data, 16), destOffset, size)
-            case evm_codes.EXTCODEHASH:
-                addr = hex(stack[0])
-                if len(addr) < 42:
-                    addr = '0x' + '0'*(42 - len(addr)) + addr[2:]
-                if state is None or addr not in state:
-                    a = 0
-                elif 'code' not in state[addr]:
-                    a = int.from_bytes(keccak(b''), byteorder='big')
-                else:
-                    extcode = bytes.fromhex(state[addr]['code']['bin'])
-                    a = int.from_bytes(keccak(extcode), byteorder='big')
-                stack[0] = a
-            case evm_codes.BLOCKHASH:
-                stack = [0] + stack[1:]
-            case evm_codes.COINBASE:
-                stack = [int(block['coinbase'], 16)] + stack
-            case evm_codes.TIMESTAMP:
-                stack = [int(block['timestamp'], 16)] + stack
-            case evm_codes.NUMBER:
-                stack = [int(block['number'], 16)] + stack
-            case evm_codes.DIFFICULTY:
-                stack = [int(block['difficulty'], 16)] + stack
-            case evm_codes.GASLIMIT:
-                stack = [int(block['gaslimit'], 16)] + stack
-            case evm_codes.CHAINID:
-                stack = [int(block['chainid'], 16)] + stack
-            case evm_codes.SELFBALANCE:
-                addr = tx["to"]
-                stack = [0] + stack
-                if state is None or addr not in state or 'balance' not in state[addr]:
-                    stack[0] = 0
-                else:
-                    stack[0] = int(state[addr]['balance'], 16)
-            case evm_codes.BASEFEE:
-                stack = [int(block['basefee'], 16)] + stack
-            case evm_codes.POP:
-                stack = stack[1:]
-            case evm_codes.MLOAD:
-                pos = stack[0]
-                stack[0] = mload(memory, pos, 32)
-            case evm_codes.MSTORE:
-                pos, val = stack[0], stack[1]
-                stack = stack[2:]
-                if len(memory) < pos + 32:
-                    memory += ([0] * (pos + 32 - len(memory)))
-                for i in range(32):
-                    memory[pos + 31 - i] = (val >> (i * 8)) & 0xFF
-            case evm_codes.MSTORE8:
-                pos, val = stack[0], stack[1] & 0xFF
-                stack = stack[2:]
-                if len(memory) <= pos:
-                    memory += ([0] * (pos + 1 - len(memory)))
-                memory[pos] = val
-            case evm_codes.SLOAD:
-                k = stack[0]
-                stack[0] = storage.get(k, 0)
-            case evm_codes.SSTORE:
-                k, v = stack[0], stack[1]
-                storage[k] = v
-                stack = stack[2:]
-            case evm_codes.JUMP:
-                pc = stack[0]
-                stack = stack[1:]
-                if code[pc] != evm_codes.JUMPDEST or invalid_position(code, pc):
-                    success = False
+def address_hex(addr):
+    return '0x%040x' % addr
+
+MAX_UINT256 = evm_word.MASK
+# calls nested deeper than this fail
+MAX_DEPTH = 1024
+
+class Frame:
+    # everything one execution of evm() needs, handed to every opcode handler
+    __slots__ = ('code', 'ip', 'program', 'table', 'blocks', 'targets', 'pcs', 'tables', 'stack', 'memory',
+                 'tx', 'block', 'calldata', 'address', 'storage', 'static', 'gas', 'logs', 'log_mark', 'ret',
+                 'success', 'last_ret', 'depth', 'snapshot', 'callee', 'resume', 'ret_offset', 'ret_size',
+                 'create_key', 'sstore_gas', 'context', 'state')
+
+    def __init__(self, context, code, program, tables, tx, block, calldata, address, static, gas, depth=0,
+                 logs=None):
+        # the EVM this frame runs in, and its world state
+        self.context = context
+        self.state = state = context.state
+        self.code = code
+        # index of the next instruction in the decoded program, not a byte
+        # offset; in a compiled frame the index of the next block
+        self.ip = 0
+        self.program = program
+        self.table = tables[0] if gas is None else tables[1]
+        # block functions when the code runs compiled (see evm_compile)
+        self.blocks = None
+        self.targets = program.targets
+        # byte offset of each instruction, for tracers and error reports
+        self.pcs = program.pcs
+        # (unmetered, metered) dispatch tables, inherited by sub-calls
+        self.tables = tables
+        self.stack = UncheckedStack()
+        # gas left, or None when running unmetered
+        self.gas = gas
+        self.memory = Memory() if gas is None else MeteredMemory(self.charge)
+        self.tx = tx
+        self.block = block
+        # bytes or a memoryview into the caller's memory, never hex
+        self.calldata = calldata
+        # account whose storage and balance this code acts on
+        self.address = address
+        self.storage = state.storage_of(address)
+        # set inside STATICCALL, state changes fail the frame
+        self.static = static
+        # Logs of the whole run, shared with sub-calls; this frame's start
+        # at log_mark, dropped again if it fails
+        self.logs = logs if logs is not None else []
+        self.log_mark = len(self.logs)
+        # memoryview of what RETURN/REVERT handed back, None if neither ran
+        self.ret = None
+        self.success = True
+        self.last_ret = b''
+        # number of calls between this frame and the top-level one
+        self.depth = depth
+        # what state reverts to if the frame fails
+        self.snapshot = state.snapshot()
+        # a sub-call set up by CALL/CREATE, run as soon as this frame halts
+        self.callee = None
+        # for sub-calls, resume(caller, frame) hands results to the caller
+        self.resume = None
+        # where the caller wants RETURNDATA copied
+        self.ret_offset = 0
+        self.ret_size = 0
+        # for constructors create_cache can replay, (key, gas given) and the
+        # least gas any SSTORE ran with (None before the first one)
+        self.create_key = None
+        self.sstore_gas = None
+
+    @property
+    def log(self):
+        # this frame's logs, and those of sub-calls that succeeded, in the
+        # evm.json shape
+        return [log.to_json() for log in self.logs[self.log_mark:]]
+
+    @property
+    def bloom(self):
+        bloom = LogsBloom()
+        for log in self.logs[self.log_mark:]:
+            bloom.add(log)
+        return bloom
+
+    def charge(self, cost):
+        self.gas -= cost
+        if self.gas < 0:
+            raise OutOfGas()
+
+def fail(frame):
+    # exceptional halt: unlike REVERT, all remaining gas is consumed
+    frame.success = False
+    if frame.gas is not None:
+        frame.gas = 0
+    return True
+
+# opcode handlers: each takes the frame and the operand decoded for the
+# instruction, and returns True to halt execution
+
+def op_stop(frame, arg):
+    return True
+
+def op_invalid(frame, arg):
+    return fail(frame)
+
+def op_add(frame, arg):
+    a, b = frame.stack.popn(2)
+    frame.stack.push((a + b) & MASK)
+
+def op_mul(frame, arg):
+    a, b = frame.stack.popn(2)
+    frame.stack.push((a * b) & MASK)
+
+def op_sub(frame, arg):
+    a, b = frame.stack.popn(2)
+    frame.stack.push((a - b) & MASK)
+
+def op_div(frame, arg):
+    a, b = frame.stack.popn(2)
+    frame.stack.push(a // b if b else 0)
+
+def op_sdiv(frame, arg):
+    a, b = frame.stack.popn(2)
+    frame.stack.push(evm_word.sdiv(a, b))
+
+def op_mod(frame, arg):
+    a, b = frame.stack.popn(2)
+    frame.stack.push(a % b if b else 0)
+
+def op_smod(frame, arg):
+    a, b = frame.stack.popn(2)
+    frame.stack.push(evm_word.smod(a, b))
+
+def op_addmod(frame, arg):
+    a, b, n = frame.stack.popn(3)
+    frame.stack.push((a + b) % n if n else 0)
+
+def op_mulmod(frame, arg):
+    a, b, n = frame.stack.popn(3)
+    frame.stack.push((a * b) % n if n else 0)
+
+def op_exp(frame, arg):
+    a, b = frame.stack.popn(2)
+    frame.stack.push(pow(a, b, evm_word.MOD))
+
+def op_signextend(frame, arg):
+    b, x = frame.stack.popn(2)
+    frame.stack.push(evm_word.signextend(b, x))
+
+def op_lt(frame, arg):
+    a, b = frame.stack.popn(2)
+    frame.stack.push(int(a < b))
+
+def op_gt(frame, arg):
+    a, b = frame.stack.popn(2)
+    frame.stack.push(int(a > b))
+
+def op_slt(frame, arg):
+    a, b = frame.stack.popn(2)
+    frame.stack.push(evm_word.slt(a, b))
+
+def op_sgt(frame, arg):
+    a, b = frame.stack.popn(2)
+    frame.stack.push(evm_word.sgt(a, b))
+
+def op_eq(frame, arg):
+    a, b = frame.stack.popn(2)
+    frame.stack.push(int(a == b))
+
+def op_iszero(frame, arg):
+    frame.stack.set_top(int(frame.stack.peek() == 0))
+
+def op_and(frame, arg):
+    a, b = frame.stack.popn(2)
+    frame.stack.push(a & b)
+
+def op_or(frame, arg):
+    a, b = frame.stack.popn(2)
+    frame.stack.push(a | b)
+
+def op_xor(frame, arg):
+    a, b = frame.stack.popn(2)
+    frame.stack.push(a ^ b)
+
+def op_not(frame, arg):
+    frame.stack.set_top(frame.stack.peek() ^ MASK)
+
+def op_byte(frame, arg):
+    i, x = frame.stack.popn(2)
+    frame.stack.push(evm_word.byte(i, x))
+
+def op_shl(frame, arg):
+    shift, x = frame.stack.popn(2)
+    frame.stack.push(evm_word.shl(shift, x))
+
+def op_shr(frame, arg):
+    shift, x = frame.stack.popn(2)
+    frame.stack.push(evm_word.shr(shift, x))
+
+def op_sar(frame, arg):
+    shift, x = frame.stack.popn(2)
+    frame.stack.push(evm_word.sar(shift, x))
+
+def op_sha3(frame, arg):
+    offset, size = frame.stack.popn(2)
+    frame.stack.push(keccak_memo.word(frame.memory.read(offset, size)))
+
+def op_address(frame, arg):
+    frame.stack.push(int(frame.tx['to'], 16))
+
+def op_balance(frame, arg):
+    frame.stack.set_top(frame.state.get_balance(frame.stack.peek()))
+
+def op_origin(frame, arg):
+    frame.stack.push(int(frame.tx['origin'], 16))
+
+def op_caller(frame, arg):
+    frame.stack.push(int(frame.tx['from'], 16))
+
+def op_callvalue(frame, arg):
+    frame.stack.push(int(frame.tx['value'], 16))
+
+def op_calldataload(frame, arg):
+    pos = frame.stack.peek()
+    data = frame.calldata[pos:pos + 32]
+    # reads past the end of calldata are zero-padded
+    frame.stack.set_top(int.from_bytes(data, byteorder='big') << (8 * (32 - len(data))))
+
+def op_calldatasize(frame, arg):
+    frame.stack.push(len(frame.calldata))
+
+def op_calldatacopy(frame, arg):
+    destoffset, offset, size = frame.stack.popn(3)
+    frame.memory.write_padded(destoffset, frame.calldata[offset:offset + size], size)
+
+def op_codesize(frame, arg):
+    frame.stack.push(len(frame.code))
+
+def op_codecopy(frame, arg):
+    destoffset, offset, size = frame.stack.popn(3)
+    frame.memory.write_padded(destoffset, frame.code[offset:offset + size], size)
+
+def op_gasprice(frame, arg):
+    frame.stack.push(int(frame.tx['gasprice'], 16))
+
+def op_extcodesize(frame, arg):
+    frame.stack.set_top(len(frame.state.get_code(frame.stack.peek())))
+
+def op_extcodecopy(frame, arg):
+    addr, destoffset, offset, size = frame.stack.popn(4)
+    extcode = frame.state.get_code(addr)
+    frame.memory.write_padded(destoffset, extcode[offset:offset + size], size)
+
+def op_returndatasize(frame, arg):
+    frame.stack.push(len(frame.last_ret))
+
+def op_returndatacopy(frame, arg):
+    destOffset, offset, size = frame.stack.popn(3)
+    frame.memory.write_padded(destOffset, frame.last_ret[offset:offset + size], size)
+
+def op_extcodehash(frame, arg):
+    addr = frame.stack.peek()
+    if not frame.state.exists(addr):
+        frame.stack.set_top(0)
+    else:
+        frame.stack.set_top(int.from_bytes(code_cache.get(frame.state.get_code(addr)).hash, byteorder='big'))
+
+def op_blockhash(frame, arg):
+    frame.stack.set_top(0)
+
+def op_coinbase(frame, arg):
+    frame.stack.push(int(frame.block['coinbase'], 16))
+
+def op_timestamp(frame, arg):
+    frame.stack.push(int(frame.block['timestamp'], 16))
+
+def op_number(frame, arg):
+    frame.stack.push(int(frame.block['number'], 16))
+
+def op_difficulty(frame, arg):
+    frame.stack.push(int(frame.block['difficulty'], 16))
+
+def op_gaslimit(frame, arg):
+    frame.stack.push(int(frame.block['gaslimit'], 16))
+
+def op_chainid(frame, arg):
+    frame.stack.push(int(frame.block['chainid'], 16))
+
+def op_selfbalance(frame, arg):
+    frame.stack.push(frame.state.get_balance(frame.address))
+
+def op_basefee(frame, arg):
+    frame.stack.push(int(frame.block['basefee'], 16))
+
+def op_pop(frame, arg):
+    frame.stack.pop()
+
+def op_mload(frame, arg):
+    frame.stack.set_top(frame.memory.read_word(frame.stack.peek()))
+
+def op_mstore(frame, arg):
+    pos, val = frame.stack.popn(2)
+    frame.memory.write_word(pos, val)
+
+def op_mstore8(frame, arg):
+    pos, val = frame.stack.popn(2)
+    frame.memory.write_byte(pos, val)
+
+def op_sload(frame, arg):
+    frame.stack.set_top(frame.storage.get(frame.stack.peek(), 0))
+
+def op_sstore(frame, arg):
+    k, v = frame.stack.popn(2)
+    if frame.static:
+        return fail(frame)
+    frame.state.set_storage(frame.address, k, v)
+
+def op_jump(frame, arg):
+    ip = frame.targets.get(frame.stack.pop())
+    if ip is None:
+        return fail(frame)
+    frame.ip = ip
+
+def op_jumpi(frame, arg):
+    dest, cond = frame.stack.popn(2)
+    if cond != 0:
+        ip = frame.targets.get(dest)
+        if ip is None:
+            return fail(frame)
+        frame.ip = ip
+
+def op_pc(frame, arg):
+    # arg is the byte offset of this instruction in the original code
+    frame.stack.push(arg)
+
+def op_msize(frame, arg):
+    frame.stack.push(len(frame.memory))
+
+def op_gas(frame, arg):
+    # GAS ends a basic block, so every static cost up to here has been charged
+    frame.stack.push(frame.gas if frame.gas is not None else MAX_UINT256)
+
+def op_jumpdest(frame, arg):
+    pass
+
+def op_push(frame, arg):
+    frame.stack.push(arg)
+
+def op_dup(frame, arg):
+    frame.stack.dup(arg)
+
+def op_swap(frame, arg):
+    frame.stack.swap(arg)
+
+def op_log(frame, arg):
+    vals = frame.stack.popn(2 + arg)
+    if frame.static:
+        return fail(frame)
+    data = bytes(frame.memory.read(vals[0], vals[1]))
+    frame.logs.append(Log(frame.address, tuple(vals[2:]), data))
+
+def create_address(sender, nonce):
+    # CREATE: the last 20 bytes of keccak(rlp([sender, nonce]))
+    if nonce == 0:
+        encoded = b'\x80'
+    elif nonce < 0x80:
+        encoded = bytes((nonce,))
+    else:
+        data = nonce.to_bytes((nonce.bit_length() + 7) // 8, byteorder='big')
+        encoded = bytes((0x80 + len(data),)) + data
+    payload = b'\x94' + sender.to_bytes(20, byteorder='big') + encoded
+    return int.from_bytes(keccak256(bytes((0xc0 + len(payload),)) + payload)[12:], byteorder='big')
+
+def create2_address(sender, salt, initcode_hash):
+    # CREATE2, EIP-1014
+    data = b'\xff' + sender.to_bytes(20, byteorder='big') + salt.to_bytes(32, byteorder='big') + initcode_hash
+    return int.from_bytes(keccak256(data)[12:], byteorder='big')
+
+def op_create(frame, arg):
+    value, offset, size = frame.stack.popn(3)
+    if frame.static:
+        return fail(frame)
+    initcode = bytes(frame.memory.read(offset, size))
+    addr = create_address(frame.address, frame.state.get_nonce(frame.address))
+    return create_into(frame, value, initcode, addr)
+
+def op_create2(frame, arg):
+    value, offset, size, salt = frame.stack.popn(4)
+    if frame.static:
+        return fail(frame)
+    initcode = bytes(frame.memory.read(offset, size))
+    addr = create2_address(frame.address, salt, keccak256(initcode))
+    return create_into(frame, value, initcode, addr)
+
+def create_into(frame, value, initcode, addr):
+    # sets initcode up as a sub-call deploying to addr, run once frame
+    # halts; resume_create deploys what it returns. A constructor already
+    # seen with the same inputs is not run again: create_cache has its
+    # effects, and they are applied here.
+    if frame.depth >= MAX_DEPTH:
+        frame.last_ret = b''
+        frame.stack.push(0)
+        return
+    state = frame.state
+    state.set_nonce(frame.address, state.get_nonce(frame.address) + 1)
+    state.access_address(addr)
+    frame.last_ret = b''
+    child_gas = None
+    if frame.gas is not None:
+        child_gas = evm_gas.all_but_one_64th(frame.gas)
+        frame.gas -= child_gas
+    if state.get_nonce(addr) or state.get_code(addr) or state.storage_view(addr):
+        # address collision: fails with the constructor's gas used up
+        frame.stack.push(0)
+        return
+    # the new account is credited value inside the snapshot, so a failed
+    # constructor takes it back; as with CALL the sender is not debited
+    snapshot = state.snapshot()
+    state.create_account(addr, state.get_balance(addr) + value, nonce=1)
+    if not any(initcode):
+        deploy(frame, addr, True, None, child_gas, snapshot, len(frame.logs))
+        return
+    tx = frame.tx
+    new_tx = {
+        "to": address_hex(addr),
+        "value": hex(value),
+        "origin": tx.get("origin") if tx else None,
+        "from": tx.get("to") if tx else None
+    }
+    entry = code_cache.get(initcode)
+    key = None
+    if frame.tables is TABLES:
+        key = create_key(entry, new_tx, frame.block, child_gas is not None)
+    if key is not None:
+        result = create_cache.get(key)
+        if result is not None and (child_gas is None or result.min_gas <= child_gas):
+            log_mark = len(frame.logs)
+            for slot, val in result.storage:
+                state.set_storage(addr, slot, val)
+            for slot in result.warm:
+                state.access_slot(addr, slot)
+            frame.logs.extend(Log(addr, topics, data) for topics, data in result.logs)
+            if child_gas is not None:
+                child_gas -= result.gas_used
+            deploy(frame, addr, True, result.code, child_gas, snapshot, log_mark)
+            return
+    child = new_frame(frame.context, entry, new_tx, frame.block, b'', addr, False, child_gas,
+                      frame.tables, frame.depth + 1, frame.logs)
+    # a failed constructor also undoes the account it was creating
+    child.snapshot = snapshot
+    child.resume = resume_create
+    if key is not None:
+        child.create_key = (key, child_gas)
+    frame.callee = child
+    return True
+
+def create_key(entry, tx, block, metered):
+    # create_cache key for running entry as initcode, None if its result
+    # can depend on more than the key says
+    inputs = entry.constructor_inputs
+    if inputs is False:
+        inputs = entry.constructor_inputs = evm_analysis.constructor_inputs(entry.cfg, entry.code)
+    if inputs is None:
+        return None
+    block = block or {}
+    return entry.hash, metered, tuple((tx if from_tx else block).get(name) for from_tx, name in inputs)
+
+def resume_create(frame, child):
+    ret = bytes(child.ret) if child.ret is not None else None
+    if child.success and child.create_key is not None:
+        key, start_gas = child.create_key
+        state = frame.state
+        addr = child.address
+        warm = tuple(state.accessed_since(child.snapshot, addr))
+        logs = tuple((log.topics, log.data) for log in frame.logs[child.log_mark:])
+        gas_used = min_gas = None
+        if start_gas is not None:
+            gas_used = min_gas = start_gas - child.gas
+            if child.sstore_gas is not None:
+                # SSTORE fails with the stipend or less left, not only when
+                # it runs out: less gas than this and the live run fails
+                min_gas = max(min_gas, start_gas - child.sstore_gas + evm_gas.G_CALL_STIPEND + 1)
+        storage = tuple(state.written_since(child.snapshot, addr))
+        create_cache.put(key, CreateResult(ret, storage, warm, logs, gas_used, min_gas))
+    deploy(frame, child.address, child.success, ret, child.gas, child.snapshot, child.log_mark)
+
+def deploy(frame, addr, success, ret, gas, snapshot, log_mark):
+    # finishes a CREATE whose constructor returned ret with gas left over;
+    # code deposit is paid out of that gas
+    if success and ret and gas is not None:
+        gas -= evm_gas.G_CODE_DEPOSIT * len(ret)
+        if gas < 0:
+            success = False
+            gas = 0
+            frame.state.revert(snapshot)
+            del frame.logs[log_mark:]
+            ret = None
+    if gas is not None:
+        frame.gas += gas
+    if not success:
+        # a reverting constructor's data is the return data
+        frame.last_ret = ret if ret is not None else b''
+        frame.stack.push(0)
+        return
+    frame.last_ret = b''
+    if ret:
+        frame.state.set_code(addr, ret)
+    frame.stack.push(addr)
+
+def call_into(frame, gas, address, storage_address, tx, value, static, argsOffset, argsSize, retOffset, retSize):
+    # sets address's code up as a sub-call, run once frame halts; its
+    # results come back through resume_call. Precompiles run on the spot
+    # instead. calldata is a view of our
+    # memory, released before our memory can grow, so the return area is
+    # expanded (and paid for) first.
+    frame.memory.expand(retOffset, retSize)
+    if frame.depth >= MAX_DEPTH:
+        frame.last_ret = b''
+        frame.stack.push(0)
+        return
+    args = frame.memory.read(argsOffset, argsSize)
+    child_gas = None
+    if frame.gas is not None:
+        child_gas = min(gas, evm_gas.all_but_one_64th(frame.gas))
+        frame.gas -= child_gas
+        if value:
+            child_gas += evm_gas.G_CALL_STIPEND
+    precompile = PRECOMPILES.get(address)
+    if precompile is not None:
+        # runs right here, no frame: the output is the return data as is and
+        # the return area is written from a view of it
+        success, ret, left = evm_precompiles.call(precompile, args, child_gas)
+        args.release()
+        if left is not None:
+            frame.gas += left
+        frame.last_ret = ret
+        frame.memory.write(retOffset, memoryview(ret)[:retSize])
+        frame.stack.push(int(success))
+        return
+    child = new_frame(frame.context, code_cache.get(frame.state.get_code(address)), tx, frame.block, args,
+                      storage_address, static, child_gas, frame.tables, frame.depth + 1, frame.logs)
+    child.resume = resume_call
+    child.ret_offset = retOffset
+    child.ret_size = retSize
+    frame.callee = child
+    return True
+
+def resume_call(frame, child):
+    child.calldata.release()
+    if child.gas is not None:
+        frame.gas += child.gas
+    ret = child.ret if child.ret is not None else b''
+    frame.last_ret = ret
+    frame.memory.write(child.ret_offset, ret[:child.ret_size])
+    frame.stack.push(int(child.success))
+
+def op_call(frame, arg):
+    gas, address, value, argsOffset, argsSize, retOffset, retSize = frame.stack.popn(7)
+    if frame.static and value:
+        return fail(frame)
+    tx = frame.tx
+    new_tx = {
+        "to": address_hex(address),
+        "value": hex(value),
+        "origin": tx.get("origin") if tx else None,
+        "from": tx.get("to") if tx else None
+    }
+    return call_into(frame, gas, address, address, new_tx, value, frame.static, argsOffset, argsSize, retOffset, retSize)
+
+def op_return(frame, arg):
+    offset, size = frame.stack.popn(2)
+    frame.ret = frame.memory.read(offset, size)
+    return True
+
+def op_delegatecall(frame, arg):
+    gas, address, argsOffset, argsSize, retOffset, retSize = frame.stack.popn(6)
+    return call_into(frame, gas, address, frame.address, frame.tx, 0, frame.static, argsOffset, argsSize, retOffset, retSize)
+
+def op_staticcall(frame, arg):
+    gas, address, argsOffset, argsSize, retOffset, retSize = frame.stack.popn(6)
+    tx = frame.tx
+    new_tx = {
+        "to": address_hex(address),
+        "origin": tx.get("origin") if tx else None,
+        "from": tx.get("to") if tx else None
+    }
+    return call_into(frame, gas, address, address, new_tx, 0, True, argsOffset, argsSize, retOffset, retSize)
+
+def op_revert(frame, arg):
+    offset, size = frame.stack.popn(2)
+    frame.ret = frame.memory.read(offset, size)
+    frame.success = False
+    return True
+
+def op_selfdestruct(frame, arg):
+    addr = frame.stack.pop()
+    if frame.static:
+        return fail(frame)
+    state = frame.state
+    me = frame.address
+    balance = state.get_balance(me)
+    state.set_code(me, b'')
+    state.set_balance(me, 0)
+    state.set_balance(addr, state.get_balance(addr) + balance)
+
+# superinstructions: the decoder fuses the pair into the first slot, these
+# run both halves and step over the second slot
+
+def op_push_jump(frame, arg):
+    frame.ip = arg
+
+def op_push_jumpi(frame, arg):
+    if frame.stack.pop() != 0:
+        frame.ip = arg
+    else:
+        frame.ip += 1
+
+def op_push_mstore(frame, arg):
+    frame.memory.write_word(arg, frame.stack.pop())
+    frame.ip += 1
+
+def op_dup_swap(frame, arg):
+    frame.stack.dup(arg[0])
+    frame.stack.swap(arg[1])
+    frame.ip += 1
+
+def op_charge(frame, arg):
+    # opens each basic block of a metered program: arg is the block's static cost
+    frame.gas -= arg
+    if frame.gas < 0:
+        raise OutOfGas()
+
+def op_check(frame, arg):
+    # opens each basic block whose stack bounds the analysis could not prove
+    height = len(frame.stack.items)
+    if height < arg[0] or height > arg[1]:
+        return fail(frame)
+
+def build_table():
+    # indexed by opcode byte, plus the superinstructions, CHARGE and CHECK
+    # after the first 256; anything not listed in evm_codes (and INVALID itself) fails
+    # the execution
+    table = [op_invalid] * (evm_analysis.CHECK + 1)
+    handlers = {
+        evm_codes.STOP: op_stop,
+        evm_codes.ADD: op_add,
+        evm_codes.MUL: op_mul,
+        evm_codes.SUB: op_sub,
+        evm_codes.DIV: op_div,
+        evm_codes.SDIV: op_sdiv,
+        evm_codes.MOD: op_mod,
+        evm_codes.SMOD: op_smod,
+        evm_codes.ADDMOD: op_addmod,
+        evm_codes.MULMOD: op_mulmod,
+        evm_codes.EXP: op_exp,
+        evm_codes.SIGNEXTEND: op_signextend,
+        evm_codes.LT: op_lt,
+        evm_codes.GT: op_gt,
+        evm_codes.SLT: op_slt,
+        evm_codes.SGT: op_sgt,
+        evm_codes.EQ: op_eq,
+        evm_codes.ISZERO: op_iszero,
+        evm_codes.AND: op_and,
+        evm_codes.OR: op_or,
+        evm_codes.XOR: op_xor,
+        evm_codes.NOT: op_not,
+        evm_codes.BYTE: op_byte,
+        evm_codes.SHL: op_shl,
+        evm_codes.SHR: op_shr,
+        evm_codes.SAR: op_sar,
+        evm_codes.SHA3: op_sha3,
+        evm_codes.ADDRESS: op_address,
+        evm_codes.BALANCE: op_balance,
+        evm_codes.ORIGIN: op_origin,
+        evm_codes.CALLER: op_caller,
+        evm_codes.CALLVALUE: op_callvalue,
+        evm_codes.CALLDATALOAD: op_calldataload,
+        evm_codes.CALLDATASIZE: op_calldatasize,
+        evm_codes.CALLDATACOPY: op_calldatacopy,
+        evm_codes.CODESIZE: op_codesize,
+        evm_codes.CODECOPY: op_codecopy,
+        evm_codes.GASPRICE: op_gasprice,
+        evm_codes.EXTCODESIZE: op_extcodesize,
+        evm_codes.EXTCODECOPY: op_extcodecopy,
+        evm_codes.RETURNDATASIZE: op_returndatasize,
+        evm_codes.RETURNDATACOPY: op_returndatacopy,
+        evm_codes.EXTCODEHASH: op_extcodehash,
+        evm_codes.BLOCKHASH: op_blockhash,
+        evm_codes.COINBASE: op_coinbase,
+        evm_codes.TIMESTAMP: op_timestamp,
+        evm_codes.NUMBER: op_number,
+        evm_codes.DIFFICULTY: op_difficulty,
+        evm_codes.GASLIMIT: op_gaslimit,
+        evm_codes.CHAINID: op_chainid,
+        evm_codes.SELFBALANCE: op_selfbalance,
+        evm_codes.BASEFEE: op_basefee,
+        evm_codes.POP: op_pop,
+        evm_codes.MLOAD: op_mload,
+        evm_codes.MSTORE: op_mstore,
+        evm_codes.MSTORE8: op_mstore8,
+        evm_codes.SLOAD: op_sload,
+        evm_codes.SSTORE: op_sstore,
+        evm_codes.JUMP: op_jump,
+        evm_codes.JUMPI: op_jumpi,
+        evm_codes.PC: op_pc,
+        evm_codes.MSIZE: op_msize,
+        evm_codes.GAS: op_gas,
+        evm_codes.JUMPDEST: op_jumpdest,
+        evm_codes.PUSH0: op_push,
+        evm_codes.CREATE: op_create,
+        evm_codes.CREATE2: op_create2,
+        evm_codes.CALL: op_call,
+        evm_codes.RETURN: op_return,
+        evm_codes.DELEGATECALL: op_delegatecall,
+        evm_codes.STATICCALL: op_staticcall,
+        evm_codes.REVERT: op_revert,
+        evm_codes.INVALID: op_invalid,
+        evm_codes.SELFDESTRUCT: op_selfdestruct,
+        evm_analysis.PUSH_JUMP: op_push_jump,
+        evm_analysis.PUSH_JUMPI: op_push_jumpi,
+        evm_analysis.PUSH_MSTORE: op_push_mstore,
+        evm_analysis.DUP_SWAP: op_dup_swap,
+        evm_analysis.CHARGE: op_charge,
+        evm_analysis.CHECK: op_check,
+    }
+    for op, handler in handlers.items():
+        table[op] = handler
+    for op in range(evm_codes.PUSH1, evm_codes.PUSH32 + 1):
+        table[op] = op_push
+    for op in range(evm_codes.DUP1, evm_codes.DUP16 + 1):
+        table[op] = op_dup
+    for op in range(evm_codes.SWAP1, evm_codes.SWAP16 + 1):
+        table[op] = op_swap
+    for op in range(evm_codes.LOG0, evm_codes.LOG4 + 1):
+        table[op] = op_log
+    return table
+
+OPCODES = build_table()
+
+# dynamic gas: each function returns the operand-dependent part of an
+# opcode's cost, read off the stack before the handler runs. Static costs
+# are charged per basic block by CHARGE.
+
+def cold_account(frame, addr):
+    # precompiles are warm from the start of every transaction (EIP-2929)
+    if addr not in PRECOMPILES and frame.state.access_address(addr):
+        return evm_gas.G_COLD_ACCOUNT_ACCESS - evm_gas.G_WARM_ACCESS
+    return 0
+
+def gas_exp(frame):
+    exponent = frame.stack.peek(1)
+    return evm_gas.G_EXP_BYTE * ((exponent.bit_length() + 7) // 8)
+
+def gas_sha3(frame):
+    return evm_gas.G_KECCAK_WORD * evm_gas.words(frame.stack.peek(1))
+
+def gas_copy(frame):
+    return evm_gas.G_COPY * evm_gas.words(frame.stack.peek(2))
+
+def gas_account(frame):
+    return cold_account(frame, frame.stack.peek())
+
+def gas_extcodecopy(frame):
+    return cold_account(frame, frame.stack.peek()) + evm_gas.G_COPY * evm_gas.words(frame.stack.peek(3))
+
+def gas_sload(frame):
+    if frame.state.access_slot(frame.address, frame.stack.peek()):
+        return evm_gas.G_COLD_SLOAD - evm_gas.G_WARM_ACCESS
+    return 0
+
+def gas_sstore(frame):
+    # EIP-2200 with EIP-2929 pricing, refunds are not tracked
+    gas = frame.gas
+    if gas <= evm_gas.G_CALL_STIPEND:
+        raise OutOfGas()
+    if frame.create_key is not None and (frame.sstore_gas is None or gas < frame.sstore_gas):
+        # a replay must start with enough gas for this SSTORE to have run
+        frame.sstore_gas = gas
+    key, new = frame.stack.peek(), frame.stack.peek(1)
+    cost = 0
+    if frame.state.access_slot(frame.address, key):
+        cost += evm_gas.G_COLD_SLOAD
+    current = frame.storage.get(key, 0)
+    original = frame.state.original_storage(frame.address, key)
+    if new == current or current != original:
+        return cost + evm_gas.G_WARM_ACCESS
+    if original == 0:
+        return cost + evm_gas.G_SSET
+    return cost + evm_gas.G_SRESET
+
+def gas_log(frame):
+    return evm_gas.G_LOG_DATA * frame.stack.peek(1)
+
+def gas_create(frame):
+    return evm_gas.G_INITCODE_WORD * evm_gas.words(frame.stack.peek(2))
+
+def gas_create2(frame):
+    # initcode is hashed for the address as well
+    return (evm_gas.G_INITCODE_WORD + evm_gas.G_KECCAK_WORD) * evm_gas.words(frame.stack.peek(2))
+
+def gas_call(frame):
+    addr, value = frame.stack.peek(1), frame.stack.peek(2)
+    cost = cold_account(frame, addr)
+    if value:
+        cost += evm_gas.G_CALL_VALUE
+        if not frame.state.exists(addr):
+            cost += evm_gas.G_NEW_ACCOUNT
+    return cost
+
+def gas_delegatecall(frame):
+    return cold_account(frame, frame.stack.peek(1))
+
+def gas_selfdestruct(frame):
+    addr = frame.stack.peek()
+    cost = cold_account(frame, addr)
+    if frame.state.get_balance(frame.address) and not frame.state.exists(addr):
+        cost += evm_gas.G_NEW_ACCOUNT
+    return cost
+
+def metered(handler, cost):
+    def op(frame, arg):
+        frame.charge(cost(frame))
+        return handler(frame, arg)
+    return op
+
+def build_metered_table(table):
+    # the same handlers, with the dynamic-cost opcodes wrapped; memory
+    # expansion is charged by MeteredMemory itself
+    table = list(table)
+    dynamic = {
+        evm_codes.EXP: gas_exp,
+        evm_codes.SHA3: gas_sha3,
+        evm_codes.BALANCE: gas_account,
+        evm_codes.CALLDATACOPY: gas_copy,
+        evm_codes.CODECOPY: gas_copy,
+        evm_codes.EXTCODESIZE: gas_account,
+        evm_codes.EXTCODECOPY: gas_extcodecopy,
+        evm_codes.RETURNDATACOPY: gas_copy,
+        evm_codes.EXTCODEHASH: gas_account,
+        evm_codes.SLOAD: gas_sload,
+        evm_codes.SSTORE: gas_sstore,
+        evm_codes.CREATE: gas_create,
+        evm_codes.CREATE2: gas_create2,
+        evm_codes.CALL: gas_call,
+        evm_codes.DELEGATECALL: gas_delegatecall,
+        evm_codes.STATICCALL: gas_delegatecall,
+        evm_codes.SELFDESTRUCT: gas_selfdestruct,
+    }
+    for op in range(evm_codes.LOG0, evm_codes.LOG4 + 1):
+        dynamic[op] = gas_log
+    for op, cost in dynamic.items():
+        table[op] = metered(table[op], cost)
+    return table
+
+METERED_OPCODES = build_metered_table(OPCODES)
+
+TABLES = (OPCODES, METERED_OPCODES)
+
+class EVM:
+    # one execution context: the world state its frames read and write, and
+    # when code gets compiled. Contexts share nothing mutable but the code
+    # cache, so independent ones can run on different threads.
+    __slots__ = ('state', 'compile_after', 'sink')
+
+    def __init__(self, state=None, compile_after=None, sink=None):
+        self.state = state if state is not None else WorldState()
+        # executions after which a piece of code runs compiled (see
+        # evm_compile), None keeps everything in the interpreter
+        self.compile_after = compile_after
+        # an evm_logs.LogSink for the logs of every transaction that succeeds
+        self.sink = sink
+
+    def fork(self):
+        # a context over a copy-on-write fork of this one's state, for
+        # what-if calls that must leave it untouched
+        return EVM(self.state.fork(), self.compile_after, self.sink)
+
+    def evm(self, code, tx, block, storage, gas=None):
+        # gas=None runs unmetered (trusted simulations): nothing is charged
+        # and GAS reports MAX_UINT256
+        frame = self.run(code, tx, block, storage, gas)
+        ret = frame.ret.hex() if frame.ret is not None else None
+        return (frame.success, frame.stack.to_list(), frame.log, ret, frame.storage)
+
+    def run(self, code, tx, block, storage, gas=None, tables=TABLES):
+        # like evm() but returns the finished top-level Frame, which also
+        # carries the gas left. tables swaps in other (unmetered, metered)
+        # dispatch tables, e.g. instrumented ones.
+        state = self.state
+        address = int(tx['to'], 16) if tx and 'to' in tx else 0
+        if storage is not None:
+            state.storage[address] = storage
+        if gas is not None:
+            state.access_address(address)
+            if tx and 'from' in tx:
+                state.access_address(int(tx['from'], 16))
+        # hex only at this boundary, frames pass bytes around
+        calldata = bytes.fromhex(tx['data']) if tx and 'data' in tx else b''
+        frame = drive(new_frame(self, code_cache.get(code), tx, block, calldata, address, False, gas, tables))
+        state.commit()
+        if self.sink is not None:
+            for log in frame.logs:
+                self.sink.emit(log)
+        return frame
+
+# the module-level API runs in a context over the module globals state and
+# compile_after
+
+def evm(code, tx, block, storage, gas=None):
+    return EVM(state, compile_after).evm(code, tx, block, storage, gas)
+
+def run(code, tx, block, storage, gas=None, tables=TABLES):
+    return EVM(state, compile_after).run(code, tx, block, storage, gas, tables)
+
+def new_frame(context, entry, tx, block, calldata, address, static, gas, tables, depth=0, logs=None):
+    program = entry.program if gas is None else code_cache.metered_program(entry)
+    frame = Frame(context, entry.code, program, tables, tx, block, calldata, address, static, gas, depth, logs)
+    if context.compile_after is not None and tables is TABLES:
+        frame.blocks = evm_compile.promote(entry, gas is not None, tables, context.compile_after)
+    return frame
+
+def drive(frame):
+    # calls never recurse: a CALL/CREATE handler leaves the callee in
+    # frame.callee and halts, the caller waits on callers until the callee
+    # finishes, then its resume function hands the results back and the
+    # caller carries on from frame.ip. A failed frame unwinds every state
+    # change it made.
+    callers = []
+    while True:
+        run_frame(frame)
+        callee = frame.callee
+        if callee is not None:
+            frame.callee = None
+            callers.append(frame)
+            frame = callee
+            continue
+        if not frame.success:
+            frame.state.revert(frame.snapshot)
+            del frame.logs[frame.log_mark:]
+        if not callers:
+            return frame
+        caller = callers.pop()
+        frame.resume(caller, frame)
+        frame = caller
+
+def run_frame(frame):
+    # runs frame from frame.ip until it halts or sets up a sub-call
+    try:
+        blocks = frame.blocks
+        if blocks is not None:
+            b = frame.ip
+            while b is not None:
+                b = blocks[b](frame)
+        else:
+            table = frame.table
+            ops = frame.program.ops
+            args = frame.program.args
+            n = len(ops)
+            while frame.ip < n:
+                i = frame.ip
+                frame.ip = i + 1
+                if table[ops[i]](frame, args[i]):
                     break
-            case evm_codes.JUMPI:
-                if stack[1] != 0:
-                    pc = stack[0]
-                    stack = stack[2:]
-                    if code[pc] != evm_codes.JUMPDEST or invalid_position(code, pc):
-                        success = False
-                        break
-                else:
-                    stack = stack[2:]
-            case evm_codes.PC:
-                stack = [pc - 1] + stack
-            case evm_codes.MSIZE:
-                stack = [(len(memory) // 32 + int(len(memory) % 32 > 0)) * 32] + stack
-            case evm_codes.GAS:
-                stack = [0xffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffff] + stack
-            case evm_codes.JUMPDEST:
-                continue
-            case evm_codes.PUSH0:
-                stack.append(0)
-            case x if x in range(evm_codes.PUSH1, evm_codes.PUSH32+1):
-                length = op - evm_codes.PUSH0
-                b = int(code[pc:pc + length].hex(), 16)
-                pc += length
-                stack = [b] + stack
-            case x if x in range(evm_codes.DUP1, evm_codes.DUP16+1):
-                stack = [stack[x - evm_codes.DUP1]] + stack
-            case x if x in range(evm_codes.SWAP1, evm_codes.SWAP16+1):
-                n = x - evm_codes.SWAP1 + 1
-                stack[0], stack[n] = stack[n], stack[0]
-            case x if x in range(evm_codes.LOG0, evm_codes.LOG4 + 1):
-                offset, size = stack[0], stack[1]
-                index = x - evm_codes.LOG0
-                topics = [hex(stack[2+i]) for i in range(index)]
-                stack = stack[2+index:]
-                data = ""
-                if len(memory) < pos + 32:
-                    memory += ([0] * (pos + 32 - len(memory)))
-                for i in range(size):
-                    data += hex(memory[offset + i])[2:]
-                log.append({
-                    "address": tx['to'],
-                    "data": data,
-                    "topics": topics
-                })
-            case evm_codes.CREATE:
-                value, offset, size = stack[0], stack[1], stack[2]
-                addr = "0x00000000000000000000000000000000deadbeef"
-                c = mload(memory, offset, size)
-                #print(c)
-                if c != 0:
-                    succ, _, llog, rr, _ = evm(bytes.fromhex(hex(c)[2:]), {}, block, dict())
-                    if not succ:
-                        stack = [0] + stack[3:]
-                    else:
-                        stack = [int(addr, 16)] + stack[3:]
-                        if state is None:
-                            state = {}
-                        state[addr] = {
-                            'balance': hex(value),
-                            'code': {
-                                'bin': rr
-                            }
-                        }
-                else:
-                    stack = [int(addr, 16)] + stack[3:]
-                    if state is None:
-                        state = {}
-                    state[addr] = {
-                        'balance': hex(value),
-                    }
-            case evm_codes.CALL:
-                gas, address, value, argsOffset, argsSize, retOffset, retSize = stack[0], stack[1], stack[2], stack[3], stack[4], stack[5], stack[6]
-                stack = stack[7:]
-                address = hex(address)
-                if len(address) < 22:
-                    address = '0x' + '0'*(22 - len(address)) + address[2:]
-                args = mload(memory, argsOffset, argsSize)
-                new_tx = {
-                    "to": address,
-                    "value": value,
-                    "origin": tx.get("origin") if tx else None,
-                    "from": tx.get("to") if tx else None
-                }
-                succ, _, llog, rr, _ = evm(bytes.fromhex(state[address]['code']['bin']), new_tx, block, dict())
-                if rr:
-                    rr = rr[:retSize * 2]
-                    memory = mstore(memory, int(rr, 16), retOffset, retSize)
-                lastRet = rr
-                log += llog
-                
-                stack = [int(succ)] + stack
-
-            case evm_codes.RETURN:
-                val = hex(mload(memory, stack[0], stack[1]))[2:]
-                ret = val.rjust(stack[1]*2, '0')
-                stack = stack[2:]
-                break
-            case evm_codes.DELEGATECALL:
-                gas, address, argsOffset, argsSize, retOffset, retSize = stack[0], stack[1], stack[2], stack[3], stack[4], stack[5]
-                stack = stack[6:]
-                address = hex(address)
-                if len(address) < 22:
-                    address = '0x' + '0'*(22 - len(address)) + address[2:]
-                args = mload(memory, argsOffset, argsSize)
-                succ, _, llog, rr, storage = evm(bytes.fromhex(state[address]['code']['bin']), tx, block, storage)
-                lastRet = rr
-                log += llog
-                if rr:
-                    rr = rr[:retSize * 2]
-                    memory = mstore(memory, int(rr, 16), retOffset, retSize)
-                
-                stack = [int(succ)] + stack
-            case evm_codes.STATICCALL:
-                gas, address, argsOffset, argsSize, retOffset, retSize = stack[0], stack[1], stack[2], stack[3], stack[4], stack[5]
-                stack = stack[6:]
-                address = hex(address)
-                if len(address) < 22:
-                    address = '0x' + '0'*(22 - len(address)) + address[2:]
-                args = mload(memory, argsOffset, argsSize)
-                new_tx = {
-                    "to": address,
-                    "origin": tx.get("origin") if tx else None,
-                    "from": tx.get("to") if tx else None
-                }
-                succ, _, llog, rr, ss = evm(bytes.fromhex(state[address]['code']['bin']), new_tx, block, dict())
-                if ss != {}:
-                    succ = False
-                lastRet = rr
-                log += llog
-                if rr:
-                    rr = rr[:retSize * 2]
-                    memory = mstore(memory, int(rr, 16), retOffset, retSize)
-                
-                stack = [int(succ)] + stack
-            case evm_codes.REVERT:
-                val = hex(mload(memory, stack[0], stack[1]))[2:]
-                ret = val.ljust(stack[1]*2, '0')
-                stack = stack[2:]
-                success = False
-                break
-            case evm_codes.SELFDESTRUCT:
-                addr = hex(stack[0])
-                if len(addr) < 42:
-                    addr = '0x' + '0'*(42 - len(addr)) + addr[2:]
-                stack = stack[1:]
-                del state[tx['to']]['code']
-                if addr not in state:
-                    state[addr] = {
-                        'balance': '0x0'
-                    }
-                balance = int(state[tx['to']]['balance'], 16)
-                state[tx['to']]['balance'] = '0x0'
-                state[addr]['balance'] = hex(int(state[addr]['balance'], 16) + balance)
-            case _:
-                success = False
-                break
-
-    return (success, stack, log, ret, storage)
+    except OutOfGas:
+        fail(frame)
 
 def test():
-    global state
-    script_dirname = os.path.dirname(os.path.abspath(__file__))
-    json_file = os.path.join(script_dirname, "..", "evm.json")
-    with open(json_file) as f:
-        data = json.load(f)
-        total = len(data)
-
-        for i, test in enumerate(data):
-            # Note: as the test cases get more complex, you'll need to modify this
-            # to pass down more arguments to the evm function
-            code = bytes.fromhex(test['code']['bin'])
-            tx = test.get('tx')
-            block = test.get('block')
-            state = test.get('state')
-            (success, stack, log, ret, _) = evm(code, tx, block, dict())
-
-            expected_stack = [int(x, 16) for x in test['expect'].get('stack', [])]
-            expected_log = test['expect'].get('logs', [])
-            expected_return = test['expect'].get("return", None)
-            
-            if stack != expected_stack or success != test['expect']['success'] or expected_log != log or expected_return != ret:
-                print(f"❌ Test #{i + 1}/{total} {test['name']}")
-                if stack != expected_stack:
-                    print("Stack doesn't match")
-                    print(" expected:", expected_stack)
-                    print("   actual:", stack)
-                elif expected_log != log:
-                    print("Log doesn't match")
-                    print(" expected:", expected_log)
-                    print("   actual:", log)
-                elif expected_return != ret:
-                    print("Return doesn't match")
-                    print(" expected:", expected_return)
-                    print("   actual:", ret)
-                else:
-                    print("Success doesn't match")
-                    print(" expected:", test['expect']['success'])
-                    print("   actual:", success)
-                print("")
-                print("Test code:")
-                print(test['code']['asm'])
-                print("")
-                print("Hint:", test['hint'])
-                print("")
-                print(f"Progress: {i}/{len(data)}")
-                print("")
-                break
-            else:
-                print(f"✓  Test #{i + 1}/{total} {test['name']}")
+    # runs ../evm.json in-process with the full console report, see
+    # evm_runner.py for parallel runs and JSON/JUnit output
+    # run as a script this module is __main__; evm_runner's import evm
+    # gets it too instead of loading and building everything a second time
+    sys.modules.setdefault('evm', sys.modules[__name__])
+    import evm_runner
+    return evm_runner.main(['--jobs', '1'])
 
 if __name__ == '__main__':
-    test()
+    sys.exit(test())
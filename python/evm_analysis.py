@@ -0,0 +1,345 @@
+import evm_codes
+from evm_stack import STACK_LIMIT
+
+# results are cached per code hash by evm_cache.CodeCache
+
+def jumpdests(code):
+    # one pass over the bytecode, skipping PUSH immediates, so a 0x5b inside
+    # push data is never a valid destination. valid[pc] is 1 for a JUMPDEST.
+    valid = bytearray(len(code))
+    pc = 0
+    while pc < len(code):
+        op = code[pc]
+        if op == evm_codes.JUMPDEST:
+            valid[pc] = 1
+        elif evm_codes.PUSH1 <= op <= evm_codes.PUSH32:
+            pc += op - evm_codes.PUSH0
+        pc += 1
+    return bytes(valid)
+
+# superinstructions, numbered past the 256 real opcodes. The fused pair
+# keeps both slots in the program so instruction indices (and therefore
+# jump targets) do not move; the handler just skips the second slot.
+PUSH_JUMP = 0x100
+PUSH_JUMPI = 0x101
+PUSH_MSTORE = 0x102
+DUP_SWAP = 0x103
+
+class Program:
+    # bytecode decoded into parallel arrays: ops[i] is the opcode (or
+    # superinstruction) of instruction i, args[i] its ready operand and
+    # pcs[i] its offset in the original code. targets maps the pc of each
+    # valid JUMPDEST to its instruction index.
+    __slots__ = ('ops', 'args', 'pcs', 'targets')
+
+    def __init__(self, ops, args, pcs, targets):
+        self.ops = ops
+        self.args = args
+        self.pcs = pcs
+        self.targets = targets
+
+def decode(code, valid):
+    ops = []
+    args = []
+    pcs = []
+    pc = 0
+    while pc < len(code):
+        op = code[pc]
+        arg = None
+        size = 1
+        if evm_codes.PUSH1 <= op <= evm_codes.PUSH32:
+            length = op - evm_codes.PUSH0
+            data = code[pc + 1:pc + 1 + length]
+            # immediates cut off by the end of the code are zero-padded
+            arg = int.from_bytes(data, byteorder='big') << (8 * (length - len(data)))
+            size += length
+        elif op == evm_codes.PUSH0:
+            arg = 0
+        elif evm_codes.DUP1 <= op <= evm_codes.DUP16:
+            arg = op - evm_codes.DUP1 + 1
+        elif evm_codes.SWAP1 <= op <= evm_codes.SWAP16:
+            arg = op - evm_codes.SWAP1 + 1
+        elif evm_codes.LOG0 <= op <= evm_codes.LOG4:
+            arg = op - evm_codes.LOG0
+        elif op == evm_codes.PC:
+            arg = pc
+        ops.append(op)
+        args.append(arg)
+        pcs.append(pc)
+        pc += size
+
+    targets = {p: i for i, p in enumerate(pcs) if valid[p]}
+
+    i = 0
+    while i < len(ops) - 1:
+        op, nxt = ops[i], ops[i + 1]
+        if evm_codes.PUSH1 <= op <= evm_codes.PUSH32:
+            # a constant jump to a non-JUMPDEST stays unfused, the pushed
+            # value is kept for the JUMP to fail on (and tracers to show)
+            if nxt == evm_codes.JUMP and args[i] in targets:
+                ops[i], args[i] = PUSH_JUMP, targets[args[i]]
+            elif nxt == evm_codes.JUMPI and args[i] in targets:
+                ops[i], args[i] = PUSH_JUMPI, targets[args[i]]
+            elif nxt == evm_codes.MSTORE:
+                ops[i] = PUSH_MSTORE
+            else:
+                i += 1
+                continue
+            i += 2
+        elif evm_codes.DUP1 <= op <= evm_codes.DUP16 and evm_codes.SWAP1 <= nxt <= evm_codes.SWAP16:
+            ops[i], args[i] = DUP_SWAP, (args[i], args[i + 1])
+            i += 2
+        else:
+            i += 1
+    return Program(ops, args, pcs, targets)
+
+def first_arg(program, i):
+    # the operand decode() gave instruction i before any fusing: for the
+    # first half of a superinstruction, the pushed jump destination (the pc
+    # its target slot stands for) or the DUP depth
+    op, arg = program.ops[i], program.args[i]
+    if op == PUSH_JUMP or op == PUSH_JUMPI:
+        return program.pcs[arg]
+    if op == DUP_SWAP:
+        return arg[0]
+    return arg
+
+# every basic block of an executable program opens with up to two extra
+# slots: CHARGE, in metered programs, whose operand is the summed static
+# cost of the block, and CHECK, whose operand is (need, limit), wherever
+# the stack analysis cannot prove the block stays within stack bounds.
+# Everything inside a block then runs without per-instruction checks.
+CHARGE = 0x104
+CHECK = 0x105
+
+# instructions that end a basic block: control flow, halts, and everything
+# whose behaviour depends on the exact gas left at that point
+BLOCK_END = frozenset([
+    evm_codes.STOP, evm_codes.JUMP, evm_codes.JUMPI, evm_codes.RETURN, evm_codes.REVERT,
+    evm_codes.INVALID, evm_codes.SELFDESTRUCT, evm_codes.GAS, evm_codes.SSTORE,
+    evm_codes.CREATE, evm_codes.CREATE2, evm_codes.CALL, evm_codes.CALLCODE,
+    evm_codes.DELEGATECALL, evm_codes.STATICCALL,
+])
+
+HALTS = frozenset([
+    evm_codes.STOP, evm_codes.RETURN, evm_codes.REVERT, evm_codes.INVALID, evm_codes.SELFDESTRUCT,
+])
+
+def build_stack_effects():
+    # (items popped, items pushed) per opcode; bytes that are not
+    # instructions fail when run and count as neither
+    effects = [(0, 0)] * 256
+    for ops, effect in (
+        ((evm_codes.ADD, evm_codes.MUL, evm_codes.SUB, evm_codes.DIV, evm_codes.SDIV, evm_codes.MOD,
+          evm_codes.SMOD, evm_codes.EXP, evm_codes.SIGNEXTEND, evm_codes.LT, evm_codes.GT,
+          evm_codes.SLT, evm_codes.SGT, evm_codes.EQ, evm_codes.AND, evm_codes.OR, evm_codes.XOR,
+          evm_codes.BYTE, evm_codes.SHL, evm_codes.SHR, evm_codes.SAR, evm_codes.SHA3), (2, 1)),
+        ((evm_codes.ADDMOD, evm_codes.MULMOD, evm_codes.CREATE), (3, 1)),
+        ((evm_codes.ISZERO, evm_codes.NOT, evm_codes.BALANCE, evm_codes.CALLDATALOAD,
+          evm_codes.EXTCODESIZE, evm_codes.EXTCODEHASH, evm_codes.BLOCKHASH, evm_codes.MLOAD,
+          evm_codes.SLOAD), (1, 1)),
+        ((evm_codes.ADDRESS, evm_codes.ORIGIN, evm_codes.CALLER, evm_codes.CALLVALUE,
+          evm_codes.CALLDATASIZE, evm_codes.CODESIZE, evm_codes.GASPRICE, evm_codes.RETURNDATASIZE,
+          evm_codes.COINBASE, evm_codes.TIMESTAMP, evm_codes.NUMBER, evm_codes.DIFFICULTY,
+          evm_codes.GASLIMIT, evm_codes.CHAINID, evm_codes.SELFBALANCE, evm_codes.BASEFEE,
+          evm_codes.PC, evm_codes.MSIZE, evm_codes.GAS), (0, 1)),
+        ((evm_codes.CALLDATACOPY, evm_codes.CODECOPY, evm_codes.RETURNDATACOPY), (3, 0)),
+        ((evm_codes.MSTORE, evm_codes.MSTORE8, evm_codes.SSTORE, evm_codes.JUMPI,
+          evm_codes.RETURN, evm_codes.REVERT), (2, 0)),
+        ((evm_codes.POP, evm_codes.JUMP, evm_codes.SELFDESTRUCT), (1, 0)),
+        ((evm_codes.EXTCODECOPY,), (4, 0)),
+        ((evm_codes.CREATE2,), (4, 1)),
+        ((evm_codes.CALL, evm_codes.CALLCODE), (7, 1)),
+        ((evm_codes.DELEGATECALL, evm_codes.STATICCALL), (6, 1)),
+    ):
+        for op in ops:
+            effects[op] = effect
+    for op in range(evm_codes.PUSH0, evm_codes.PUSH32 + 1):
+        effects[op] = (0, 1)
+    for n in range(1, 17):
+        effects[evm_codes.DUP1 + n - 1] = (n, n + 1)
+        effects[evm_codes.SWAP1 + n - 1] = (n + 1, n + 1)
+    for n in range(5):
+        effects[evm_codes.LOG0 + n] = (n + 2, 0)
+    return effects
+
+STACK_EFFECTS = build_stack_effects()
+
+class CFG:
+    # basic blocks of a decoded program. Block b covers instructions
+    # starts[b] to ends[b] - 1 and can be followed by the blocks in
+    # succs[b]. It needs need[b] items on entry and overflows if it is
+    # entered above limit[b]. lo[b]..hi[b] is every entry height the
+    # analysis found possible (None if unreachable); checked[b] is set
+    # where that range does not prove need <= height <= limit.
+    __slots__ = ('program', 'starts', 'ends', 'succs', 'need', 'limit', 'lo', 'hi', 'checked')
+
+    def __init__(self, program, starts, ends, succs, need, limit, lo, hi):
+        self.program = program
+        self.starts = starts
+        self.ends = ends
+        self.succs = succs
+        self.need = need
+        self.limit = limit
+        self.lo = lo
+        self.hi = hi
+        self.checked = [lo[b] is None or lo[b] < need[b] or hi[b] > limit[b] for b in range(len(starts))]
+
+def analyze(program, code):
+    # blocks start at the first instruction, at every JUMPDEST and after
+    # every BLOCK_END instruction; fused pairs never straddle a boundary
+    ops, args, pcs = program.ops, program.args, program.pcs
+    n = len(ops)
+    starts = []
+    ends = []
+    i = 0
+    while i < n:
+        starts.append(i)
+        while True:
+            op = code[pcs[i]]
+            i += 1
+            if op in BLOCK_END or i == n or code[pcs[i]] == evm_codes.JUMPDEST:
+                break
+        ends.append(i)
+
+    need = []
+    limit = []
+    delta = []
+    for start, end in zip(starts, ends):
+        height = low = high = 0
+        for i in range(start, end):
+            pops, pushes = STACK_EFFECTS[code[pcs[i]]]
+            height -= pops
+            low = min(low, height)
+            height += pushes
+            high = max(high, height)
+        need.append(-low)
+        limit.append(STACK_LIMIT - high)
+        delta.append(height)
+
+    # a jump with a constant target (fused into PUSH_JUMP/PUSH_JUMPI) has
+    # one successor, any other jump can reach every JUMPDEST
+    block_at = {start: b for b, start in enumerate(starts)}
+    dynamic = [block_at[t] for t in program.targets.values()]
+    succs = []
+    for b, end in enumerate(ends):
+        last = end - 1
+        op = code[pcs[last]]
+        out = []
+        if op == evm_codes.JUMP or op == evm_codes.JUMPI:
+            if last > starts[b] and (ops[last - 1] == PUSH_JUMP or ops[last - 1] == PUSH_JUMPI):
+                out.append(block_at[args[last - 1]])
+            else:
+                out.extend(dynamic)
+        if end < n and op != evm_codes.JUMP and op not in HALTS:
+            out.append(b + 1)
+        succs.append(out)
+
+    # entry height intervals, from 0 at the start of the code. A bound
+    # that keeps moving is widened to 0 or STACK_LIMIT so loops settle fast.
+    lo = [None] * len(starts)
+    hi = [None] * len(starts)
+    changes = [0] * len(starts)
+    work = []
+    if starts:
+        lo[0] = hi[0] = 0
+        work.append(0)
+    while work:
+        b = work.pop()
+        # heights that get through the block without a stack error
+        entry_lo = max(lo[b], need[b])
+        entry_hi = min(hi[b], limit[b])
+        if entry_lo > entry_hi:
+            continue
+        out_lo = entry_lo + delta[b]
+        out_hi = entry_hi + delta[b]
+        for s in succs[b]:
+            if lo[s] is None:
+                lo[s], hi[s] = out_lo, out_hi
+            elif out_lo < lo[s] or out_hi > hi[s]:
+                changes[s] += 1
+                if out_lo < lo[s]:
+                    lo[s] = out_lo if changes[s] < 3 else 0
+                if out_hi > hi[s]:
+                    hi[s] = out_hi if changes[s] < 3 else STACK_LIMIT
+            else:
+                continue
+            work.append(s)
+    return CFG(program, starts, ends, succs, need, limit, lo, hi)
+
+# what initcode can read of its surroundings: (True, key) for tx[key],
+# (False, key) for block[key]
+CONTEXT_READS = {
+    evm_codes.ADDRESS: (True, 'to'),
+    evm_codes.CALLER: (True, 'from'),
+    evm_codes.ORIGIN: (True, 'origin'),
+    evm_codes.CALLVALUE: (True, 'value'),
+    evm_codes.GASPRICE: (True, 'gasprice'),
+    evm_codes.COINBASE: (False, 'coinbase'),
+    evm_codes.TIMESTAMP: (False, 'timestamp'),
+    evm_codes.NUMBER: (False, 'number'),
+    evm_codes.DIFFICULTY: (False, 'difficulty'),
+    evm_codes.GASLIMIT: (False, 'gaslimit'),
+    evm_codes.CHAINID: (False, 'chainid'),
+    evm_codes.BASEFEE: (False, 'basefee'),
+}
+
+# instructions that read state other than the new account's own storage,
+# see the gas left, or reach outside the account being created
+NOT_REPLAYABLE = frozenset([
+    evm_codes.BALANCE, evm_codes.SELFBALANCE, evm_codes.EXTCODESIZE, evm_codes.EXTCODECOPY,
+    evm_codes.EXTCODEHASH, evm_codes.BLOCKHASH, evm_codes.GAS, evm_codes.SELFDESTRUCT,
+    evm_codes.CREATE, evm_codes.CREATE2, evm_codes.CALL, evm_codes.CALLCODE, evm_codes.DELEGATECALL,
+    evm_codes.STATICCALL,
+])
+
+def constructor_inputs(cfg, code):
+    # the CONTEXT_READS initcode can reach, sorted, when its result (code,
+    # storage, logs and gas used) depends on nothing but those and the
+    # initcode itself; None when it can reach anything in NOT_REPLAYABLE.
+    # The runtime code and constructor arguments after the final RETURN
+    # are never reached and do not count.
+    reads = set()
+    pcs = cfg.program.pcs
+    for b, start in enumerate(cfg.starts):
+        if cfg.lo[b] is None:
+            continue
+        for i in range(start, cfg.ends[b]):
+            op = code[pcs[i]]
+            if op in NOT_REPLAYABLE:
+                return None
+            read = CONTEXT_READS.get(op)
+            if read is not None:
+                reads.add(read)
+    return tuple(sorted(reads))
+
+def instrument(cfg, code, costs=None):
+    # the executable program: cfg.program with each block opened by its
+    # CHARGE slot (when costs is given) and its CHECK slot (when needed).
+    # Jumps land on the first slot of the JUMPDEST's block.
+    program = cfg.program
+    ops, args, pcs = program.ops, program.args, program.pcs
+    new_ops = []
+    new_args = []
+    new_pcs = []
+    entry = []
+    for b, (start, end) in enumerate(zip(cfg.starts, cfg.ends)):
+        entry.append(len(new_ops))
+        if costs is not None:
+            new_ops.append(CHARGE)
+            new_args.append(sum(costs[code[pcs[i]]] for i in range(start, end)))
+            new_pcs.append(pcs[start])
+        if cfg.checked[b]:
+            new_ops.append(CHECK)
+            new_args.append((cfg.need[b], cfg.limit[b]))
+            new_pcs.append(pcs[start])
+        new_ops.extend(ops[start:end])
+        new_args.extend(args[start:end])
+        new_pcs.extend(pcs[start:end])
+
+    block_at = {start: b for b, start in enumerate(cfg.starts)}
+    for j, op in enumerate(new_ops):
+        if op == PUSH_JUMP or op == PUSH_JUMPI:
+            new_args[j] = entry[block_at[new_args[j]]]
+    targets = {pc: entry[block_at[t]] for pc, t in program.targets.items()}
+    return Program(new_ops, new_args, new_pcs, targets)
@@ -0,0 +1,216 @@
+# Persistent state: a WorldState whose accounts and storage are a bounded
+# cache over a backend. Lookups (SLOAD, BALANCE, EXTCODE*, ...) load
+# missing entries on first use; writes stay in the cache and are flushed
+# to the backend in one batch when the transaction commits.
+#
+#   vm = evm.EVM(BackedState(SQLiteBackend('state.db')))
+#   vm.run(code, tx, block, None)      # storage=None: use the backend's
+
+import sqlite3
+import threading
+from evm_state import Account, WorldState, BALANCE, CODE, STORAGE, CREATE, NONCE
+
+class MemoryBackend:
+    # backends store committed state only: load_account() returns an
+    # Account or None, load_slot() the value or 0, write() takes
+    # {addr: Account or None} and {(addr, key): value} as one batch
+    def __init__(self):
+        self.accounts = {}
+        self.storage = {}
+
+    def load_account(self, addr):
+        acct = self.accounts.get(addr)
+        return Account(*acct) if acct is not None else None
+
+    def load_slot(self, addr, key):
+        return self.storage.get((addr, key), 0)
+
+    def write(self, accounts, slots):
+        for addr, acct in accounts.items():
+            if acct is None:
+                self.accounts.pop(addr, None)
+            else:
+                self.accounts[addr] = (acct.balance, acct.code, acct.nonce)
+        for key, value in slots.items():
+            if value:
+                self.storage[key] = value
+            else:
+                self.storage.pop(key, None)
+
+    def close(self):
+        pass
+
+def word(x):
+    return x.to_bytes(32, byteorder='big')
+
+class SQLiteBackend:
+    # words are stored as 32-byte big-endian blobs, sqlite integers stop at
+    # 64 bits; zero slots are deleted rather than stored. One connection is
+    # shared by every thread, each use of it holds the lock.
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS accounts "
+                        "(addr BLOB PRIMARY KEY, balance BLOB, code BLOB, nonce INTEGER) WITHOUT ROWID")
+        self.db.execute("CREATE TABLE IF NOT EXISTS storage "
+                        "(addr BLOB, key BLOB, value BLOB, PRIMARY KEY (addr, key)) WITHOUT ROWID")
+        self.db.commit()
+
+    def load_account(self, addr):
+        with self.lock:
+            row = self.db.execute("SELECT balance, code, nonce FROM accounts WHERE addr = ?",
+                                  (word(addr),)).fetchone()
+        if row is None:
+            return None
+        return Account(int.from_bytes(row[0], byteorder='big'), row[1], row[2])
+
+    def load_slot(self, addr, key):
+        with self.lock:
+            row = self.db.execute("SELECT value FROM storage WHERE addr = ? AND key = ?",
+                                  (word(addr), word(key))).fetchone()
+        return int.from_bytes(row[0], byteorder='big') if row is not None else 0
+
+    def write(self, accounts, slots):
+        with self.lock, self.db:
+            self.db.executemany("DELETE FROM accounts WHERE addr = ?",
+                                [(word(addr),) for addr, acct in accounts.items() if acct is None])
+            self.db.executemany("INSERT OR REPLACE INTO accounts VALUES (?, ?, ?, ?)",
+                                [(word(addr), word(acct.balance), acct.code, acct.nonce)
+                                 for addr, acct in accounts.items() if acct is not None])
+            self.db.executemany("DELETE FROM storage WHERE addr = ? AND key = ?",
+                                [(word(addr), word(key)) for (addr, key), value in slots.items() if not value])
+            self.db.executemany("INSERT OR REPLACE INTO storage VALUES (?, ?, ?)",
+                                [(word(addr), word(key), word(value))
+                                 for (addr, key), value in slots.items() if value])
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+class SlotCache(dict):
+    # one account's storage; SLOAD reads it directly, so a miss is loaded
+    # here. Slots the backend does not have are cached as 0. Misses are
+    # filled under the state's lock, forks on other threads read through.
+    __slots__ = ('state', 'addr')
+
+    def __init__(self, state, addr):
+        super().__init__()
+        self.state = state
+        self.addr = addr
+
+    def get(self, key, default=None):
+        value = dict.get(self, key)
+        if value is None:
+            state = self.state
+            with state.lock:
+                value = dict.get(self, key)
+                if value is None:
+                    value = state.backend.load_slot(self.addr, key)
+                    state.loads += 1
+                    self[key] = value
+        return value
+
+class AccountCache(dict):
+    __slots__ = ('state', 'absent')
+
+    def __init__(self, state):
+        super().__init__()
+        self.state = state
+        # addresses the backend has no account for
+        self.absent = set()
+
+    def get(self, addr, default=None):
+        acct = dict.get(self, addr)
+        if acct is None and addr not in self.absent:
+            state = self.state
+            with state.lock:
+                acct = dict.get(self, addr)
+                if acct is None and addr not in self.absent:
+                    acct = state.backend.load_account(addr)
+                    state.loads += 1
+                    if acct is None:
+                        self.absent.add(addr)
+                    else:
+                        dict.__setitem__(self, addr, acct)
+        return acct
+
+    def __contains__(self, addr):
+        return self.get(addr) is not None
+
+    def __setitem__(self, addr, acct):
+        self.absent.discard(addr)
+        dict.__setitem__(self, addr, acct)
+
+class BackedState(WorldState):
+    # the cache holds at most max_entries accounts plus slots between
+    # transactions; within one it grows as needed, since running frames
+    # hold on to the storage dicts. Eviction drops what was loaded first.
+    # Forks of it may run on several threads at once (see evm_threads): the
+    # lock serializes their cache fills.
+    def __init__(self, backend, max_entries=1 << 20):
+        super().__init__()
+        self.backend = backend
+        self.lock = threading.Lock()
+        self.max_entries = max_entries
+        self.accounts = AccountCache(self)
+        self.loads = 0
+        self.flushed = 0
+
+    def storage_of(self, addr):
+        storage = self.storage.get(addr)
+        if storage is None:
+            with self.lock:
+                storage = self.storage.get(addr)
+                if storage is None:
+                    storage = self.storage[addr] = SlotCache(self, addr)
+        return storage
+
+    storage_view = storage_of
+
+    def get_storage(self, addr, key):
+        return self.storage_of(addr).get(key)
+
+    def commit(self):
+        self.flush()
+        super().commit()
+        self.evict()
+
+    def flush(self):
+        # everything the journal says was written in this transaction, at
+        # its current value, as one batch
+        accounts = {}
+        slots = {}
+        for kind, addr, old in self.journal:
+            if kind == STORAGE:
+                slots[(addr, old[0])] = dict.get(self.storage[addr], old[0])
+            elif kind in (BALANCE, CODE, NONCE, CREATE):
+                accounts[addr] = dict.get(self.accounts, addr)
+        if accounts or slots:
+            self.backend.write(accounts, slots)
+            self.flushed += len(accounts) + len(slots)
+
+    def evict(self):
+        size = len(self.accounts) + sum(len(s) for s in self.storage.values())
+        for addr in list(self.storage):
+            if size <= self.max_entries:
+                break
+            size -= len(self.storage.pop(addr))
+        for addr in list(self.accounts):
+            if size <= self.max_entries:
+                break
+            dict.__delitem__(self.accounts, addr)
+            size -= 1
+        if len(self.accounts.absent) > self.max_entries:
+            self.accounts.absent.clear()
+
+    def stats(self):
+        return {
+            'entries': len(self.accounts) + sum(len(s) for s in self.storage.values()),
+            'loads': self.loads,
+            'flushed': self.flushed,
+        }
+
+    def close(self):
+        self.backend.close()
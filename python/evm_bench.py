@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+
+# Interpreter throughput benchmarks: micro-benchmarks per opcode family and
+# a few contract-shaped macro workloads. Reports instructions/sec and peak
+# traced allocations, saves JSON baselines and flags regressions.
+#
+#   python3 evm_bench.py                          # run everything
+#   python3 evm_bench.py --save baseline.json
+#   python3 evm_bench.py --compare baseline.json --threshold 0.10
+#   python3 evm_bench.py sha3 erc20               # run a subset
+
+import argparse
+import json
+import sys
+import time
+import tracemalloc
+import evm
+import evm_codes
+from evm_cache import create_cache
+from evm_keccak import keccak
+import evm_precompiles
+from evm_precompiles import PRECOMPILES, precompile_memo
+from evm_runner import counting_tables
+from evm_state import WorldState
+
+def assemble(*tokens):
+    # tiny assembler: 'ADD' is an opcode, an int is pushed with the smallest
+    # PUSH, ':name' places a JUMPDEST labelled name, '@name' pushes its offset
+    code = bytearray()
+    labels = {}
+    refs = []
+    for token in tokens:
+        if isinstance(token, int):
+            data = token.to_bytes(max(1, (token.bit_length() + 7) // 8), byteorder='big')
+            code.append(evm_codes.PUSH0 + len(data))
+            code += data
+        elif token.startswith(':'):
+            labels[token[1:]] = len(code)
+            code.append(evm_codes.JUMPDEST)
+        elif token.startswith('@'):
+            code.append(evm_codes.PUSH2)
+            refs.append((len(code), token[1:]))
+            code += b'\0\0'
+        else:
+            code.append(getattr(evm_codes, token))
+    for pos, name in refs:
+        code[pos:pos + 2] = labels[name].to_bytes(2, byteorder='big')
+    return bytes(code)
+
+def loop(n, *body, setup=()):
+    # runs body n times, after setup once; body sees the counter on top and
+    # must leave the stack as it found it
+    return assemble(*setup, n, ':loop', *body, 1, 'SWAP1', 'SUB', 'DUP1', '@loop', 'JUMPI', 'POP', 'STOP')
+
+def mapping_slot(key, slot):
+    return int.from_bytes(keccak(key.to_bytes(32, 'big') + slot.to_bytes(32, 'big')), 'big')
+
+CONTRACT = 0x1000000000000000000000000000000000000c0d
+TX = {"to": hex(CONTRACT), "from": "0x1e79b045dc29eae9fdc69673c9dcd7c53e5e159d",
+      "origin": "0x1e79b045dc29eae9fdc69673c9dcd7c53e5e159d"}
+
+def workload(code, tx=None, state=None, storage=None):
+    return {'code': code, 'tx': dict(tx or TX), 'state': state, 'storage': storage or {}}
+
+def bench_arithmetic():
+    return workload(loop(2000, 'DUP1', 'DUP1', 'ADD', 'DUP1', 'MUL', 7, 'SWAP1', 'MOD',
+                         5, 'XOR', 3, 'SWAP1', 'DIV', 'DUP2', 'LT', 'POP'))
+
+def bench_stack():
+    return workload(loop(2000, 1, 2, 3, 'DUP3', 'DUP3', 'SWAP2', 'SWAP1', 'SWAP4', 'SWAP3',
+                         'POP', 'POP', 'POP', 'POP', 'POP'))
+
+def bench_memory():
+    return workload(loop(2000, 'DUP1', 'DUP1', 'MSTORE', 'DUP1', 'MLOAD', 'POP',
+                         'DUP1', 32, 'MSTORE', 32, 'MLOAD', 'POP'))
+
+def bench_sha3():
+    return workload(loop(2000, 'DUP1', 0, 'MSTORE', 64, 0, 'SHA3', 'POP'))
+
+def bench_storage():
+    return workload(loop(2000, 'DUP1', 'DUP1', 'SSTORE', 'DUP1', 'SLOAD', 'POP'))
+
+def bench_jump():
+    return workload(loop(5000))
+
+def bench_erc20():
+    # balances[0xaa] -= 1; balances[0xbb] += 1, mapping at slot 0
+    def update(holder, op):
+        return (holder, 0, 'MSTORE', 0, 32, 'MSTORE', 64, 0, 'SHA3',
+                'DUP1', 'SLOAD', 1, 'SWAP1', op, 'SWAP1', 'SSTORE')
+    code = loop(1000, *update(0xaa, 'SUB'), *update(0xbb, 'ADD'))
+    return workload(code, storage={mapping_slot(0xaa, 0): 10 ** 18, mapping_slot(0xbb, 0): 0})
+
+def bench_mapping():
+    # reads balances[i] for 1000 distinct keys, mapping at slot 1
+    code = loop(1000, 'DUP1', 0, 'MSTORE', 1, 32, 'MSTORE', 64, 0, 'SHA3', 'SLOAD', 'POP')
+    return workload(code, storage={mapping_slot(i, 1): i for i in range(1, 1001)})
+
+def bench_call_chain():
+    # the contract CALLs itself with depth - 1 until depth reaches zero
+    code = assemble(0, 'CALLDATALOAD', 'DUP1', 'ISZERO', '@end', 'JUMPI',
+                    1, 'SWAP1', 'SUB', 0, 'MSTORE',
+                    0, 0, 32, 0, 0, 'ADDRESS', 'GAS', 'CALL', 'POP', 'STOP',
+                    ':end', 'POP', 'STOP')
+    tx = dict(TX, data=(64).to_bytes(32, 'big').hex())
+    return workload(code, tx=tx, state={hex(CONTRACT): {'code': {'bin': code.hex()}}})
+
+def bench_delegate_chain():
+    # a proxy chain as deep as calls go: DELEGATECALL into our own code
+    # with depth - 1, 1024 frames down
+    code = assemble(0, 'CALLDATALOAD', 'DUP1', 'ISZERO', '@end', 'JUMPI',
+                    1, 'SWAP1', 'SUB', 0, 'MSTORE',
+                    0, 0, 32, 0, 'ADDRESS', 'GAS', 'DELEGATECALL', 'POP', 'STOP',
+                    ':end', 'POP', 'STOP')
+    tx = dict(TX, data=(1024).to_bytes(32, 'big').hex())
+    return workload(code, tx=tx, state={hex(CONTRACT): {'code': {'bin': code.hex()}}})
+
+def bench_logs():
+    # a Transfer-style event per iteration: two topics, the counter as data
+    transfer = int.from_bytes(keccak(b'Transfer(address,address,uint256)'), 'big')
+    return workload(loop(2000, 'DUP1', 0, 'MSTORE', CONTRACT, transfer, 32, 0, 'LOG2'))
+
+def bench_calldatacopy():
+    size = 64 * 1024
+    code = loop(200, size, 0, 0, 'CALLDATACOPY')
+    return workload(code, tx=dict(TX, data='ab' * size))
+
+class Unavailable(Exception):
+    # a workload this interpreter cannot run, e.g. for lack of an optional
+    # package; the message says why
+    pass
+
+def bench_precompile(address, data, vary, n=200):
+    # n STATICCALLs to a precompile with data as input, the counter written
+    # into it at offset vary each time so memoized ones compute every call
+    code = loop(n, 'DUP1', vary, 'MSTORE', 64, len(data), len(data), 0, address, 'GAS', 'STATICCALL', 'POP',
+                setup=(len(data), 0, 0, 'CALLDATACOPY'))
+    return workload(code, tx=dict(TX, data=data.hex()))
+
+def bench_identity():
+    return bench_precompile(0x04, bytes(range(256)) * 16, 0, 2000)
+
+def bench_sha256():
+    return bench_precompile(0x02, bytes(range(256)) * 4, 0, 2000)
+
+def bench_ecrecover():
+    # any hash with a valid (v, r, s) recovers some key
+    sig = bytes.fromhex('000000000000000000000000000000000000000000000000000000000000001c'
+                        '9242685bf161793cc25603c231bc2f568eb630ea16aa137d2664ac8038825608'
+                        '4f8ae3bd7535248d0bd448298cc2e2071e56992d0774dc340c368ae950852ada')
+    return bench_precompile(0x01, bytes(32) + sig, 0, 50)
+
+def bench_modexp():
+    # 2048-bit RSA-style exponentiation with a varying base
+    m = 2 ** 2048 - 159
+    data = b''.join(x.to_bytes(32, 'big') for x in (256, 32, 256)) + bytes(256) + (65537).to_bytes(32, 'big')
+    return bench_precompile(0x05, data + m.to_bytes(256, 'big'), 96 + 224)
+
+def bench_ripemd160():
+    return bench_precompile(0x03, bytes(range(256)) * 4, 0, 2000)
+
+def bench_ecadd():
+    # the counter goes past the 128 bytes ecadd reads: the points stay on
+    # the curve and the memo still sees a new input every call
+    g1 = (1).to_bytes(32, 'big') + (2).to_bytes(32, 'big')
+    return bench_precompile(0x06, g1 + g1 + bytes(32), 128, 200)
+
+def bench_ecmul():
+    g1 = (1).to_bytes(32, 'big') + (2).to_bytes(32, 'big')
+    return bench_precompile(0x07, g1 + bytes(32), 64, 50)
+
+def bench_ecpairing():
+    # e(P, Q) * e(-P, Q) == 1 for the generators. Nothing in the input can
+    # vary without breaking it, so the counter goes past it and the workload
+    # is a single call: one pairing check is slow enough on its own.
+    if 0x08 not in PRECOMPILES:
+        raise Unavailable("ecpairing needs py_ecc")
+    bn128 = evm_precompiles.bn128
+    x, y = (bn128.normalize(bn128.G2)[i].coeffs for i in (0, 1))
+    g2 = b''.join(int(c).to_bytes(32, 'big') for c in (x[1], x[0], y[1], y[0]))
+    p = evm_precompiles.BN128_P
+    data = (1).to_bytes(32, 'big') + (2).to_bytes(32, 'big') + g2 + (1).to_bytes(32, 'big') + (p - 2).to_bytes(32, 'big') + g2
+    return bench_precompile(0x08, data, len(data) + 64, 1)
+
+def bench_blake2f():
+    # 12 rounds, the counter written into the message block
+    data = (12).to_bytes(4, 'big') + bytes(64) + bytes(range(128)) + (128).to_bytes(8, 'little') + bytes(8) + b'\x01'
+    return bench_precompile(0x09, data, 100, 500)
+
+def bench_factory():
+    # a factory CREATE2-deploying 200 copies of a pool template whose
+    # constructor records the factory and a few parameters and returns 4 KiB
+    # of runtime code
+    runtime = b'\x5b' * 4096
+    def initcode(offset):
+        return assemble('CALLER', 0, 'SSTORE', 3000, 1, 'SSTORE', 60, 2, 'SSTORE',
+                        len(runtime), offset, 0, 'CODECOPY', len(runtime), 0, 'RETURN')
+    size = len(initcode(0))
+    init = initcode(len(initcode(size))) + runtime
+    code = loop(200, 'DUP1', len(init), 0, 0, 'CREATE2', 'POP', setup=(len(init), 0, 0, 'CALLDATACOPY'))
+    return workload(code, tx=dict(TX, data=init.hex()))
+
+WORKLOADS = {
+    'arithmetic': bench_arithmetic,
+    'stack': bench_stack,
+    'memory': bench_memory,
+    'sha3': bench_sha3,
+    'storage': bench_storage,
+    'jump': bench_jump,
+    'erc20': bench_erc20,
+    'mapping': bench_mapping,
+    'call_chain': bench_call_chain,
+    'delegate_chain': bench_delegate_chain,
+    'logs': bench_logs,
+    'calldatacopy': bench_calldatacopy,
+    'identity': bench_identity,
+    'sha256': bench_sha256,
+    'ecrecover': bench_ecrecover,
+    'modexp': bench_modexp,
+    'ripemd160': bench_ripemd160,
+    'ecadd': bench_ecadd,
+    'ecmul': bench_ecmul,
+    'ecpairing': bench_ecpairing,
+    'blake2f': bench_blake2f,
+    'factory': bench_factory,
+}
+
+_counter = [0]
+_counting = counting_tables(_counter)
+
+def run_once(w, tables=evm.TABLES, compile_after=None):
+    vm = evm.EVM(WorldState.from_json(w['state']), compile_after)
+    storage = dict(w['storage'])
+    # a previous run's results would make memoized precompiles and cached
+    # constructors free
+    precompile_memo.clear()
+    create_cache.clear()
+    start = time.perf_counter()
+    frame = vm.run(w['code'], w['tx'], {}, storage, tables=tables)
+    elapsed = time.perf_counter() - start
+    if not frame.success:
+        raise RuntimeError("benchmark workload failed")
+    return elapsed
+
+def measure(w, min_time, compile_after=None):
+    _counter[0] = 0
+    run_once(w, _counting)
+    instructions = _counter[0]
+
+    tracemalloc.start()
+    run_once(w, compile_after=compile_after)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    # rate from the fastest run, it is far less noisy than the mean
+    run_once(w, compile_after=compile_after)
+    times = []
+    while sum(times) < min_time:
+        times.append(run_once(w, compile_after=compile_after))
+    return {
+        'instructions': instructions,
+        'runs': len(times),
+        'seconds_per_run': sum(times) / len(times),
+        'ops_per_sec': instructions / min(times),
+        'peak_alloc_kib': peak / 1024,
+    }
+
+def compare(results, baseline, threshold):
+    regressions = []
+    for name, r in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        change = r['ops_per_sec'] / base['ops_per_sec'] - 1
+        r['change'] = change
+        if change < -threshold:
+            regressions.append(name)
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="EVM interpreter benchmarks")
+    parser.add_argument('workloads', nargs='*', help=f"subset of: {', '.join(WORKLOADS)}")
+    parser.add_argument('--min-time', type=float, default=0.5, help="seconds to time each workload for")
+    parser.add_argument('--save', help="write results as a JSON baseline")
+    parser.add_argument('--compare', help="JSON baseline to compare against")
+    parser.add_argument('--threshold', type=float, default=0.10,
+                        help="flag workloads this much slower than the baseline")
+    parser.add_argument('--compile-after', type=int, default=None, metavar='N',
+                        help="compile contracts to Python after N runs (see evm_compile.py)")
+    args = parser.parse_args(argv)
+
+    names = args.workloads or list(WORKLOADS)
+    results = {}
+    for name in names:
+        try:
+            w = WORKLOADS[name]()
+        except Unavailable as e:
+            print(f"{name}: skipped, {e}")
+            continue
+        results[name] = measure(w, args.min_time, args.compile_after)
+
+    regressions = []
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+
+    print(f"{'workload':<14}{'instructions':>14}{'ops/sec':>14}{'peak KiB':>12}{'change':>10}")
+    for name, r in results.items():
+        change = f"{r['change']:+.1%}" if 'change' in r else ''
+        flag = '  REGRESSION' if name in regressions else ''
+        print(f"{name:<14}{r['instructions']:>14}{r['ops_per_sec']:>14,.0f}{r['peak_alloc_kib']:>12.1f}{change:>10}{flag}")
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+    return 1 if regressions else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
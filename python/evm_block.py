@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+
+# Optimistic parallel block execution. Every transaction first runs
+# speculatively against the pre-block state in a process pool, recording
+# what it read and the final values of what it wrote. The writes are then
+# applied in block order; a transaction that read anything an earlier one
+# wrote is re-executed against the committed state instead. The result is
+# identical to running the block serially.
+#
+#   python3 evm_block.py -j 8 --txs 2000     # synthetic block, checked against serial
+
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+import evm
+from evm_state import Account, WorldState, BALANCE, CODE, STORAGE, CREATE, NONCE
+
+class RecordedStorage(dict):
+    # one account's storage; SLOAD reads it directly, so lookups are
+    # recorded here rather than in the state methods
+    __slots__ = ('reads', 'addr')
+
+    def __init__(self, reads, addr, items=()):
+        super().__init__(items)
+        self.reads = reads
+        self.addr = addr
+
+    def get(self, key, default=None):
+        self.reads.add((STORAGE, self.addr, key))
+        return dict.get(self, key, default)
+
+class SpeculativeState(WorldState):
+    # a WorldState whose transactions never stick: reads are collected in
+    # reads, and commit() collects the final value of every key written
+    # into writes and then unwinds the transaction. apply() makes writes
+    # permanent. Keys are (kind, addr) or (STORAGE, addr, slot), with the
+    # evm_state journal kinds; CREATE stands for the account existing.
+    def __init__(self):
+        super().__init__()
+        self.reads = set()
+        self.writes = {}
+
+    @classmethod
+    def copy_of(cls, state):
+        new = cls()
+        new.accounts = {addr: Account(a.balance, a.code, a.nonce) for addr, a in state.accounts.items()}
+        new.storage = {addr: RecordedStorage(new.reads, addr, s) for addr, s in state.storage.items()}
+        return new
+
+    def to_world_state(self):
+        return WorldState.copy(self)
+
+    def exists(self, addr):
+        self.reads.add((CREATE, addr))
+        return super().exists(addr)
+
+    def get_balance(self, addr):
+        self.reads.add((BALANCE, addr))
+        return super().get_balance(addr)
+
+    def get_code(self, addr):
+        self.reads.add((CODE, addr))
+        return super().get_code(addr)
+
+    def get_nonce(self, addr):
+        self.reads.add((NONCE, addr))
+        return super().get_nonce(addr)
+
+    def storage_of(self, addr):
+        storage = self.storage.get(addr)
+        if storage is None:
+            storage = self.storage[addr] = RecordedStorage(self.reads, addr)
+        return storage
+
+    storage_view = storage_of
+
+    def get_storage(self, addr, key):
+        return self.storage_of(addr).get(key, 0)
+
+    def begin(self):
+        self.reads.clear()
+        self.writes = {}
+
+    def commit(self):
+        writes = self.writes
+        for kind, addr, old in self.journal:
+            if kind == STORAGE:
+                key = old[0]
+                writes[(STORAGE, addr, key)] = dict.get(self.storage[addr], key, 0)
+                continue
+            acct = self.accounts.get(addr)
+            if kind == CREATE:
+                writes[(CREATE, addr)] = acct is not None
+                kinds = (BALANCE, CODE, NONCE)
+            elif kind in (BALANCE, CODE, NONCE):
+                kinds = (kind,)
+            else:
+                continue
+            for field in kinds:
+                writes[(field, addr)] = account_field(acct, field)
+        self.revert(0)
+        super().commit()
+
+    def apply(self, writes):
+        # not journaled: this is the committed state of the block
+        for key, value in writes.items():
+            kind, addr = key[0], key[1]
+            if kind == STORAGE:
+                dict.__setitem__(self.storage_of(addr), key[2], value)
+            elif kind == CREATE:
+                if not value:
+                    self.accounts.pop(addr, None)
+                elif addr not in self.accounts:
+                    self.accounts[addr] = Account()
+            else:
+                acct = self.accounts.get(addr)
+                if acct is None:
+                    acct = self.accounts[addr] = Account()
+                if kind == BALANCE:
+                    acct.balance = value
+                elif kind == CODE:
+                    acct.code = value
+                else:
+                    acct.nonce = value
+
+def account_field(acct, kind):
+    if acct is None:
+        return b'' if kind == CODE else 0
+    if kind == BALANCE:
+        return acct.balance
+    if kind == CODE:
+        return acct.code
+    return acct.nonce
+
+def run_tx(vm, tx, block, gas):
+    # runs tx in the evm.EVM vm, the code is the account code at tx['to']
+    frame = vm.run(vm.state.get_code(int(tx['to'], 16)), tx, block, None, gas)
+    return {
+        'success': frame.success,
+        'stack': frame.stack.to_list(),
+        'logs': frame.log,
+        'return': frame.ret.hex() if frame.ret is not None else None,
+    }
+
+def speculate(vm, tx, block, gas):
+    # vm runs over a SpeculativeState
+    state = vm.state
+    state.begin()
+    result = run_tx(vm, tx, block, gas)
+    return set(state.reads), state.writes, result
+
+_vm = None
+_txs = None
+_block = None
+_gas = None
+
+def _init_worker(state, txs, block, gas):
+    global _vm, _txs, _block, _gas
+    _vm = evm.EVM(SpeculativeState.copy_of(state))
+    _txs, _block, _gas = txs, block, gas
+
+def _speculate_index(i):
+    return speculate(_vm, _txs[i], _block, _gas)
+
+def execute_block(state, txs, block=None, gas=None, jobs=None):
+    # returns (post-block WorldState, per-tx results, indices re-executed);
+    # state itself is left untouched
+    jobs = jobs or os.cpu_count() or 1
+    if jobs <= 1:
+        return execute_serial(state, txs, block, gas) + ([],)
+    chunksize = max(1, len(txs) // (jobs * 8))
+    with ProcessPoolExecutor(jobs, initializer=_init_worker, initargs=(state, txs, block, gas)) as pool:
+        speculative = list(pool.map(_speculate_index, range(len(txs)), chunksize=chunksize))
+
+    committed = SpeculativeState.copy_of(state)
+    vm = evm.EVM(committed)
+    written = set()
+    results = []
+    reexecuted = []
+    for i, (reads, writes, result) in enumerate(speculative):
+        if not reads.isdisjoint(written):
+            reads, writes, result = speculate(vm, txs[i], block, gas)
+            reexecuted.append(i)
+        committed.apply(writes)
+        written.update(writes)
+        results.append(result)
+    return committed.to_world_state(), results, reexecuted
+
+def execute_serial(state, txs, block=None, gas=None):
+    # the reference: one transaction after another on a copy of state
+    vm = evm.EVM(state.copy())
+    results = [run_tx(vm, tx, block, gas) for tx in txs]
+    return vm.state, results
+
+def token_block(n, holders, rounds):
+    # a block of token transfers between a handful of holders, each doing
+    # some keccak work first so there is something to parallelise
+    from evm_bench import assemble, mapping_slot
+    def update(word, op):
+        return (word, 'CALLDATALOAD', 0, 'MSTORE', 0, 32, 'MSTORE', 64, 0, 'SHA3',
+                'DUP1', 'SLOAD', 1, 'SWAP1', op, 'SWAP1', 'SSTORE')
+    code = assemble(64, 'CALLDATALOAD', ':loop', 64, 0, 'SHA3', 0, 'MSTORE',
+                    1, 'SWAP1', 'SUB', 'DUP1', '@loop', 'JUMPI', 'POP',
+                    *update(0, 'SUB'), *update(32, 'ADD'), 'STOP')
+    token = 0x70c3
+    state = WorldState()
+    state.accounts[token] = Account(code=code)
+    state.storage[token] = {mapping_slot(h, 0): 10 ** 18 for h in range(1, holders + 1)}
+    txs = []
+    for i in range(n):
+        sender, receiver = i % holders + 1, (i * 7 + 3) % holders + 1
+        data = b''.join(x.to_bytes(32, 'big') for x in (sender, receiver, rounds))
+        txs.append({"to": evm.address_hex(token), "from": evm.address_hex(sender), "data": data.hex()})
+    return state, txs
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Parallel block execution on a synthetic token block")
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--txs', type=int, default=1000)
+    parser.add_argument('--holders', type=int, default=200, help="fewer holders means more conflicts")
+    parser.add_argument('--rounds', type=int, default=200, help="keccak rounds per transaction")
+    args = parser.parse_args(argv)
+
+    state, txs = token_block(args.txs, args.holders, args.rounds)
+    start = time.perf_counter()
+    serial_state, serial_results = execute_serial(state, txs)
+    serial_time = time.perf_counter() - start
+    start = time.perf_counter()
+    parallel_state, parallel_results, reexecuted = execute_block(state, txs, jobs=args.jobs)
+    parallel_time = time.perf_counter() - start
+
+    same = parallel_state.to_json() == serial_state.to_json() and parallel_results == serial_results
+    print(f"{len(txs)} txs, {len(reexecuted)} re-executed: serial {serial_time:.2f}s, "
+          f"{args.jobs} jobs {parallel_time:.2f}s, {'matches' if same else 'DIFFERS FROM'} serial")
+    return 0 if same else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,236 @@
+from collections import OrderedDict
+import sys
+import threading
+import evm_analysis
+from evm_gas import STATIC_COSTS
+from evm_keccak import keccak256
+
+# size estimates for CodeCache: containers with the objects they hold.
+# Small ints, bools and None are shared by the whole interpreter and cost
+# an entry nothing.
+
+def objects_size(items):
+    size = sys.getsizeof(items)
+    for x in items:
+        if type(x) is int:
+            if not -5 <= x <= 256:
+                size += sys.getsizeof(x)
+        elif x is not None and type(x) is not bool:
+            size += sys.getsizeof(x)
+    return size
+
+def program_size(program):
+    # targets maps pcs (its keys) to instruction indices
+    size = objects_size(program.ops) + objects_size(program.args) + objects_size(program.pcs)
+    return size + objects_size(program.targets) + sum(sys.getsizeof(i) for i in program.targets.values() if i > 256)
+
+def cfg_size(cfg):
+    size = program_size(cfg.program) + sys.getsizeof(cfg.succs) + sum(map(objects_size, cfg.succs))
+    for items in (cfg.starts, cfg.ends, cfg.need, cfg.limit, cfg.lo, cfg.hi, cfg.checked):
+        size += objects_size(items)
+    return size
+
+def blocks_size(blocks):
+    # the block functions and their code objects, and the namespace they
+    # were all compiled into
+    size = sys.getsizeof(blocks) + sum(sys.getsizeof(f) + sys.getsizeof(f.__code__) for f in blocks)
+    return size + sys.getsizeof(blocks[0].__globals__) if blocks else size
+
+class CodeEntry:
+    # everything derived from one piece of bytecode, each part worked out
+    # the first time something asks for it: EXTCODEHASH only wants the hash
+    # and must not pay for decoding and analysis
+    __slots__ = ('code', 'cache', '_hash', 'jumpdests', '_cfg', '_program', 'metered', 'runs', 'compiled',
+                 'size', 'constructor_inputs')
+
+    def __init__(self, code, cache):
+        self.code = code
+        # the CodeCache holding the entry, told as the entry grows
+        self.cache = cache
+        self._hash = None
+        self.jumpdests = None
+        self._cfg = None
+        self._program = None
+        # the gas-metered form is only built once something runs it metered
+        self.metered = None
+        # executions so far and the compiled block functions, unmetered and
+        # metered, see evm_compile.promote()
+        self.runs = 0
+        self.compiled = [None, None]
+        # estimated bytes held, grown by what gets added later
+        self.size = sys.getsizeof(self) + sys.getsizeof(code)
+        # evm_analysis.constructor_inputs(), worked out the first time the
+        # code runs as initcode
+        self.constructor_inputs = False
+
+    @property
+    def hash(self):
+        # keccak of the code, for EXTCODEHASH and create_cache; only worked
+        # out when something asks
+        code_hash = self._hash
+        if code_hash is None:
+            code_hash = self._hash = keccak256(self.code)
+        return code_hash
+
+    @property
+    def cfg(self):
+        cfg = self._cfg
+        if cfg is None:
+            code = self.code
+            jumpdests = evm_analysis.jumpdests(code)
+            cfg = evm_analysis.analyze(evm_analysis.decode(code, jumpdests), code)
+            cfg = self._fill('_cfg', cfg, sys.getsizeof(jumpdests) + cfg_size(cfg), jumpdests)
+        return cfg
+
+    @property
+    def program(self):
+        # the unmetered program, what a first execution runs
+        program = self._program
+        if program is None:
+            program = evm_analysis.instrument(self.cfg, self.code)
+            program = self._fill('_program', program, program_size(program))
+        return program
+
+    def _fill(self, slot, value, extra, jumpdests=None):
+        # keeps value in slot unless another thread got there first;
+        # returns the one kept
+        cache = self.cache
+        with cache.lock:
+            kept = getattr(self, slot)
+            if kept is not None:
+                return kept
+            setattr(self, slot, value)
+            if jumpdests is not None:
+                self.jumpdests = jumpdests
+            cache._grow(self, extra)
+        return value
+
+class CodeCache:
+    # LRU keyed by the code itself, bounded by the estimated size of its
+    # entries: the code, its analysis, its programs and compiled blocks,
+    # each counted with the objects it holds. A dict lookup on bytes costs one pass of Python's string
+    # hash (cached on the object after that), far less than a keccak, and
+    # keeps hashing code off the way to the first instruction. Shared by
+    # every execution context, so lookups hold a lock; entries themselves
+    # are only ever filled in, never changed.
+    def __init__(self, max_size=64 * 1024 * 1024):
+        self.lock = threading.Lock()
+        self.max_size = max_size
+        self.size = 0
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, code):
+        with self.lock:
+            entry = self.entries.get(code)
+            if entry is not None:
+                self.hits += 1
+                self.entries.move_to_end(code)
+                return entry
+            self.misses += 1
+            entry = CodeEntry(code, self)
+            self.entries[code] = entry
+            self.size += entry.size
+            while self.size > self.max_size and len(self.entries) > 1:
+                _, old = self.entries.popitem(last=False)
+                self.size -= old.size
+                self.evictions += 1
+            return entry
+
+    def metered_program(self, entry):
+        if entry.metered is None:
+            program = evm_analysis.instrument(entry.cfg, entry.code, STATIC_COSTS)
+            extra = program_size(program)
+            with self.lock:
+                if entry.metered is None:
+                    entry.metered = program
+                    self._grow(entry, extra)
+        return entry.metered
+
+    def set_compiled(self, entry, metered, blocks):
+        # keeps blocks as entry's compiled form unless another thread got
+        # there first; returns the one kept
+        extra = blocks_size(blocks)
+        with self.lock:
+            if entry.compiled[metered] is None:
+                entry.compiled[metered] = blocks
+                self._grow(entry, extra)
+            return entry.compiled[metered]
+
+    def _grow(self, entry, extra):
+        # under the lock; entries already evicted only grow themselves
+        entry.size += extra
+        if self.entries.get(entry.code) is entry:
+            self.size += extra
+
+    def stats(self):
+        return {
+            'entries': len(self.entries),
+            'size': self.size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+code_cache = CodeCache()
+
+class CreateResult:
+    # what a replayable constructor did: the runtime code it returned, the
+    # storage it left in its new account and the slots it touched there,
+    # its logs as (topics, data), the gas it used and the least gas it can
+    # be replayed with (both None unmetered)
+    __slots__ = ('code', 'storage', 'warm', 'logs', 'gas_used', 'min_gas')
+
+    def __init__(self, code, storage, warm, logs, gas_used, min_gas):
+        self.code = code
+        self.storage = storage
+        self.warm = warm
+        self.logs = logs
+        self.gas_used = gas_used
+        self.min_gas = min_gas
+
+class CreateCache:
+    # LRU from (initcode hash, metered, the context values the initcode
+    # reads) to the CreateResult of running it, so a factory deploying the
+    # same template again and again runs its constructor once. Shared like
+    # code_cache.
+    def __init__(self, max_entries=4096):
+        self.lock = threading.Lock()
+        self.max_entries = max_entries
+        self.results = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self.lock:
+            result = self.results.get(key)
+            if result is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.results.move_to_end(key)
+            return result
+
+    def put(self, key, result):
+        with self.lock:
+            self.results[key] = result
+            while len(self.results) > self.max_entries:
+                self.results.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.results.clear()
+
+    def stats(self):
+        return {
+            'entries': len(self.results),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+create_cache = CreateCache()
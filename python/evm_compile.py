@@ -0,0 +1,334 @@
+#!/usr/bin/env python3
+
+# Compilation tier: each basic block of a hot contract becomes a generated
+# Python function. Stack items the block produces and consumes live in
+# local variables, PUSH constants are folded, arithmetic and memory
+# opcodes are inlined and everything else calls the interpreter's handler
+# with the stack spilled first. A block function returns the index of the
+# block to run next, or None when execution halts.
+#
+#   python3 evm_compile.py          # compare against the interpreter
+
+import os
+import sys
+import evm_codes
+import evm_word
+from evm_gas import OutOfGas, STATIC_COSTS
+from evm_analysis import STACK_EFFECTS, first_arg
+from evm_cache import code_cache
+
+def build_inline():
+    # pure operations: expression templates over operands {0} (the top of
+    # the stack), {1}, ...; constant operands fold at compile time
+    pure = {
+        evm_codes.ADD: '({0} + {1}) & MASK',
+        evm_codes.MUL: '({0} * {1}) & MASK',
+        evm_codes.SUB: '({0} - {1}) & MASK',
+        evm_codes.DIV: '({0} // {1} if {1} else 0)',
+        evm_codes.SDIV: 'sdiv({0}, {1})',
+        evm_codes.MOD: '({0} % {1} if {1} else 0)',
+        evm_codes.SMOD: 'smod({0}, {1})',
+        evm_codes.ADDMOD: '(({0} + {1}) % {2} if {2} else 0)',
+        evm_codes.MULMOD: '(({0} * {1}) % {2} if {2} else 0)',
+        evm_codes.EXP: 'pow({0}, {1}, MOD)',
+        evm_codes.SIGNEXTEND: 'signextend({0}, {1})',
+        evm_codes.LT: 'int({0} < {1})',
+        evm_codes.GT: 'int({0} > {1})',
+        evm_codes.SLT: 'slt({0}, {1})',
+        evm_codes.SGT: 'sgt({0}, {1})',
+        evm_codes.EQ: 'int({0} == {1})',
+        evm_codes.ISZERO: 'int({0} == 0)',
+        evm_codes.AND: '({0} & {1})',
+        evm_codes.OR: '({0} | {1})',
+        evm_codes.XOR: '({0} ^ {1})',
+        evm_codes.NOT: '({0} ^ MASK)',
+        evm_codes.BYTE: 'byte({0}, {1})',
+        evm_codes.SHL: 'shl({0}, {1})',
+        evm_codes.SHR: 'shr({0}, {1})',
+        evm_codes.SAR: 'sar({0}, {1})',
+    }
+    # reads of frame state, never folded
+    reads = {
+        evm_codes.MLOAD: 'memory.read_word({0})',
+        evm_codes.SLOAD: 'storage.get({0}, 0)',
+    }
+    writes = {
+        evm_codes.MSTORE: 'memory.write_word({0}, {1})',
+        evm_codes.MSTORE8: 'memory.write_byte({0}, {1})',
+    }
+    return pure, reads, writes
+
+PURE, READS, WRITES = build_inline()
+
+# handlers that may halt the frame to run a sub-call (see evm.drive)
+SUSPENDS = frozenset([
+    evm_codes.CREATE, evm_codes.CREATE2, evm_codes.CALL, evm_codes.CALLCODE,
+    evm_codes.DELEGATECALL, evm_codes.STATICCALL,
+])
+
+GLOBALS = {
+    'MASK': evm_word.MASK,
+    'MOD': evm_word.MOD,
+    'sdiv': evm_word.sdiv,
+    'smod': evm_word.smod,
+    'signextend': evm_word.signextend,
+    'slt': evm_word.slt,
+    'sgt': evm_word.sgt,
+    'byte': evm_word.byte,
+    'shl': evm_word.shl,
+    'shr': evm_word.shr,
+    'sar': evm_word.sar,
+    'OutOfGas': OutOfGas,
+}
+
+class BlockWriter:
+    # emits one block function. stack holds what the block has pushed but
+    # not yet written back: ('c', value) for constants, ('v', name) for
+    # locals, bottom first, sitting on top of the frame's real stack
+    def __init__(self, index):
+        self.lines = []
+        self.stack = []
+        self.names = 0
+        self.uses = set()
+        self.index = index
+
+    def emit(self, line):
+        self.lines.append('    ' + line)
+
+    def fresh(self):
+        self.names += 1
+        return f'v{self.names}'
+
+    def pull(self, n):
+        # moves real stack items into locals until n items are virtual
+        while len(self.stack) < n:
+            name = self.fresh()
+            self.uses.add('items')
+            self.emit(f'{name} = items.pop()')
+            self.stack.insert(0, ('v', name))
+
+    def operands(self, n):
+        self.pull(n)
+        vals = self.stack[:-n - 1:-1]
+        del self.stack[-n:]
+        return vals
+
+    def spill(self):
+        if self.stack:
+            self.uses.add('items')
+            self.emit(f"items.extend(({', '.join(render(x) for x in self.stack)},))")
+            self.stack.clear()
+
+    def jump(self, dest, blocks):
+        # lines for a jump to dest, a constant or a local
+        if dest[0] == 'c':
+            target = blocks.get(dest[1])
+            return ['return halt(frame)' if target is None else f'return {target}']
+        return [f'target = JUMPS.get({dest[1]})',
+                'if target is None:',
+                '    return halt(frame)',
+                'return target']
+
+    def source(self):
+        prologue = []
+        if 'items' in self.uses:
+            prologue.append('    items = frame.stack.items')
+        if 'memory' in self.uses:
+            prologue.append('    memory = frame.memory')
+        if 'storage' in self.uses:
+            prologue.append('    storage = frame.storage')
+        return '\n'.join([f'def b{self.index}(frame):'] + prologue + self.lines)
+
+def render(x):
+    return str(x[1])
+
+def block_source(cfg, code, b, metered, inline, blocks):
+    program = cfg.program
+    pcs = program.pcs
+    start, end = cfg.starts[b], cfg.ends[b]
+    w = BlockWriter(b)
+    if metered:
+        cost = sum(STATIC_COSTS[code[pcs[i]]] for i in range(start, end))
+        if cost:
+            w.emit(f'frame.gas -= {cost}')
+            w.emit('if frame.gas < 0:')
+            w.emit('    raise OutOfGas()')
+    if cfg.checked[b]:
+        w.uses.add('items')
+        w.emit('height = len(items)')
+        w.emit(f'if height < {cfg.need[b]} or height > {cfg.limit[b]}:')
+        w.emit('    return halt(frame)')
+
+    for i in range(start, end):
+        pc = pcs[i]
+        op = code[pc]
+        if evm_codes.PUSH0 <= op <= evm_codes.PUSH32:
+            w.stack.append(('c', first_arg(program, i)))
+        elif evm_codes.DUP1 <= op <= evm_codes.DUP16:
+            n = op - evm_codes.DUP1 + 1
+            w.pull(n)
+            w.stack.append(w.stack[-n])
+        elif evm_codes.SWAP1 <= op <= evm_codes.SWAP16:
+            n = op - evm_codes.SWAP1 + 1
+            w.pull(n + 1)
+            w.stack[-1], w.stack[-1 - n] = w.stack[-1 - n], w.stack[-1]
+        elif op == evm_codes.POP:
+            w.operands(1)
+        elif op == evm_codes.JUMPDEST:
+            pass
+        elif op == evm_codes.PC:
+            w.stack.append(('c', pc))
+        elif op in PURE and op in inline:
+            vals = w.operands(STACK_EFFECTS[op][0])
+            expr = PURE[op].format(*(render(x) for x in vals))
+            if all(x[0] == 'c' for x in vals):
+                w.stack.append(('c', eval(expr, GLOBALS)))
+            else:
+                name = w.fresh()
+                w.emit(f'{name} = {expr}')
+                w.stack.append(('v', name))
+        elif op in READS and op in inline:
+            vals = w.operands(1)
+            w.uses.add('memory' if op == evm_codes.MLOAD else 'storage')
+            name = w.fresh()
+            w.emit(f'{name} = {READS[op].format(render(vals[0]))}')
+            w.stack.append(('v', name))
+        elif op in WRITES:
+            vals = w.operands(2)
+            w.uses.add('memory')
+            w.emit(WRITES[op].format(*(render(x) for x in vals)))
+        elif op == evm_codes.JUMP:
+            dest = w.operands(1)[0]
+            w.spill()
+            for line in w.jump(dest, blocks):
+                w.emit(line)
+            return w.source()
+        elif op == evm_codes.JUMPI:
+            dest, cond = w.operands(2)
+            w.spill()
+            if cond[0] == 'c':
+                if cond[1]:
+                    for line in w.jump(dest, blocks):
+                        w.emit(line)
+                    return w.source()
+            else:
+                w.emit(f'if {cond[1]}:')
+                for line in w.jump(dest, blocks):
+                    w.emit('    ' + line)
+        elif op == evm_codes.STOP:
+            w.spill()
+            w.emit('return None')
+            return w.source()
+        else:
+            w.spill()
+            if op in SUSPENDS:
+                # ends the block; a sub-call halts the frame, which carries
+                # on from the next block once the callee returns
+                w.emit(f'frame.ip = {b + 1 if b + 1 < len(cfg.starts) else None}')
+            w.emit(f'if h{op}(frame, {first_arg(program, i)!r}):')
+            w.emit('    return None')
+
+    w.spill()
+    w.emit(f'return {b + 1}' if b + 1 < len(cfg.starts) else 'return None')
+    return w.source()
+
+def compile_blocks(cfg, code, tables, metered):
+    # the list of block functions for cfg, dispatching through tables (the
+    # interpreter's (unmetered, metered) pair) for what is not inlined
+    table = tables[1] if metered else tables[0]
+    # opcodes with a dynamic gas cost go through their metered handler
+    inline = {op for op in list(PURE) + list(READS) if not metered or tables[1][op] is tables[0][op]}
+    block_at = {start: b for b, start in enumerate(cfg.starts)}
+    blocks = {pc: block_at[t] for pc, t in cfg.program.targets.items()}
+    invalid = table[evm_codes.INVALID]
+
+    def halt(frame):
+        invalid(frame, None)
+        return None
+
+    namespace = dict(GLOBALS, JUMPS=blocks, halt=halt)
+    for op in range(256):
+        namespace[f'h{op}'] = table[op]
+    sources = [block_source(cfg, code, b, metered, inline, blocks) for b in range(len(cfg.starts))]
+    exec(compile('\n\n'.join(sources), f'<evm block code {code[:8].hex()}>', 'exec'), namespace)
+    return [namespace[f'b{b}'] for b in range(len(cfg.starts))]
+
+def promote(entry, metered, tables, after):
+    # counts executions of entry's code; once it has run after times, its
+    # blocks are compiled (once per metered/unmetered) and kept on the entry
+    entry.runs += 1
+    if entry.runs <= after or not entry.cfg.starts:
+        return None
+    blocks = entry.compiled[metered]
+    if blocks is None:
+        blocks = code_cache.set_compiled(entry, metered, compile_blocks(entry.cfg, entry.code, tables, metered))
+    return blocks
+
+def outcome(code, tx, block, state, gas, after):
+    # what a run leaves behind, with compile_after set to after; a failed
+    # frame's stack and logs are not part of its result
+    import evm
+    from evm_state import WorldState
+    vm = evm.EVM(WorldState.from_json(state), after)
+    try:
+        frame = vm.run(code, tx, block, {}, gas)
+    except (OverflowError, MemoryError) as e:
+        # unmetered memory expansion past what the host can allocate
+        return (type(e).__name__,)
+    ret = frame.ret.hex() if frame.ret is not None else None
+    if not frame.success:
+        return (False, ret, frame.gas, vm.state.to_json())
+    return (True, frame.stack.to_list(), frame.log, ret, frame.gas, vm.state.to_json())
+
+FUZZ_OPS = [
+    0x00, 0x01, 0x02, 0x03, 0x04, 0x05, 0x06, 0x07, 0x08, 0x0a, 0x0b, 0x10, 0x11, 0x12, 0x13, 0x14,
+    0x15, 0x16, 0x17, 0x18, 0x19, 0x1a, 0x1b, 0x1c, 0x1d, 0x20, 0x30, 0x35, 0x36, 0x37, 0x38, 0x39,
+    0x50, 0x51, 0x52, 0x53, 0x54, 0x55, 0x56, 0x57, 0x58, 0x59, 0x5a, 0x5b, 0x5b, 0x5f, 0x80, 0x81,
+    0x82, 0x8f, 0x90, 0x91, 0x9f, 0xa0, 0xa2, 0xf3, 0xfd, 0xfe,
+]
+
+def fuzz_corpus(n, seed=0):
+    # random straight-line and looping bytecode, biased towards small
+    # pushes so jumps often land on a JUMPDEST
+    import random
+    rng = random.Random(seed)
+    for _ in range(n):
+        code = bytearray()
+        for _ in range(rng.randrange(1, 80)):
+            r = rng.random()
+            if r < 0.3:
+                code += bytes([evm_codes.PUSH1, rng.randrange(0, 48)])
+            elif r < 0.33:
+                code += bytes([evm_codes.PUSH32]) + rng.getrandbits(256).to_bytes(32, 'big')
+            else:
+                code.append(rng.choice(FUZZ_OPS))
+        yield bytes(code)
+
+def main():
+    import evm_fixtures
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'evm.json')
+    fixtures = evm_fixtures.load(path)
+    mismatches = 0
+    for case in fixtures:
+        test = case.test
+        args = (case.code, test.get('tx'), test.get('block'), test.get('state'))
+        if outcome(*args, None, None) != outcome(*args, None, 0):
+            mismatches += 1
+            print("fixture differs:", test['name'])
+    tx = {"to": "0x1000000000000000000000000000000000000c0d", "data": "0102030405"}
+    corpus = 0
+    for code in fuzz_corpus(5000):
+        # unmetered code can loop forever, so only metered runs may jump
+        runs = [100000]
+        if evm_codes.JUMP not in code and evm_codes.JUMPI not in code:
+            runs.append(None)
+        for gas in runs:
+            corpus += 1
+            if outcome(code, tx, {}, None, gas, None) != outcome(code, tx, {}, None, gas, 0):
+                mismatches += 1
+                print("fuzz case differs:", code.hex(), "gas", gas)
+    print(f"{len(fixtures)} fixtures and {corpus} fuzz runs compared, {mismatches} mismatches")
+    return 1 if mismatches else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
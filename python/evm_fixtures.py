@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+
+# Fixture files (evm.json and the like) through a binary cache kept in
+# __pycache__ next to them, so short runs skip json.load and bytes.fromhex.
+# The cache holds each case's bytecode already decoded and the case itself
+# marshalled on its own, unpacked only when something looks at it. It is
+# used while the fixture's mtime and size match those it was built from,
+# or failing that its sha256 does; otherwise it is built again. Caches
+# that cannot be written (read-only checkouts) are simply skipped.
+#
+#   cases = evm_fixtures.load('../evm.json')
+#   cases[3].code, cases[3].test['expect']
+#
+#   python3 evm_fixtures.py ../evm.json      # build or refresh caches
+
+import importlib.util
+import marshal
+import os
+import struct
+import sys
+
+# pinned to the interpreter like a .pyc, marshal's format changes with it
+MAGIC = b'EVMFIX\0\1' + importlib.util.MAGIC_NUMBER
+# magic, source mtime_ns, source size, source sha256
+HEADER = struct.Struct(f'>{len(MAGIC)}sQQ32s')
+
+class Case:
+    __slots__ = ('code', '_blob', '_test')
+
+    def __init__(self, code, blob=None, test=None):
+        # bytecode as bytes
+        self.code = code
+        self._blob = blob
+        self._test = test
+
+    @property
+    def test(self):
+        # the fixture's JSON object
+        test = self._test
+        if test is None:
+            test = self._test = marshal.loads(self._blob)
+            self._blob = None
+        return test
+
+def _sha256(data):
+    # hashlib (and json below) only load when a cache has to be checked or
+    # built, not on the way to a current one
+    import hashlib
+    return hashlib.sha256(data).digest()
+
+def cache_path(path):
+    head, tail = os.path.split(os.path.abspath(path))
+    return os.path.join(head, '__pycache__', tail + '.evmfix')
+
+def load(path):
+    # the Cases of a fixture file, from its cache when that is current
+    st = os.stat(path)
+    cached = cache_path(path)
+    try:
+        with open(cached, 'rb') as f:
+            data = f.read()
+    except OSError:
+        data = b''
+    if len(data) >= HEADER.size:
+        magic, mtime, size, digest = HEADER.unpack_from(data)
+        if magic == MAGIC:
+            if mtime == st.st_mtime_ns and size == st.st_size:
+                return _cases(data)
+            with open(path, 'rb') as f:
+                source = f.read()
+            if _sha256(source) == digest:
+                # touched but not changed: only the header is stale
+                _write(cached, HEADER.pack(MAGIC, st.st_mtime_ns, st.st_size, digest) + data[HEADER.size:])
+                return _cases(data)
+    with open(path, 'rb') as f:
+        source = f.read()
+    import json
+    tests = json.loads(source)
+    cases = [Case(bytes.fromhex(test['code']['bin']), test=test) for test in tests]
+    body = marshal.dumps([(case.code, marshal.dumps(case.test)) for case in cases])
+    _write(cached, HEADER.pack(MAGIC, st.st_mtime_ns, st.st_size, _sha256(source)) + body)
+    return cases
+
+def _cases(data):
+    return [Case(code, blob) for code, blob in marshal.loads(memoryview(data)[HEADER.size:])]
+
+def _write(cached, data):
+    # written aside and renamed, so a concurrent reader never sees half
+    tmp = f'{cached}.{os.getpid()}'
+    try:
+        os.makedirs(os.path.dirname(cached), exist_ok=True)
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, cached)
+    except OSError:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+
+def main(argv=None):
+    paths = (argv if argv is not None else sys.argv[1:]) or [
+        os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'evm.json')]
+    for path in paths:
+        cases = load(path)
+        print(f"{cache_path(path)}: {len(cases)} cases")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,91 @@
+import evm_codes
+
+class OutOfGas(Exception):
+    pass
+
+# Shanghai schedule (EIP-2929 access lists, EIP-3860 initcode metering)
+G_ZERO = 0
+G_JUMPDEST = 1
+G_BASE = 2
+G_VERYLOW = 3
+G_LOW = 5
+G_MID = 8
+G_HIGH = 10
+G_WARM_ACCESS = 100
+G_COLD_ACCOUNT_ACCESS = 2600
+G_COLD_SLOAD = 2100
+G_SSET = 20000
+G_SRESET = 2900
+G_CALL_STIPEND = 2300
+G_CALL_VALUE = 9000
+G_NEW_ACCOUNT = 25000
+G_SELFDESTRUCT = 5000
+G_CREATE = 32000
+G_CODE_DEPOSIT = 200
+G_INITCODE_WORD = 2
+G_EXP = 10
+G_EXP_BYTE = 50
+G_KECCAK = 30
+G_KECCAK_WORD = 6
+G_COPY = 3
+G_LOG = 375
+G_LOG_TOPIC = 375
+G_LOG_DATA = 8
+G_BLOCKHASH = 20
+G_MEMORY = 3
+G_QUAD_DIVISOR = 512
+
+def build_static_costs():
+    # the part of each opcode's cost known before it runs; everything that
+    # depends on operands is charged by the handler
+    costs = [0] * 256
+    for op in (evm_codes.ADD, evm_codes.SUB, evm_codes.LT, evm_codes.GT, evm_codes.SLT,
+               evm_codes.SGT, evm_codes.EQ, evm_codes.ISZERO, evm_codes.AND, evm_codes.OR,
+               evm_codes.XOR, evm_codes.NOT, evm_codes.BYTE, evm_codes.SHL, evm_codes.SHR,
+               evm_codes.SAR, evm_codes.CALLDATALOAD, evm_codes.MLOAD, evm_codes.MSTORE,
+               evm_codes.MSTORE8, evm_codes.CALLDATACOPY, evm_codes.CODECOPY,
+               evm_codes.RETURNDATACOPY):
+        costs[op] = G_VERYLOW
+    for op in (evm_codes.MUL, evm_codes.DIV, evm_codes.SDIV, evm_codes.MOD, evm_codes.SMOD,
+               evm_codes.SIGNEXTEND, evm_codes.SELFBALANCE):
+        costs[op] = G_LOW
+    for op in (evm_codes.ADDMOD, evm_codes.MULMOD, evm_codes.JUMP):
+        costs[op] = G_MID
+    for op in (evm_codes.ADDRESS, evm_codes.ORIGIN, evm_codes.CALLER, evm_codes.CALLVALUE,
+               evm_codes.CALLDATASIZE, evm_codes.CODESIZE, evm_codes.GASPRICE,
+               evm_codes.RETURNDATASIZE, evm_codes.COINBASE, evm_codes.TIMESTAMP,
+               evm_codes.NUMBER, evm_codes.DIFFICULTY, evm_codes.GASLIMIT, evm_codes.CHAINID,
+               evm_codes.BASEFEE, evm_codes.POP, evm_codes.PC, evm_codes.MSIZE, evm_codes.GAS,
+               evm_codes.PUSH0):
+        costs[op] = G_BASE
+    for op in (evm_codes.BALANCE, evm_codes.EXTCODESIZE, evm_codes.EXTCODECOPY,
+               evm_codes.EXTCODEHASH, evm_codes.SLOAD, evm_codes.CALL, evm_codes.CALLCODE,
+               evm_codes.DELEGATECALL, evm_codes.STATICCALL):
+        costs[op] = G_WARM_ACCESS
+    for op in range(evm_codes.PUSH1, evm_codes.SWAP16 + 1):
+        costs[op] = G_VERYLOW
+    for op in range(evm_codes.LOG0, evm_codes.LOG4 + 1):
+        costs[op] = G_LOG + G_LOG_TOPIC * (op - evm_codes.LOG0)
+    costs[evm_codes.JUMPI] = G_HIGH
+    costs[evm_codes.JUMPDEST] = G_JUMPDEST
+    costs[evm_codes.EXP] = G_EXP
+    costs[evm_codes.SHA3] = G_KECCAK
+    costs[evm_codes.BLOCKHASH] = G_BLOCKHASH
+    costs[evm_codes.CREATE] = G_CREATE
+    costs[evm_codes.CREATE2] = G_CREATE
+    costs[evm_codes.SELFDESTRUCT] = G_SELFDESTRUCT
+    return costs
+
+STATIC_COSTS = build_static_costs()
+
+def words(size):
+    return (size + 31) // 32
+
+def memory_cost(size):
+    # total cost of memory holding size bytes
+    w = words(size)
+    return G_MEMORY * w + w * w // G_QUAD_DIVISOR
+
+def all_but_one_64th(gas):
+    # EIP-150: a sub-call can be given at most this much of what is left
+    return gas - gas // 64
@@ -0,0 +1,68 @@
+from evm_memo import BoundedMemo
+
+# inputs up to this size go through the memo: Solidity mapping slots hash
+# a 64-byte (key, slot) pair, and the same pairs come back again and again
+MEMO_MAX_INPUT = 64
+
+# the backend, picked the first time anything is hashed rather than at
+# import so runs that never hash never load one: pycryptodome directly when
+# installed, else whatever eth_hash finds (its probing alone costs tens of
+# milliseconds). _hash_view also takes memoryviews without a copy.
+_hash = None
+_hash_view = None
+
+def _pick():
+    global _hash, _hash_view
+    try:
+        from Crypto.Hash import keccak as pycryptodome_keccak
+    except ImportError:
+        from eth_hash.auto import keccak as backend
+        # eth_hash only takes bytes
+        def view_backend(data):
+            return backend(data if type(data) is bytes else bytes(data))
+    else:
+        def backend(data):
+            return pycryptodome_keccak.new(digest_bits=256, data=data).digest()
+        view_backend = backend
+    _hash = backend
+    _hash_view = view_backend
+
+def keccak(data):
+    # digest of bytes
+    if _hash is None:
+        _pick()
+    return _hash(data)
+
+def keccak256(data):
+    # digest of bytes or a memoryview, hashed in place when the backend can
+    if _hash_view is None:
+        _pick()
+    return _hash_view(data)
+
+class KeccakMemo(BoundedMemo):
+    # short inputs to their hash as a stack word
+    def __init__(self, max_entries=65536):
+        super().__init__(max_entries)
+
+    def word(self, data):
+        # keccak of data as an int, what SHA3 pushes
+        if len(data) > MEMO_MAX_INPUT:
+            return int.from_bytes(keccak256(data), byteorder='big')
+        key = bytes(data)
+        word = self.get(key)
+        if word is None:
+            word = int.from_bytes(keccak(key), byteorder='big')
+            self.put(key, word)
+        return word
+
+    def batch(self, inputs):
+        # words for many inputs at once, short ones remembered for later SHA3s
+        return [self.word(data) for data in inputs]
+
+    def mapping_slots(self, keys, slot):
+        # storage slots of mapping[key] for a mapping declared at slot, the
+        # keccak(key . slot) inputs primed in the memo
+        suffix = slot.to_bytes(32, byteorder='big')
+        return self.batch([key.to_bytes(32, byteorder='big') + suffix for key in keys])
+
+keccak_memo = KeccakMemo()
@@ -0,0 +1,118 @@
+# Logs as LOG0-LOG4 produce them: int address and topics, raw bytes data.
+# A run buffers the logs of all its frames in one list, dropping those of
+# frames that fail, and hands what is left of a successful transaction to
+# the execution context's sink. Sinks keep the 2048-bit logs bloom of
+# everything they were given, so a reader can skip what cannot match
+# without decoding any entries.
+#
+#   sink = StreamSink(open('logs.bin', 'wb'))
+#   evm.EVM(state, sink=sink).run(code, tx, block, None)
+#   for log in read_logs(open('logs.bin', 'rb')): ...
+
+import struct
+from evm_keccak import keccak_memo
+
+BLOOM_BITS = 2048
+
+class Log:
+    __slots__ = ('address', 'topics', 'data')
+
+    def __init__(self, address, topics, data):
+        self.address = address
+        # tuple of ints
+        self.topics = topics
+        self.data = data
+
+    def __eq__(self, other):
+        return (isinstance(other, Log) and self.address == other.address and self.topics == other.topics
+                and self.data == other.data)
+
+    def __repr__(self):
+        return f"Log({self.address:#x}, {self.topics!r}, {self.data!r})"
+
+    def to_json(self):
+        # the evm.json shape
+        return {
+            "address": '0x%040x' % self.address,
+            "data": self.data.hex(),
+            "topics": [hex(t) for t in self.topics],
+        }
+
+    def encode(self):
+        # address, topic count, topics, data length, data
+        return b''.join((self.address.to_bytes(20, byteorder='big'), bytes((len(self.topics),)),
+                         *(t.to_bytes(32, byteorder='big') for t in self.topics),
+                         struct.pack('>I', len(self.data)), self.data))
+
+def read_logs(f):
+    # the Logs a StreamSink wrote to the binary file f, one at a time
+    while True:
+        head = f.read(21)
+        if not head:
+            return
+        topics = tuple(int.from_bytes(f.read(32), byteorder='big') for _ in range(head[20]))
+        size, = struct.unpack('>I', f.read(4))
+        yield Log(int.from_bytes(head[:20], byteorder='big'), topics, f.read(size))
+
+def bloom_mask(item):
+    # the three bloom bits for item (an address or topic, as bytes): 11
+    # bits each from the first three byte pairs of its keccak
+    h = keccak_memo.word(item)
+    return (1 << ((h >> 240) & 0x7ff)) | (1 << ((h >> 224) & 0x7ff)) | (1 << ((h >> 208) & 0x7ff))
+
+class LogsBloom:
+    __slots__ = ('bits',)
+
+    def __init__(self, bits=0):
+        self.bits = bits
+
+    def add(self, log):
+        bits = self.bits | bloom_mask(log.address.to_bytes(20, byteorder='big'))
+        for topic in log.topics:
+            bits |= bloom_mask(topic.to_bytes(32, byteorder='big'))
+        self.bits = bits
+
+    def might_contain(self, address=None, topics=()):
+        # False means no log added has address and all of topics
+        mask = 0
+        if address is not None:
+            mask |= bloom_mask(address.to_bytes(20, byteorder='big'))
+        for topic in topics:
+            mask |= bloom_mask(topic.to_bytes(32, byteorder='big'))
+        return self.bits & mask == mask
+
+    def to_bytes(self):
+        return self.bits.to_bytes(BLOOM_BITS // 8, byteorder='big')
+
+class LogSink:
+    # gets emit(log) for each log of every successful transaction, in
+    # order; keeps count and the bloom of everything so far. Subclasses
+    # do something with each log in write().
+    def __init__(self):
+        self.bloom = LogsBloom()
+        self.count = 0
+
+    def emit(self, log):
+        self.bloom.add(log)
+        self.count += 1
+        self.write(log)
+
+    def write(self, log):
+        pass
+
+class ListSink(LogSink):
+    def __init__(self):
+        super().__init__()
+        self.logs = []
+
+    def write(self, log):
+        self.logs.append(log)
+
+class StreamSink(LogSink):
+    # Log.encode() records to a binary file, see read_logs()
+    def __init__(self, out):
+        super().__init__()
+        self.out = out
+
+    def write(self, log):
+        self.out.write(log.encode())
@@ -0,0 +1,65 @@
+import threading
+
+class BoundedMemo:
+    # bounded map from inputs to results worked out from them, shared by
+    # every thread: lookups need no lock, adding does. When it is full the
+    # oldest entry goes. Full means max_entries entries or, with max_size
+    # given, max_size in total over the sizes put() was given; an entry
+    # bigger than that on its own is not kept at all.
+    def __init__(self, max_entries, max_size=None):
+        self.lock = threading.Lock()
+        self.max_entries = max_entries
+        self.max_size = max_size
+        self.entries = {}
+        # size of each entry, only kept when max_size is set
+        self.sizes = {}
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        # the result for key, None if there is none
+        value = self.entries.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def put(self, key, value, size=0):
+        max_size = self.max_size
+        if max_size is not None and size > max_size:
+            return
+        entries = self.entries
+        with self.lock:
+            if key in entries:
+                return
+            while entries and (len(entries) >= self.max_entries
+                               or max_size is not None and self.size + size > max_size):
+                old = next(iter(entries))
+                del entries[old]
+                if max_size is not None:
+                    self.size -= self.sizes.pop(old)
+                self.evictions += 1
+            entries[key] = value
+            if max_size is not None:
+                self.sizes[key] = size
+                self.size += size
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.sizes.clear()
+            self.size = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self.entries),
+            'size': self.size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
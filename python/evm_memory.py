@@ -0,0 +1,82 @@
+from evm_gas import OutOfGas, memory_cost
+
+# memory never grows past this: at 2**32 bytes expansion alone costs over
+# 3 * 10**13 gas, so no metered frame gets there, and unmetered ones fail
+# like running out of gas rather than trying to allocate 2**256 bytes
+MAX_MEMORY = 1 << 32
+
+class Memory:
+    # byte-addressed memory, always sized in whole 32-byte words so that
+    # len(memory) is MSIZE
+    __slots__ = ('data',)
+
+    def __init__(self):
+        self.data = bytearray()
+
+    def __len__(self):
+        return len(self.data)
+
+    def expand(self, offset, size):
+        if size == 0:
+            return
+        end = offset + size
+        if end > len(self.data):
+            if end > MAX_MEMORY:
+                raise OutOfGas()
+            self.data.extend(bytes((end + 31) // 32 * 32 - len(self.data)))
+
+    def read(self, offset, size):
+        # the returned view must be released (or copied with bytes()) before
+        # memory grows again, bytearray cannot resize while it is exported.
+        # A zero-size read touches nothing, whatever its offset.
+        if size == 0:
+            return memoryview(b'')
+        self.expand(offset, size)
+        return memoryview(self.data)[offset:offset + size]
+
+    def read_word(self, offset):
+        self.expand(offset, 32)
+        return int.from_bytes(self.data[offset:offset + 32], byteorder='big')
+
+    def write(self, offset, data):
+        size = len(data)
+        if size == 0:
+            return
+        self.expand(offset, size)
+        self.data[offset:offset + size] = data
+
+    def write_padded(self, offset, data, size):
+        # writes exactly size bytes: data truncated or right-padded with zeros
+        if size == 0:
+            return
+        self.expand(offset, size)
+        n = min(len(data), size)
+        self.data[offset:offset + n] = data[:n]
+        if n < size:
+            self.data[offset + n:offset + size] = bytes(size - n)
+
+    def write_word(self, offset, val):
+        self.expand(offset, 32)
+        self.data[offset:offset + 32] = val.to_bytes(32, byteorder='big')
+
+    def write_byte(self, offset, val):
+        self.expand(offset, 1)
+        self.data[offset] = val & 0xFF
+
+class MeteredMemory(Memory):
+    # charges memory expansion gas through charge(cost) before growing
+    __slots__ = ('charge',)
+
+    def __init__(self, charge):
+        super().__init__()
+        self.charge = charge
+
+    def expand(self, offset, size):
+        if size == 0:
+            return
+        end = offset + size
+        if end > len(self.data):
+            if end > MAX_MEMORY:
+                raise OutOfGas()
+            self.charge(memory_cost(end) - memory_cost(len(self.data)))
+            self.data.extend(bytes((end + 31) // 32 * 32 - len(self.data)))
@@ -0,0 +1,404 @@
+#!/usr/bin/env python3
+
+# Precompiled contracts at addresses 0x01-0x09, run natively instead of as
+# bytecode. call_into() looks the callee up in PRECOMPILES before loading
+# any code; a precompile gets the call's input, charges its own gas and
+# returns output without a frame of its own. All of them are pure, so the
+# costly ones (everything but the hashes and identity, which cost about
+# what a lookup does) are memoized on their input.
+#
+#   python3 evm_precompiles.py        # known-answer checks
+
+import sys
+from evm_gas import words
+from evm_keccak import keccak256
+from evm_memo import BoundedMemo
+
+try:
+    import coincurve
+except ImportError:
+    coincurve = None
+
+try:
+    from py_ecc import optimized_bn128 as bn128
+except ImportError:
+    bn128 = None
+
+MASK64 = (1 << 64) - 1
+
+class PrecompileError(Exception):
+    # invalid input: the call fails and the gas given to it is gone
+    pass
+
+class Precompile:
+    __slots__ = ('address', 'name', 'gas', 'run', 'memoize')
+
+    def __init__(self, address, name, gas, run, memoize):
+        self.address = address
+        self.name = name
+        # gas(data) -> cost, run(data) -> output bytes; data is a memoryview
+        # of the caller's memory, valid only until run returns
+        self.gas = gas
+        self.run = run
+        self.memoize = memoize
+
+PRECOMPILES = {}
+
+def precompile(address, name, gas, memoize=True):
+    def register(run):
+        PRECOMPILES[address] = Precompile(address, name, gas, run, memoize)
+        return run
+    return register
+
+class PrecompileMemo(BoundedMemo):
+    # (address, input) to output, bounded by the bytes of input and output
+    # held as well as by entries: modexp inputs run to megabytes
+    def __init__(self, max_entries=4096, max_size=16 * 1024 * 1024):
+        super().__init__(max_entries, max_size)
+
+    def run(self, pc, data):
+        key = (pc.address, bytes(data))
+        output = self.get(key)
+        if output is None:
+            output = pc.run(key[1])
+            self.put(key, output, len(key[1]) + len(output))
+        return output
+
+precompile_memo = PrecompileMemo()
+
+def call(pc, data, gas):
+    # (success, output, gas left) of calling pc with data and gas (None when
+    # unmetered). Running out of gas or bad input fails the call with
+    # nothing returned and all of gas used up.
+    if gas is not None:
+        cost = pc.gas(data)
+        if cost > gas:
+            return False, b'', 0
+        gas -= cost
+    try:
+        output = precompile_memo.run(pc, data) if pc.memoize else pc.run(data)
+    except PrecompileError:
+        return False, b'', 0 if gas is not None else None
+    return True, output, gas
+
+def padded(data, offset, size):
+    # size bytes of input from offset, zero-filled past its end as calldata is
+    chunk = bytes(data[offset:offset + size])
+    return chunk + bytes(size - len(chunk)) if len(chunk) < size else chunk
+
+def word_at(data, offset):
+    return int.from_bytes(padded(data, offset, 32), byteorder='big')
+
+# elliptic curves y^2 = x^3 + b over the prime field p (secp256k1 and
+# alt_bn128 both have a = 0), points in Jacobian coordinates with z == 0
+# for the point at infinity
+
+INFINITY = (0, 1, 0)
+
+def ec_double(pt, p):
+    x, y, z = pt
+    if not y or not z:
+        return INFINITY
+    ysq = y * y % p
+    s = 4 * x * ysq % p
+    m = 3 * x * x % p
+    nx = (m * m - 2 * s) % p
+    return nx, (m * (s - nx) - 8 * ysq * ysq) % p, 2 * y * z % p
+
+def ec_add(a, b, p):
+    if not a[2]:
+        return b
+    if not b[2]:
+        return a
+    az2 = a[2] * a[2] % p
+    bz2 = b[2] * b[2] % p
+    u1 = a[0] * bz2 % p
+    u2 = b[0] * az2 % p
+    s1 = a[1] * bz2 * b[2] % p
+    s2 = b[1] * az2 * a[2] % p
+    if u1 == u2:
+        return ec_double(a, p) if s1 == s2 else INFINITY
+    h = u2 - u1
+    r = s2 - s1
+    h2 = h * h % p
+    h3 = h * h2 % p
+    u1h2 = u1 * h2 % p
+    nx = (r * r - h3 - 2 * u1h2) % p
+    return nx, (r * (u1h2 - nx) - s1 * h3) % p, h * a[2] * b[2] % p
+
+def ec_mul(pt, n, p):
+    result = INFINITY
+    for bit in bin(n)[2:] if n else ():
+        result = ec_double(result, p)
+        if bit == '1':
+            result = ec_add(result, pt, p)
+    return result
+
+def ec_affine(pt, p):
+    # (x, y), or None for infinity
+    if not pt[2]:
+        return None
+    zinv = pow(pt[2], -1, p)
+    zinv2 = zinv * zinv % p
+    return pt[0] * zinv2 % p, pt[1] * zinv2 * zinv % p
+
+SECP256K1_P = 2 ** 256 - 2 ** 32 - 977
+SECP256K1_N = 0xfffffffffffffffffffffffffffffffebaaedce6af48a03bbfd25e8cd0364141
+SECP256K1_G = (0x79be667ef9dcbbac55a06295ce870b07029bfcdb2dce28d959f2815b16f81798,
+               0x483ada7726a3c4655da4fbfc0e1108a8fd17b448a68554199c47d08ffb10d4b8, 1)
+
+def recover_public_key(h, v, r, s):
+    # 64-byte uncompressed public key that signed hash h, or None
+    if coincurve is not None:
+        sig = r.to_bytes(32, byteorder='big') + s.to_bytes(32, byteorder='big') + bytes((v - 27,))
+        try:
+            key = coincurve.PublicKey.from_signature_and_message(sig, h.to_bytes(32, byteorder='big'), hasher=None)
+        except Exception:
+            return None
+        return key.format(compressed=False)[1:]
+    p = SECP256K1_P
+    n = SECP256K1_N
+    alpha = (r * r * r + 7) % p
+    y = pow(alpha, (p + 1) // 4, p)
+    if y * y % p != alpha:
+        return None
+    if y & 1 != v - 27:
+        y = p - y
+    rinv = pow(r, -1, n)
+    q = ec_add(ec_mul((r, y, 1), s * rinv % n, p), ec_mul(SECP256K1_G, -h * rinv % n, p), p)
+    point = ec_affine(q, p)
+    if point is None:
+        return None
+    return point[0].to_bytes(32, byteorder='big') + point[1].to_bytes(32, byteorder='big')
+
+@precompile(0x01, 'ecrecover', lambda data: 3000)
+def ecrecover(data):
+    # bad signatures are not an error, they just recover nothing
+    h, v, r, s = (word_at(data, i) for i in range(0, 128, 32))
+    if v not in (27, 28) or not 0 < r < SECP256K1_N or not 0 < s < SECP256K1_N:
+        return b''
+    key = recover_public_key(h, v, r, s)
+    if key is None:
+        return b''
+    return bytes(12) + keccak256(key)[12:]
+
+@precompile(0x02, 'sha256', lambda data: 60 + 12 * words(len(data)), memoize=False)
+def sha256(data):
+    # hashlib loads on first use, it is a few milliseconds of startup
+    import hashlib
+    return hashlib.sha256(data).digest()
+
+def _ripemd160_digest(data):
+    import hashlib
+    try:
+        return hashlib.new('ripemd160', data).digest()
+    except ValueError:
+        # OpenSSL 3 without the legacy provider
+        from Crypto.Hash import RIPEMD160
+        return RIPEMD160.new(data).digest()
+
+@precompile(0x03, 'ripemd160', lambda data: 600 + 120 * words(len(data)), memoize=False)
+def ripemd160(data):
+    return bytes(12) + _ripemd160_digest(data)
+
+@precompile(0x04, 'identity', lambda data: 15 + 3 * words(len(data)), memoize=False)
+def identity(data):
+    # the one copy out of the caller's memory: it becomes the return data,
+    # which must not change as memory does, and call_into writes the return
+    # area from a view of it
+    return bytes(data)
+
+# operands longer than this fail instead of being allocated. No block's
+# gas pays for one: a base or modulus of 2**25 bytes costs over 5 * 10**12
+# and an exponent that long over 8 * 10**7, so metered calls fail the same
+# either way and only unmetered ones are cut short.
+MODEXP_MAX_LEN = 1 << 25
+
+def modexp_sizes(data):
+    return word_at(data, 0), word_at(data, 32), word_at(data, 64)
+
+def modexp_gas(data):
+    # EIP-2565
+    bsize, esize, msize = modexp_sizes(data)
+    head = int.from_bytes(padded(data, 96 + bsize, min(esize, 32)), byteorder='big') if esize else 0
+    iterations = max(0, head.bit_length() - 1)
+    if esize > 32:
+        iterations += 8 * (esize - 32)
+    complexity = ((max(bsize, msize) + 7) // 8) ** 2
+    return max(200, complexity * max(iterations, 1) // 3)
+
+@precompile(0x05, 'modexp', modexp_gas)
+def modexp(data):
+    bsize, esize, msize = modexp_sizes(data)
+    if not msize:
+        return b''
+    if max(bsize, esize, msize) > MODEXP_MAX_LEN:
+        raise PrecompileError("modexp operand too long")
+    b = int.from_bytes(padded(data, 96, bsize), byteorder='big')
+    e = int.from_bytes(padded(data, 96 + bsize, esize), byteorder='big')
+    m = int.from_bytes(padded(data, 96 + bsize + esize, msize), byteorder='big')
+    return (pow(b, e, m) if m else 0).to_bytes(msize, byteorder='big')
+
+BN128_P = 21888242871839275222246405745257275088696311157297823662689037894645226208583
+BN128_N = 21888242871839275222246405745257275088548364400416034343698204186575808495617
+
+def bn128_point(data, offset):
+    # a G1 point as EIP-196 encodes it, (0, 0) for infinity
+    x, y = word_at(data, offset), word_at(data, offset + 32)
+    if x >= BN128_P or y >= BN128_P:
+        raise PrecompileError("coordinate not in the field")
+    if not x and not y:
+        return INFINITY
+    if (y * y - x * x * x - 3) % BN128_P:
+        raise PrecompileError("point not on alt_bn128")
+    return x, y, 1
+
+def bn128_encode(pt):
+    point = ec_affine(pt, BN128_P) or (0, 0)
+    return point[0].to_bytes(32, byteorder='big') + point[1].to_bytes(32, byteorder='big')
+
+@precompile(0x06, 'ecadd', lambda data: 150)
+def ecadd(data):
+    return bn128_encode(ec_add(bn128_point(data, 0), bn128_point(data, 64), BN128_P))
+
+@precompile(0x07, 'ecmul', lambda data: 6000)
+def ecmul(data):
+    # G1 has cofactor 1, every point on the curve has order BN128_N
+    return bn128_encode(ec_mul(bn128_point(data, 0), word_at(data, 64) % BN128_N, BN128_P))
+
+def bn128_g2_point(data, offset):
+    # EIP-197 puts the imaginary part of each Fp2 coordinate first
+    xi, xr, yi, yr = (word_at(data, offset + i) for i in range(0, 128, 32))
+    if max(xi, xr, yi, yr) >= BN128_P:
+        raise PrecompileError("coordinate not in the field")
+    if not (xi or xr or yi or yr):
+        return bn128.Z2
+    pt = (bn128.FQ2([xr, xi]), bn128.FQ2([yr, yi]), bn128.FQ2.one())
+    if not bn128.is_on_curve(pt, bn128.b2) or not bn128.is_inf(bn128.multiply(pt, BN128_N)):
+        raise PrecompileError("point not in G2")
+    return pt
+
+def ecpairing(data):
+    if len(data) % 192:
+        raise PrecompileError("input not a list of (G1, G2) pairs")
+    product = bn128.FQ12.one()
+    for offset in range(0, len(data), 192):
+        x, y, z = bn128_point(data, offset)
+        q = bn128_g2_point(data, offset + 64)
+        if z and not bn128.is_inf(q):
+            product *= bn128.pairing(q, (bn128.FQ(x), bn128.FQ(y), bn128.FQ(1)), final_exponentiate=False)
+    return (bn128.final_exponentiate(product) == bn128.FQ12.one()).to_bytes(32, byteorder='big')
+
+# pairings need Fp12 arithmetic, left to py_ecc; without it 0x08 is an
+# ordinary empty account
+if bn128 is not None:
+    precompile(0x08, 'ecpairing', lambda data: 45000 + 34000 * (len(data) // 192))(ecpairing)
+
+BLAKE2B_IV = (0x6a09e667f3bcc908, 0xbb67ae8584caa73b, 0x3c6ef372fe94f82b, 0xa54ff53a5f1d36f1,
+              0x510e527fade682d1, 0x9b05688c2b3e6c1f, 0x1f83d9abfb41bd6b, 0x5be0cd19137e2179)
+
+BLAKE2B_SIGMA = (
+    (0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15),
+    (14, 10, 4, 8, 9, 15, 13, 6, 1, 12, 0, 2, 11, 7, 5, 3),
+    (11, 8, 12, 0, 5, 2, 15, 13, 10, 14, 3, 6, 7, 1, 9, 4),
+    (7, 9, 3, 1, 13, 12, 11, 14, 2, 6, 5, 10, 4, 0, 15, 8),
+    (9, 0, 5, 7, 2, 4, 10, 15, 14, 1, 11, 12, 6, 8, 3, 13),
+    (2, 12, 6, 10, 0, 11, 8, 3, 4, 13, 7, 5, 15, 14, 1, 9),
+    (12, 5, 1, 15, 14, 13, 4, 10, 0, 7, 6, 3, 9, 2, 8, 11),
+    (13, 11, 7, 14, 12, 1, 3, 9, 5, 0, 15, 4, 8, 6, 2, 10),
+    (6, 15, 14, 9, 11, 3, 0, 8, 12, 2, 13, 7, 1, 4, 10, 5),
+    (10, 2, 8, 4, 7, 6, 1, 5, 15, 11, 9, 14, 3, 12, 13, 0),
+)
+
+BLAKE2B_MIX = ((0, 4, 8, 12), (1, 5, 9, 13), (2, 6, 10, 14), (3, 7, 11, 15),
+               (0, 5, 10, 15), (1, 6, 11, 12), (2, 7, 8, 13), (3, 4, 9, 14))
+
+def blake2b_compress(rounds, h, m, t0, t1, final):
+    # the BLAKE2b F function with a round count, as EIP-152 exposes it
+    v = list(h) + list(BLAKE2B_IV)
+    v[12] ^= t0
+    v[13] ^= t1
+    if final:
+        v[14] ^= MASK64
+    for i in range(rounds):
+        s = BLAKE2B_SIGMA[i % 10]
+        for j, (a, b, c, d) in enumerate(BLAKE2B_MIX):
+            x, y = m[s[2 * j]], m[s[2 * j + 1]]
+            va = (v[a] + v[b] + x) & MASK64
+            vd = v[d] ^ va
+            vd = (vd >> 32 | vd << 32) & MASK64
+            vc = (v[c] + vd) & MASK64
+            vb = v[b] ^ vc
+            vb = (vb >> 24 | vb << 40) & MASK64
+            va = (va + vb + y) & MASK64
+            vd ^= va
+            vd = (vd >> 16 | vd << 48) & MASK64
+            vc = (vc + vd) & MASK64
+            vb ^= vc
+            v[a], v[b], v[c], v[d] = va, (vb >> 63 | vb << 1) & MASK64, vc, vd
+    return [h[i] ^ v[i] ^ v[i + 8] for i in range(8)]
+
+def blake2f_gas(data):
+    return int.from_bytes(data[:4], byteorder='big') if len(data) == 213 else 0
+
+@precompile(0x09, 'blake2f', blake2f_gas)
+def blake2f(data):
+    if len(data) != 213 or data[212] > 1:
+        raise PrecompileError("blake2f takes exactly 213 bytes ending in 0 or 1")
+    le = [int.from_bytes(data[i:i + 8], byteorder='little') for i in range(4, 212, 8)]
+    h = blake2b_compress(int.from_bytes(data[:4], byteorder='big'), le[:8], le[8:24], le[24], le[25], data[212])
+    return b''.join(x.to_bytes(8, byteorder='little') for x in h)
+
+def main():
+    import hashlib
+    checks = []
+
+    def check(name, address, data, expected):
+        ok, output, _ = call(PRECOMPILES[address], memoryview(data), None)
+        # expected None: the call must fail
+        checks.append((name, ok and output == expected if expected is not None else not ok))
+
+    check("sha256", 0x02, b'abc', hashlib.sha256(b'abc').digest())
+    check("ripemd160", 0x03, b'', bytes(12) + bytes.fromhex('9c1185a5c5e9fc54612808977ee8f548b2258d31'))
+    check("identity", 0x04, b'\x01\x02\x03', b'\x01\x02\x03')
+    # geth's ecrecover test vector
+    check("ecrecover", 0x01, bytes.fromhex(
+        '456e9aea5e197a1f1af7a3e85a3212fa4049a3ba34c2289b4c860fc0b0c64ef3'
+        '000000000000000000000000000000000000000000000000000000000000001c'
+        '9242685bf161793cc25603c231bc2f568eb630ea16aa137d2664ac8038825608'
+        '4f8ae3bd7535248d0bd448298cc2e2071e56992d0774dc340c368ae950852ada'),
+        bytes.fromhex('0000000000000000000000007156526fbd7a3c72969b54f64e42c10fbb768c8a'))
+    check("ecrecover bad v", 0x01, bytes(31) + b'\x1d' + bytes(96), b'')
+    b, e, m = 3, 2 ** 255 + 17, 2 ** 256 - 189
+    check("modexp", 0x05, b''.join(x.to_bytes(32, byteorder='big') for x in (32, 32, 32, b, e, m)),
+          pow(b, e, m).to_bytes(32, byteorder='big'))
+    check("modexp zero modulus", 0x05, b''.join(x.to_bytes(32, byteorder='big') for x in (1, 1, 1)) + b'\x02\x03\x00',
+          b'\x00')
+    g1 = (1).to_bytes(32, byteorder='big') + (2).to_bytes(32, byteorder='big')
+    double = bytes.fromhex('030644e72e131a029b85045b68181585d97816a916871ca8d3c208c16d87cfd3'
+                           '15ed738c0e0a7c92e7845f96b2ae9c0a68a6a449e3538fc7ff3ebf7a5a18a2c4')
+    check("ecadd", 0x06, g1 + g1, double)
+    check("ecmul", 0x07, g1 + (2).to_bytes(32, byteorder='big'), double)
+    check("ecmul by order", 0x07, g1 + BN128_N.to_bytes(32, byteorder='big'), bytes(64))
+    ok, _, left = call(PRECOMPILES[0x06], memoryview(g1 + (1).to_bytes(32, byteorder='big') * 2), 500)
+    checks.append(("ecadd off curve", not ok and left == 0))
+    # blake2b('abc') is one final F compression of the padded block
+    h = list(BLAKE2B_IV)
+    h[0] ^= 0x01010040
+    f_input = ((12).to_bytes(4, byteorder='big') + b''.join(x.to_bytes(8, byteorder='little') for x in h)
+               + b'abc' + bytes(125) + (3).to_bytes(8, byteorder='little') + bytes(8) + b'\x01')
+    check("blake2f", 0x09, f_input, hashlib.blake2b(b'abc').digest())
+    check("blake2f bad flag", 0x09, f_input[:-1] + b'\x02', None)
+    ok, _, left = call(PRECOMPILES[0x04], memoryview(bytes(64)), 21)
+    checks.append(("identity gas", ok and left == 0))
+    ok, _, left = call(PRECOMPILES[0x05], memoryview(bytes(96)), 199)
+    checks.append(("modexp minimum gas", not ok and left == 0))
+
+    failed = [name for name, ok in checks if not ok]
+    for name in failed:
+        print(f"FAIL {name}")
+    print(f"{len(checks) - len(failed)}/{len(checks)} passed")
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
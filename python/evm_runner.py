@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+
+# Runs evm.json-style fixture files to completion, optionally across a
+# process pool, and reports every failure with per-case timing and
+# instruction counts.
+#
+#   python3 evm_runner.py                      # ../evm.json, console output
+#   python3 evm_runner.py -j 8 --json out.json --junit out.xml cases/*.json
+#   python3 evm_runner.py --count --compile-after 0
+#
+# Cases run on evm.TABLES, as everything else does, so the create cache and
+# (with --compile-after) the compile tier are part of what is tested.
+# --count runs each case a second time through counting tables for its
+# instruction count; that run is not timed.
+
+import argparse
+import os
+import sys
+import time
+import evm
+import evm_analysis
+import evm_fixtures
+from evm_state import WorldState
+
+DEFAULT_FIXTURE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "evm.json")
+
+def load_cases(paths):
+    # (path, index, evm_fixtures.Case) for every case in paths
+    cases = []
+    for path in paths:
+        for index, case in enumerate(evm_fixtures.load(path)):
+            cases.append((path, index, case))
+    return cases
+
+def counting_tables(counter):
+    # copies of evm.TABLES that bump counter[0] once per EVM instruction:
+    # a superinstruction stands for two, CHARGE and CHECK slots for none
+    def counted(handler, weight):
+        def op(frame, arg):
+            counter[0] += weight
+            return handler(frame, arg)
+        return op
+
+    def weight(op):
+        if op == evm_analysis.CHARGE or op == evm_analysis.CHECK:
+            return 0
+        if op > 0xff:
+            return 2
+        return 1
+
+    return tuple([counted(handler, weight(op)) for op, handler in enumerate(table)]
+                 for table in evm.TABLES)
+
+_counter = [0]
+_tables = counting_tables(_counter)
+
+# perf_counter() when this process first ran a case, see startup()
+_first_run = None
+
+def startup():
+    # seconds from evm starting to import to the first instruction this
+    # process ran, None before any
+    if _first_run is None:
+        return None
+    return _first_run - evm.IMPORT_START
+
+def run_case(path, index, case, count=False, compile_after=None):
+    global _first_run
+    test = case.test
+    expect = test['expect']
+    result = {
+        'file': path,
+        'index': index,
+        'name': test['name'],
+        'passed': False,
+        'failure': None,
+        'expected': None,
+        'actual': None,
+        'time': 0.0,
+        # None unless counted
+        'instructions': None,
+    }
+    vm = evm.EVM(WorldState.from_json(test.get('state')), compile_after)
+    start = time.perf_counter()
+    if _first_run is None:
+        _first_run = start
+    try:
+        frame = vm.run(case.code, test.get('tx'), test.get('block'), dict())
+    except Exception as e:
+        frame = None
+        result['failure'] = "Error"
+        result['actual'] = f"{type(e).__name__}: {e}"
+    result['time'] = time.perf_counter() - start
+    if count:
+        result['instructions'] = count_instructions(case)
+    if frame is None:
+        return result
+
+    stack = frame.stack.to_list()
+    ret = frame.ret.hex() if frame.ret is not None else None
+    expected_stack = [int(x, 16) for x in expect.get('stack', [])]
+    expected_log = expect.get('logs', [])
+    expected_return = expect.get('return', None)
+    if stack != expected_stack:
+        result.update(failure="Stack doesn't match", expected=[hex(x) for x in expected_stack],
+                      actual=[hex(x) for x in stack])
+    elif frame.log != expected_log:
+        result.update(failure="Log doesn't match", expected=expected_log, actual=frame.log)
+    elif ret != expected_return:
+        result.update(failure="Return doesn't match", expected=expected_return, actual=ret)
+    elif frame.success != expect['success']:
+        result.update(failure="Success doesn't match", expected=expect['success'], actual=frame.success)
+    else:
+        result['passed'] = True
+    return result
+
+def count_instructions(case):
+    # EVM instructions case runs, from a run of its own on the counting
+    # tables (which keep it off the create cache and the compile tier)
+    test = case.test
+    _counter[0] = 0
+    try:
+        evm.EVM(WorldState.from_json(test.get('state'))).run(case.code, test.get('tx'), test.get('block'),
+                                                              dict(), tables=_tables)
+    except Exception:
+        pass
+    return _counter[0]
+
+_cases = None
+_options = {}
+
+def _init_worker(paths, options):
+    global _cases, _options
+    _cases = load_cases(paths)
+    _options = options
+
+def _run_index(i):
+    return run_case(*_cases[i], **_options)
+
+def run_all(paths, jobs, count=False, compile_after=None):
+    cases = load_cases(paths)
+    options = {'count': count, 'compile_after': compile_after}
+    if jobs <= 1:
+        return cases, [run_case(*case, **options) for case in cases]
+    # workers load the fixtures themselves, only indices and results cross
+    # the process boundary
+    from concurrent.futures import ProcessPoolExecutor
+    chunksize = max(1, len(cases) // (jobs * 8))
+    with ProcessPoolExecutor(jobs, initializer=_init_worker, initargs=(paths, options)) as pool:
+        return cases, list(pool.map(_run_index, range(len(cases)), chunksize=chunksize))
+
+def print_console(cases, results):
+    total = len(results)
+    for i, ((_, _, case), result) in enumerate(zip(cases, results)):
+        if result['passed']:
+            print(f"✓  Test #{i + 1}/{total} {result['name']}")
+            continue
+        test = case.test
+        print(f"❌ Test #{i + 1}/{total} {result['name']}")
+        print(result['failure'])
+        print(" expected:", result['expected'])
+        print("   actual:", result['actual'])
+        print("")
+        print("Test code:")
+        print(test['code'].get('asm'))
+        print("")
+        print("Hint:", test.get('hint', ''))
+        print("")
+
+def summary(results, wall_time):
+    counted = [r['instructions'] for r in results if r['instructions'] is not None]
+    return {
+        'total': len(results),
+        'passed': sum(r['passed'] for r in results),
+        'failed': sum(not r['passed'] and r['failure'] != "Error" for r in results),
+        'errors': sum(r['failure'] == "Error" for r in results),
+        'time': wall_time,
+        'instructions': sum(counted) if counted else None,
+        # cases run in worker processes leave this None
+        'startup': startup(),
+        'cases': results,
+    }
+
+def write_junit(report, path):
+    import xml.etree.ElementTree as ET
+    suites = ET.Element('testsuites', tests=str(report['total']),
+                        failures=str(report['failed']), errors=str(report['errors']),
+                        time=f"{report['time']:.6f}")
+    by_file = {}
+    for r in report['cases']:
+        by_file.setdefault(r['file'], []).append(r)
+    for name, results in by_file.items():
+        suite = ET.SubElement(suites, 'testsuite', name=name, tests=str(len(results)),
+                              failures=str(sum(not r['passed'] and r['failure'] != "Error" for r in results)),
+                              errors=str(sum(r['failure'] == "Error" for r in results)),
+                              time=f"{sum(r['time'] for r in results):.6f}")
+        for r in results:
+            case = ET.SubElement(suite, 'testcase', classname=name, name=r['name'], time=f"{r['time']:.6f}")
+            if r['instructions'] is not None:
+                ET.SubElement(case, 'property', name='instructions', value=str(r['instructions']))
+            if not r['passed']:
+                tag = 'error' if r['failure'] == "Error" else 'failure'
+                node = ET.SubElement(case, tag, message=r['failure'])
+                node.text = f"expected: {r['expected']}\nactual: {r['actual']}"
+    ET.ElementTree(suites).write(path, encoding='utf-8', xml_declaration=True)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run EVM fixture files")
+    parser.add_argument('fixtures', nargs='*', default=[DEFAULT_FIXTURE])
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1,
+                        help="worker processes (1 runs in-process)")
+    parser.add_argument('--json', help="write a JSON summary with every case to this file")
+    parser.add_argument('--junit', help="write a JUnit XML report to this file")
+    parser.add_argument('-q', '--quiet', action='store_true', help="skip the per-test console output")
+    parser.add_argument('--count', action='store_true',
+                        help="count instructions per case, in a second untimed run")
+    parser.add_argument('--compile-after', type=int, default=None, metavar='N',
+                        help="compile contracts to Python after N runs (see evm_compile.py)")
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    cases, results = run_all(args.fixtures, args.jobs, args.count, args.compile_after)
+    report = summary(results, time.perf_counter() - start)
+
+    if not args.quiet:
+        print_console(cases, results)
+    counted = f" ({report['instructions']} instructions)" if report['instructions'] is not None else ""
+    print(f"{report['passed']}/{report['total']} passed, {report['failed']} failed, "
+          f"{report['errors']} errors in {report['time']:.2f}s{counted}")
+    if report['startup'] is not None:
+        print(f"{report['startup'] * 1e3:.1f}ms from import to first instruction")
+    if args.json:
+        import json
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.junit:
+        write_junit(report, args.junit)
+    return 0 if report['passed'] == report['total'] else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
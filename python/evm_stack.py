@@ -0,0 +1,45 @@
+STACK_LIMIT = 1024
+
+class UncheckedStack:
+    # the stack frames run on, items stored bottom-first so push/pop work on
+    # the end of the list. Bounds are checked once per basic block by the
+    # CHECK slot evm_analysis puts wherever it cannot prove them, so the
+    # operations themselves skip the checks.
+    __slots__ = ('items',)
+
+    def __init__(self, items=()):
+        self.items = list(items)
+
+    def __len__(self):
+        return len(self.items)
+
+    def push(self, val):
+        self.items.append(val)
+
+    def pop(self):
+        return self.items.pop()
+
+    def popn(self, n):
+        # returns the top n items, top first
+        items = self.items
+        vals = items[:-n - 1:-1]
+        del items[-n:]
+        return vals
+
+    def peek(self, n=0):
+        return self.items[-1 - n]
+
+    def set_top(self, val):
+        self.items[-1] = val
+
+    def dup(self, n):
+        items = self.items
+        items.append(items[-n])
+
+    def swap(self, n):
+        items = self.items
+        items[-1], items[-1 - n] = items[-1 - n], items[-1]
+
+    def to_list(self):
+        # top-first, the order evm() has always returned
+        return self.items[::-1]
@@ -0,0 +1,318 @@
+from types import MappingProxyType
+
+class Account:
+    __slots__ = ('balance', 'code', 'nonce')
+
+    def __init__(self, balance=0, code=b'', nonce=0):
+        self.balance = balance
+        self.code = code
+        self.nonce = nonce
+
+# journal entry kinds
+BALANCE = 0
+CODE = 1
+STORAGE = 2
+CREATE = 3
+NONCE = 4
+ACCESS_ADDRESS = 5
+ACCESS_SLOT = 6
+
+_MISSING = object()
+# storage of an account that has none, for reading only
+_EMPTY = MappingProxyType({})
+
+class WorldState:
+    # accounts and storage keyed by int address. Every write appends an undo
+    # record to the journal, so reverting a sub-call only touches what it
+    # changed: snapshot() marks a point, revert() unwinds back to it.
+    def __init__(self):
+        self.accounts = {}
+        self.storage = {}
+        self.journal = []
+        # per-transaction gas bookkeeping: EIP-2929 warm sets and the value
+        # each written slot had when the transaction started
+        self.accessed_addresses = set()
+        self.accessed_slots = set()
+        self.original = {}
+
+    @classmethod
+    def from_json(cls, data):
+        # the fixture shape:
+        # {"0x..": {"balance": "0x..", "nonce": "0x..", "code": {"bin": ".."}}}
+        state = cls()
+        for addr, acct in (data or {}).items():
+            code = bytes.fromhex(acct['code']['bin']) if 'code' in acct else b''
+            state.accounts[int(addr, 16)] = Account(
+                int(acct.get('balance', '0x0'), 16), code, int(acct.get('nonce', '0x0'), 16))
+            if 'storage' in acct:
+                state.storage[int(addr, 16)] = {int(k, 16): int(v, 16) for k, v in acct['storage'].items()}
+        return state
+
+    def to_json(self):
+        data = {}
+        for addr, acct in self.accounts.items():
+            out = {}
+            if acct.balance:
+                out['balance'] = hex(acct.balance)
+            if acct.nonce:
+                out['nonce'] = hex(acct.nonce)
+            if acct.code:
+                out['code'] = {'bin': acct.code.hex()}
+            # a slot holding 0 is the same as no slot
+            storage = {hex(k): hex(v) for k, v in self.storage.get(addr, _EMPTY).items() if v}
+            if storage:
+                out['storage'] = storage
+            data['0x%040x' % addr] = out
+        return data
+
+    def fork(self):
+        # an O(1) copy-on-write fork, see ForkedState
+        return ForkedState(self)
+
+    def copy(self):
+        # committed contents only, the journal and access sets start empty
+        state = WorldState()
+        state.accounts = {addr: Account(a.balance, a.code, a.nonce) for addr, a in self.accounts.items()}
+        state.storage = {addr: dict(s) for addr, s in self.storage.items()}
+        return state
+
+    def exists(self, addr):
+        return addr in self.accounts
+
+    def get_balance(self, addr):
+        acct = self.accounts.get(addr)
+        return acct.balance if acct is not None else 0
+
+    def get_code(self, addr):
+        acct = self.accounts.get(addr)
+        return acct.code if acct is not None else b''
+
+    def get_nonce(self, addr):
+        acct = self.accounts.get(addr)
+        return acct.nonce if acct is not None else 0
+
+    def storage_of(self, addr):
+        storage = self.storage.get(addr)
+        if storage is None:
+            storage = self.storage[addr] = {}
+        return storage
+
+    def storage_view(self, addr):
+        # addr's storage for reading only, nothing is created for it
+        return self.storage.get(addr, _EMPTY)
+
+    def get_storage(self, addr, key):
+        storage = self.storage.get(addr)
+        return storage.get(key, 0) if storage is not None else 0
+
+    def _account(self, addr):
+        acct = self.accounts.get(addr)
+        if acct is None:
+            acct = self.accounts[addr] = Account()
+            self.journal.append((CREATE, addr, None))
+        return acct
+
+    def create_account(self, addr, balance=0, code=b'', nonce=0):
+        old = self.accounts.get(addr)
+        self.accounts[addr] = Account(balance, code, nonce)
+        self.journal.append((CREATE, addr, old))
+
+    def set_balance(self, addr, balance):
+        acct = self._account(addr)
+        self.journal.append((BALANCE, addr, acct.balance))
+        acct.balance = balance
+
+    def set_code(self, addr, code):
+        acct = self._account(addr)
+        self.journal.append((CODE, addr, acct.code))
+        acct.code = code
+
+    def set_nonce(self, addr, nonce):
+        acct = self._account(addr)
+        self.journal.append((NONCE, addr, acct.nonce))
+        acct.nonce = nonce
+
+    def original_storage(self, addr, key):
+        return self.original.get((addr, key), self.get_storage(addr, key))
+
+    def access_address(self, addr):
+        # True the first time addr is touched in this transaction
+        if addr in self.accessed_addresses:
+            return False
+        self.accessed_addresses.add(addr)
+        self.journal.append((ACCESS_ADDRESS, addr, None))
+        return True
+
+    def access_slot(self, addr, key):
+        if (addr, key) in self.accessed_slots:
+            return False
+        self.accessed_slots.add((addr, key))
+        self.journal.append((ACCESS_SLOT, addr, key))
+        return True
+
+    def accessed_since(self, snapshot, addr):
+        # slots of addr first accessed after snapshot
+        return [key for kind, a, key in self.journal[snapshot:] if kind == ACCESS_SLOT and a == addr]
+
+    def written_since(self, snapshot, addr):
+        # (slot, value now) for the slots of addr written after snapshot,
+        # from the journal: storage views can also hold slots only ever read
+        keys = dict.fromkeys(old[0] for kind, a, old in self.journal[snapshot:] if kind == STORAGE and a == addr)
+        return [(key, self.get_storage(addr, key)) for key in keys]
+
+    def set_storage(self, addr, key, value):
+        storage = self.storage_of(addr)
+        if (addr, key) not in self.original:
+            self.original[(addr, key)] = storage.get(key, 0)
+        self.journal.append((STORAGE, addr, (key, storage.get(key, _MISSING))))
+        storage[key] = value
+
+    def snapshot(self):
+        return len(self.journal)
+
+    def revert(self, snapshot):
+        journal = self.journal
+        while len(journal) > snapshot:
+            kind, addr, old = journal.pop()
+            if kind == STORAGE:
+                key, val = old
+                if val is _MISSING:
+                    del self.storage[addr][key]
+                else:
+                    self.storage[addr][key] = val
+            elif kind == BALANCE:
+                self.accounts[addr].balance = old
+            elif kind == CODE:
+                self.accounts[addr].code = old
+            elif kind == NONCE:
+                self.accounts[addr].nonce = old
+            elif kind == ACCESS_ADDRESS:
+                self.accessed_addresses.discard(addr)
+            elif kind == ACCESS_SLOT:
+                self.accessed_slots.discard((addr, old))
+            elif old is None:
+                del self.accounts[addr]
+            else:
+                self.accounts[addr] = old
+
+    def commit(self):
+        # changes become permanent, nothing left to undo
+        self.journal.clear()
+        self.accessed_addresses.clear()
+        self.accessed_slots.clear()
+        self.original.clear()
+
+class ForkAccounts(dict):
+    # a fork's accounts: an account is copied from the base the first time
+    # the fork looks at it, since Accounts are changed in place
+    __slots__ = ('base',)
+
+    def __init__(self, base):
+        super().__init__()
+        self.base = base
+
+    def get(self, addr, default=None):
+        acct = dict.get(self, addr)
+        if acct is None:
+            acct = self.base.get(addr)
+            if acct is None:
+                return default
+            acct = Account(acct.balance, acct.code, acct.nonce)
+            dict.__setitem__(self, addr, acct)
+        return acct
+
+    def __contains__(self, addr):
+        return self.get(addr) is not None
+
+class ForkStorage(dict):
+    # one account's storage in a fork: holds the slots the fork wrote, the
+    # rest are read from the base. SLOAD reads it directly.
+    __slots__ = ('base',)
+
+    def __init__(self, base):
+        super().__init__()
+        self.base = base
+
+    def get(self, key, default=None):
+        value = dict.get(self, key, _MISSING)
+        if value is _MISSING:
+            return self.base.get(key, default)
+        return value
+
+def slot_keys(view):
+    # every key a storage view shows, down through the bases of ForkStorages
+    keys = set()
+    while type(view) is ForkStorage:
+        keys.update(dict.keys(view))
+        view = view.base
+    keys.update(view)
+    return keys
+
+class ForkedState(WorldState):
+    # a copy-on-write overlay over base. Forking costs O(1) and only what a
+    # fork touches is copied into it: accounts when first read, storage
+    # slots when written. Dropping a fork costs nothing, merge() writes its
+    # changes back. base must not change while forks of it are in use,
+    # any number of forks (and forks of forks) can share it.
+    def __init__(self, base):
+        super().__init__()
+        self.base = base
+        self.accounts = ForkAccounts(base.accounts)
+
+    def storage_of(self, addr):
+        storage = self.storage.get(addr)
+        if storage is None:
+            storage = self.storage[addr] = ForkStorage(self.base.storage_view(addr))
+        return storage
+
+    storage_view = storage_of
+
+    def get_storage(self, addr, key):
+        storage = self.storage.get(addr)
+        if storage is None:
+            return self.base.get_storage(addr, key)
+        return storage.get(key, 0)
+
+    def copy(self):
+        # a plain WorldState with base and the overlay flattened together
+        state = self.base.copy()
+        for addr, acct in self.accounts.items():
+            state.accounts[addr] = Account(acct.balance, acct.code, acct.nonce)
+        for addr, storage in self.storage.items():
+            if type(storage) is ForkStorage:
+                state.storage_of(addr).update(storage)
+            else:
+                # replaced outright by the storage argument of evm.run()
+                state.storage[addr] = dict(storage)
+        return state
+
+    def to_json(self):
+        return self.copy().to_json()
+
+    def merge(self):
+        # applies what the fork changed to base as one committed
+        # transaction; the fork should not be used afterwards
+        base = self.base
+        for addr, acct in self.accounts.items():
+            old = base.accounts.get(addr)
+            if old is None:
+                base.create_account(addr, acct.balance, acct.code, acct.nonce)
+                old = base.accounts.get(addr)
+            if old.balance != acct.balance:
+                base.set_balance(addr, acct.balance)
+            if old.code != acct.code:
+                base.set_code(addr, acct.code)
+            if old.nonce != acct.nonce:
+                base.set_nonce(addr, acct.nonce)
+        for addr, storage in self.storage.items():
+            if type(storage) is not ForkStorage:
+                # replaced outright by the storage argument of evm.run(), as
+                # copy() has it: the base's slots it does not hold are
+                # cleared (those a BackedState base has loaded)
+                for key in [key for key in slot_keys(base.storage_view(addr)) if key not in storage]:
+                    if base.get_storage(addr, key):
+                        base.set_storage(addr, key, 0)
+            for key, value in storage.items():
+                if base.get_storage(addr, key) != value or key not in base.storage_view(addr):
+                    base.set_storage(addr, key, value)
+        base.commit()
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+
+# Concurrency stress check: independent simulations, each in its own
+# evm.EVM, run on a thread pool and must give exactly what they give run
+# one after another. The shared code cache and keccak memo are shrunk so
+# they evict constantly, and the interpreter switches threads as often as
+# it can. The token transfers also run on forks of one BackedState over a
+# SQLite database, whose caches start empty so the threads fill them.
+#
+#   python3 evm_threads.py -j 8 --rounds 20
+
+import argparse
+import os
+import random
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+import evm
+from evm_backend import BackedState, SQLiteBackend
+from evm_cache import code_cache
+from evm_keccak import keccak_memo
+from evm_state import WorldState
+
+def simulations():
+    # (name, code, tx, block, state, storage, gas): every evm.json fixture,
+    # metered and not, the benchmark workloads and a block of token
+    # transfers run as independent calls against the same state, once from
+    # JSON and once on forks of a shared BackedState. state is JSON or a
+    # WorldState to fork.
+    import evm_bench
+    import evm_block
+    import evm_fixtures
+    sims = []
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'evm.json')
+    for case in evm_fixtures.load(path):
+        test = case.test
+        for gas in (None, 10 ** 6):
+            sims.append((test['name'], case.code, test.get('tx'), test.get('block'), test.get('state'), {}, gas))
+    for name, bench in evm_bench.WORKLOADS.items():
+        try:
+            w = bench()
+        except evm_bench.Unavailable:
+            continue
+        sims.append((name, w['code'], w['tx'], {}, w['state'], w['storage'], None))
+    state, txs = evm_block.token_block(40, 8, 5)
+    token = state.to_json()
+    for i, tx in enumerate(txs):
+        code = state.get_code(int(tx['to'], 16))
+        sims.append((f'token transfer {i}', code, tx, {}, token, None, 10 ** 7))
+    backend = SQLiteBackend(':memory:')
+    backend.write(state.accounts, {(addr, key): value for addr, storage in state.storage.items()
+                                   for key, value in storage.items()})
+    # max_entries=0: evict() empties the caches
+    shared = BackedState(backend, max_entries=0)
+    for i, tx in enumerate(txs):
+        code = state.get_code(int(tx['to'], 16))
+        sims.append((f'sqlite token transfer {i}', code, tx, {}, shared, None, 10 ** 7))
+    return sims
+
+def overlay(fork):
+    # what a run on a fork changed: the accounts it looked at and the slots
+    # it wrote. Unlike the shared base's caches that does not depend on what
+    # other runs happened to load.
+    accounts = {addr: (acct.balance, acct.code, acct.nonce) for addr, acct in dict.items(fork.accounts)}
+    storage = {addr: dict(slots) for addr, slots in fork.storage.items() if slots}
+    return accounts, storage
+
+def simulate(sim, compile_after):
+    name, code, tx, block, state, storage, gas = sim
+    shared = isinstance(state, WorldState)
+    vm = evm.EVM(state.fork() if shared else WorldState.from_json(state), compile_after)
+    try:
+        frame = vm.run(code, tx, block, dict(storage) if storage is not None else None, gas)
+    except Exception as e:
+        return (type(e).__name__, str(e))
+    ret = frame.ret.hex() if frame.ret is not None else None
+    stack = frame.stack.to_list() if frame.success else None
+    return (frame.success, stack, frame.log, ret, frame.gas, overlay(vm.state) if shared else vm.state.to_json())
+
+def stress(sims, jobs, rounds, seed=0):
+    # every simulation rounds times in each compile mode, shuffled across
+    # jobs threads; returns the runs and the ones that differ from serial
+    modes = (None, 0, 2)
+    expected = {(i, mode): simulate(sim, mode) for i, sim in enumerate(sims) for mode in modes}
+    for sim in sims:
+        if isinstance(sim[4], BackedState):
+            sim[4].evict()
+    work = [(i, mode) for i in range(len(sims)) for mode in modes] * rounds
+    random.Random(seed).shuffle(work)
+    with ThreadPoolExecutor(jobs) as pool:
+        results = list(pool.map(lambda key: simulate(sims[key[0]], key[1]), work))
+    mismatches = [key for key, result in zip(work, results) if result != expected[key]]
+    return len(work), mismatches
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run independent EVMs on threads and compare with serial runs")
+    parser.add_argument('-j', '--jobs', type=int, default=8, help="threads")
+    parser.add_argument('--rounds', type=int, default=10, help="runs of each simulation per compile mode")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    sims = simulations()
+    saved = (code_cache.max_size, keccak_memo.max_entries, sys.getswitchinterval())
+    code_cache.max_size = 64 * 1024
+    keccak_memo.max_entries = 64
+    sys.setswitchinterval(1e-6)
+    try:
+        start = time.perf_counter()
+        runs, mismatches = stress(sims, args.jobs, args.rounds, args.seed)
+        elapsed = time.perf_counter() - start
+    finally:
+        code_cache.max_size, keccak_memo.max_entries = saved[0], saved[1]
+        sys.setswitchinterval(saved[2])
+
+    for i, mode in list(dict.fromkeys(mismatches))[:20]:
+        print(f"differs from serial: {sims[i][0]} (compile_after={mode})")
+    print(f"{runs} runs of {len(sims)} simulations on {args.jobs} threads in {elapsed:.1f}s, "
+          f"{len(mismatches)} differ from serial")
+    return 1 if mismatches else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+
+# Tracing and profiling through instrumented dispatch tables. Nothing here
+# touches the normal path: a Tracer builds its own copies of evm.TABLES
+# and only runs given those tables see the hooks.
+#
+#   python3 evm_trace.py --profile 6001600101      # per-opcode counts/time
+#   python3 evm_trace.py --steps 6001600101        # EIP-3155 JSON lines
+
+import argparse
+import json
+import sys
+import time
+from collections import Counter
+import evm
+import evm_analysis
+import evm_codes
+from evm_gas import STATIC_COSTS
+
+OP_NAMES = {}
+for _name, _op in vars(evm_codes).items():
+    if _name.isupper() and isinstance(_op, int):
+        OP_NAMES.setdefault(_op, _name)
+
+def traced_tables(tracer, tables=evm.TABLES):
+    return tuple(_traced_table(tracer, table) for table in tables)
+
+def _traced_table(tracer, table):
+    perf_counter = time.perf_counter
+
+    def traced(handler, op):
+        def op_traced(frame, arg):
+            pc = frame.pcs[frame.ip - 1]
+            tracer.step(frame, pc, op)
+            start = perf_counter()
+            try:
+                return handler(frame, arg)
+            finally:
+                tracer.done(frame, pc, op, perf_counter() - start)
+        return op_traced
+
+    def unfused(frame, arg):
+        # a superinstruction runs as its two halves so every EVM instruction
+        # is seen: only the first half here, the second slot is still in the
+        # program and runs next
+        i = frame.ip - 1
+        pc = frame.pcs[i]
+        op = frame.code[pc]
+        tracer.step(frame, pc, op)
+        start = perf_counter()
+        try:
+            return table[op](frame, evm_analysis.first_arg(frame.program, i))
+        finally:
+            tracer.done(frame, pc, op, perf_counter() - start)
+
+    def charge(frame, arg):
+        tracer.enter(frame)
+        table[evm_analysis.CHARGE](frame, arg)
+        tracer.ahead[-1] = arg
+
+    traced_table = []
+    for op, handler in enumerate(table):
+        if op == evm_analysis.CHARGE:
+            traced_table.append(charge)
+        elif op == evm_analysis.CHECK:
+            traced_table.append(handler)
+        elif op > 0xff:
+            traced_table.append(unfused)
+        else:
+            traced_table.append(traced(handler, op))
+    return traced_table
+
+class Tracer:
+    # base for everything driven by traced_tables(). Keeps the stack of
+    # active frames and calls on_step(frame, pc, op, gas, depth) before each
+    # instruction, on_done(frame, pc, op, elapsed) after it (a sub-call runs
+    # after the CALL itself is done), and on_enter/on_exit around every
+    # frame that runs code. Runs go through an evm.EVM of its own, over state
+    # (a fresh WorldState by default), which they change as evm.EVM.run does.
+    def __init__(self, state=None):
+        self.vm = evm.EVM(state)
+        self.frames = []
+        # static gas a metered frame's CHARGE took ahead of the instructions
+        # still to run in the block, added back so each step reports the gas
+        # left before that instruction as EIP-3155 expects
+        self.ahead = []
+        self.tables = traced_tables(self)
+
+    def run(self, code, tx, block, storage, gas=None):
+        # self.vm.run() through the traced tables; returns the top-level Frame
+        try:
+            frame = self.vm.run(code, tx, block, storage, gas, self.tables)
+        finally:
+            while self.frames:
+                self.on_exit(self.frames.pop())
+            self.ahead.clear()
+        self.on_finish(frame, gas)
+        return frame
+
+    def enter(self, frame):
+        # a frame we have not seen yet is a sub-call of the current one;
+        # frames deeper than frame have finished by the time it runs again
+        frames = self.frames
+        depth = frame.depth
+        while len(frames) > depth + 1 or (len(frames) > depth and frames[depth] is not frame):
+            self.ahead.pop()
+            self.on_exit(frames.pop())
+        if len(frames) == depth:
+            frames.append(frame)
+            self.ahead.append(0)
+            self.on_enter(frame)
+
+    def step(self, frame, pc, op):
+        self.enter(frame)
+        gas = frame.gas + self.ahead[-1] if frame.gas is not None else None
+        self.on_step(frame, pc, op, gas, len(self.frames))
+
+    def done(self, frame, pc, op, elapsed):
+        self.ahead[-1] -= STATIC_COSTS[op]
+        self.on_done(frame, pc, op, elapsed)
+
+    def on_enter(self, frame):
+        pass
+
+    def on_exit(self, frame):
+        pass
+
+    def on_step(self, frame, pc, op, gas, depth):
+        pass
+
+    def on_done(self, frame, pc, op, elapsed):
+        pass
+
+    def on_finish(self, frame, gas):
+        pass
+
+class Profiler(Tracer):
+    # per-opcode counts and cumulative time, hottest (address, pc) pairs and
+    # instructions per call path for flame graphs
+    def __init__(self, state=None):
+        super().__init__(state)
+        self.counts = [0] * 256
+        self.times = [0.0] * 256
+        self.pcs = Counter()
+        self.stacks = Counter()
+        self.paths = []
+
+    def on_enter(self, frame):
+        path = evm.address_hex(frame.address)
+        if self.paths:
+            path = self.paths[-1] + ';' + path
+        self.paths.append(path)
+
+    def on_exit(self, frame):
+        self.paths.pop()
+
+    def on_step(self, frame, pc, op, gas, depth):
+        self.counts[op] += 1
+        self.pcs[(frame.address, pc)] += 1
+        self.stacks[self.paths[-1]] += 1
+
+    def on_done(self, frame, pc, op, elapsed):
+        self.times[op] += elapsed
+
+    def hottest_pcs(self, n=10):
+        return self.pcs.most_common(n)
+
+    def write_collapsed(self, out):
+        # one "addr;addr;addr count" line per call path, the input format of
+        # flamegraph.pl and speedscope
+        for path, count in sorted(self.stacks.items()):
+            out.write(f"{path} {count}\n")
+
+    def report(self, out, top=10):
+        out.write(f"{'opcode':<16}{'count':>10}{'time (ms)':>12}{'us/op':>10}\n")
+        ops = sorted((op for op in range(256) if self.counts[op]), key=lambda op: -self.times[op])
+        for op in ops:
+            name = OP_NAMES.get(op, hex(op))
+            out.write(f"{name:<16}{self.counts[op]:>10}{self.times[op] * 1e3:>12.3f}"
+                      f"{self.times[op] / self.counts[op] * 1e6:>10.2f}\n")
+        out.write("\nhottest pcs:\n")
+        for (address, pc), count in self.hottest_pcs(top):
+            out.write(f"  {evm.address_hex(address)} pc={pc:<6}{count:>10}\n")
+
+class StepTracer(Tracer):
+    # EIP-3155 step trace, one JSON object per line written to out as the
+    # code runs, and a summary line at the end. gasCost is what the frame's
+    # gas actually went down by across the instruction: dynamic costs
+    # included, gas handed to a sub-call too, and everything left when it
+    # fails the frame. In unmetered runs gas is reported as MAX_UINT256,
+    # the value GAS pushes there, and gasCost as 0.
+    def __init__(self, out, state=None):
+        super().__init__(state)
+        self.out = out
+        # the line of the instruction running and the gas it started with,
+        # written out once it is done
+        self.pending = None
+
+    def on_step(self, frame, pc, op, gas, depth):
+        self.pending = ({
+            "pc": pc,
+            "op": op,
+            "gas": hex(evm.MAX_UINT256 if gas is None else gas),
+            "gasCost": hex(0),
+            "memSize": len(frame.memory),
+            "stack": [hex(x) for x in frame.stack.items],
+            "depth": depth,
+            "refund": 0,
+            "opName": OP_NAMES.get(op, hex(op)),
+        }, gas)
+
+    def on_done(self, frame, pc, op, elapsed):
+        line, gas = self.pending
+        if gas is not None:
+            # a failed frame's gas is gone, what CHARGE took ahead included
+            left = frame.gas + self.ahead[-1] if frame.success else frame.gas
+            line["gasCost"] = hex(gas - left)
+        self.out.write(json.dumps(line) + "\n")
+
+    def on_finish(self, frame, gas):
+        summary = {
+            "output": frame.ret.hex() if frame.ret is not None else "",
+            "pass": frame.success,
+        }
+        if gas is not None:
+            summary["gasUsed"] = hex(gas - frame.gas)
+        self.out.write(json.dumps(summary) + "\n")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Trace or profile EVM bytecode")
+    parser.add_argument('code', help="bytecode as hex")
+    parser.add_argument('--data', default='', help="calldata as hex")
+    parser.add_argument('--gas', type=int, help="run metered with this much gas")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--steps', action='store_true', help="EIP-3155 JSON lines on stdout (default)")
+    mode.add_argument('--profile', action='store_true', help="per-opcode profile on stdout")
+    mode.add_argument('--collapsed', action='store_true', help="collapsed call stacks for flame graphs")
+    args = parser.parse_args(argv)
+
+    tx = {"to": "0x1000000000000000000000000000000000000c0d", "data": args.data}
+    tracer = Profiler() if args.profile or args.collapsed else StepTracer(sys.stdout)
+    tracer.run(bytes.fromhex(args.code), tx, {}, {}, args.gas)
+    if args.profile:
+        tracer.report(sys.stdout)
+    elif args.collapsed:
+        tracer.write_collapsed(sys.stdout)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
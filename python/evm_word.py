@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+
+# 256-bit word arithmetic on Python ints. Everything stays bounded by the
+# word size: no operation builds an int much wider than 512 bits, whatever
+# its operands.
+#
+#   python3 evm_word.py             # differential fuzz against the reference
+
+import random
+import sys
+import time
+
+WORD_BITS = 256
+MOD = 1 << WORD_BITS
+MASK = MOD - 1
+SIGN_BIT = 1 << (WORD_BITS - 1)
+
+# SIGNEXTEND from byte b: the bits kept, and the sign bit to copy upwards
+_EXTEND_MASKS = [(1 << (8 * b + 8)) - 1 for b in range(31)]
+_EXTEND_SIGNS = [1 << (8 * b + 7) for b in range(31)]
+
+def to_signed(x):
+    return x - MOD if x & SIGN_BIT else x
+
+def to_unsigned(x):
+    return x & MASK
+
+def add(a, b):
+    return (a + b) & MASK
+
+def mul(a, b):
+    return (a * b) & MASK
+
+def sub(a, b):
+    return (a - b) & MASK
+
+def div(a, b):
+    return a // b if b else 0
+
+def sdiv(a, b):
+    # truncates towards zero; MIN // -1 wraps back to MIN
+    if b == 0:
+        return 0
+    a, b = to_signed(a), to_signed(b)
+    q = abs(a) // abs(b)
+    return (-q if (a < 0) != (b < 0) else q) & MASK
+
+def mod(a, b):
+    return a % b if b else 0
+
+def smod(a, b):
+    # the result takes the sign of the dividend
+    if b == 0:
+        return 0
+    a, b = to_signed(a), to_signed(b)
+    r = abs(a) % abs(b)
+    return (-r if a < 0 else r) & MASK
+
+def addmod(a, b, n):
+    return (a + b) % n if n else 0
+
+def mulmod(a, b, n):
+    return (a * b) % n if n else 0
+
+def exp(a, b):
+    return pow(a, b, MOD)
+
+def signextend(b, x):
+    if b >= 31:
+        return x
+    x &= _EXTEND_MASKS[b]
+    if x & _EXTEND_SIGNS[b]:
+        return x | (MASK ^ _EXTEND_MASKS[b])
+    return x
+
+def slt(a, b):
+    # flipping the sign bit maps signed order onto unsigned order
+    return int((a ^ SIGN_BIT) < (b ^ SIGN_BIT))
+
+def sgt(a, b):
+    return int((a ^ SIGN_BIT) > (b ^ SIGN_BIT))
+
+def byte(i, x):
+    return (x >> (8 * (31 - i))) & 0xFF if i < 32 else 0
+
+def shl(shift, x):
+    return (x << shift) & MASK if shift < WORD_BITS else 0
+
+def shr(shift, x):
+    return x >> shift if shift < WORD_BITS else 0
+
+def sar(shift, x):
+    if x & SIGN_BIT:
+        # Python's >> on a negative int is already arithmetic
+        return ((x - MOD) >> shift) & MASK if shift < WORD_BITS else MASK
+    return x >> shift if shift < WORD_BITS else 0
+
+# the string-based implementations this module replaced, as they were, for
+# fuzz() to compare against. Where the kernel means to differ from them is
+# listed in fuzz().
+
+def _ref_signed(x):
+    return x if x < (2 ** 255 - 1) else x - (2 ** 256)
+
+def _ref_unsigned(x):
+    return x if x >= 0 else x + (2 ** 256)
+
+def _ref_sdiv(a, b):
+    if b == 0:
+        return 0
+    return _ref_unsigned(_ref_signed(a) // _ref_signed(b))
+
+def _ref_smod(a, b):
+    if b == 0:
+        return 0
+    return _ref_unsigned(_ref_signed(a) % _ref_signed(b))
+
+def _ref_exp(a, b):
+    return (a ** b) % (2 ** 256)
+
+def _ref_signextend(sz, val):
+    if sz > 32:
+        sz = 32
+    num = bin(val % (256 ** (sz + 1)))
+    if len(num) - 2 == (sz + 1) * 8:
+        num = '0b' + '1' * (32 * 8 + 2 - len(num)) + num[2:]
+    return int(num, 2)
+
+def _ref_byte(i, val):
+    return 0 if i not in range(0, 32) else (val >> (8 * (31 - i))) & 0xFF
+
+def _ref_shl(shift, val):
+    return (val << shift) & ((2 ** 256) - 1)
+
+def _ref_sar(shift, val):
+    num = bin(val)
+    if shift >= 256:
+        return int('0b' + '1' * 256, 2) if len(num) - 2 == 32 * 8 else 0
+    if len(num) - 2 == 32 * 8:
+        num = bin(val >> shift)
+        if int(num, 2) == 0:
+            num = '0b'
+        return int('0b' + '1' * (32 * 8 + 2 - len(num)) + num[2:], 2)
+    return val >> shift
+
+REFERENCE = {
+    add: lambda a, b: (a + b) % (2 ** 256),
+    mul: lambda a, b: (a * b) % (2 ** 256),
+    sub: lambda a, b: (a - b) % (2 ** 256),
+    div: lambda a, b: 0 if b == 0 else a // b,
+    sdiv: _ref_sdiv,
+    mod: lambda a, b: 0 if b == 0 else a % b,
+    smod: _ref_smod,
+    exp: _ref_exp,
+    signextend: _ref_signextend,
+    slt: lambda a, b: int(_ref_signed(a) < _ref_signed(b)),
+    sgt: lambda a, b: int(_ref_signed(a) > _ref_signed(b)),
+    byte: _ref_byte,
+    shl: _ref_shl,
+    shr: lambda shift, val: val >> min(shift, 512),
+    sar: _ref_sar,
+}
+
+EDGES = [0, 1, 2, 7, 8, 30, 31, 32, 33, 255, 256, 257, 2 ** 64, 2 ** 128,
+         2 ** 255 - 2, 2 ** 255 - 1, 2 ** 255, 2 ** 255 + 1, 2 ** 256 - 2, 2 ** 256 - 1]
+
+def operand(rng):
+    kind = rng.random()
+    if kind < 0.3:
+        return rng.choice(EDGES)
+    if kind < 0.5:
+        return rng.randrange(300)
+    if kind < 0.6:
+        return MASK - rng.randrange(300)
+    return rng.getrandbits(rng.choice((8, 64, 128, 255, 256)))
+
+def fuzz(iterations=20000, seed=0):
+    # every kernel op against its reference on random and boundary operands;
+    # returns the mismatches
+    rng = random.Random(seed)
+    failures = []
+    for op, ref in REFERENCE.items():
+        pairs = [(a, b) for a in EDGES for b in EDGES]
+        pairs += [(operand(rng), operand(rng)) for _ in range(iterations)]
+        for a, b in pairs:
+            # where the kernel differs from the old code on purpose:
+            # - EXP and SHL are not compared for exponents and shifts of
+            #   4096 and up, the old a ** b and val << shift never finish
+            if op is exp and b >= 4096 or op is shl and a >= 4096:
+                continue
+            # - the old code counted 2**255 - 1 as negative
+            if op in (sdiv, smod, slt, sgt) and SIGN_BIT - 1 in (a, b):
+                continue
+            want = ref(a, b)
+            sa, sb = to_signed(a), to_signed(b)
+            if op in (sdiv, smod) and sb and (sa < 0) != (sb < 0) and sa % sb:
+                # - SDIV truncates toward zero where the old code floored,
+                #   and SMOD takes the dividend's sign, not the divisor's
+                want = (want + 1) & MASK if op is sdiv else (want - sb) & MASK
+            if op(a, b) != want:
+                failures.append((op.__name__, a, b, op(a, b), want))
+    return failures
+
+# operands the old string and unbounded-int code took seconds (or the
+# whole machine's memory) to get through
+EXTREME = [
+    (exp, 3, MASK),
+    (exp, MASK, MASK),
+    (shl, MASK, 1),
+    (sar, MASK, MASK),
+    (signextend, MASK, MASK),
+]
+
+def main():
+    failures = fuzz()
+    for name, a, b, got, want in failures[:20]:
+        print(f"{name}({hex(a)}, {hex(b)}) = {hex(got)}, expected {hex(want)}")
+    slowest = 0.0
+    for op, a, b in EXTREME:
+        start = time.perf_counter()
+        op(a, b)
+        slowest = max(slowest, time.perf_counter() - start)
+    print(f"{len(REFERENCE)} ops fuzzed, {len(failures)} mismatches, "
+          f"slowest extreme case {slowest * 1e6:.0f}us")
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    sys.exit(main())